@@ -1,8 +1,18 @@
 import binascii
+import collections
+import functools
 import logging
-import pygatt
+import random
+import threading
 import time
-import queue
+
+from lazy import lazy_import
+from metrics import Histogram
+from tracing import TRACER, traced
+
+# loaded on first use, they are slow to import
+asyncio = lazy_import('asyncio')
+pygatt = lazy_import('pygatt')
 
 ble_log = logging.getLogger('pygatt')
 ble_log.setLevel(logging.WARN)
@@ -17,63 +27,535 @@ MODE_CHAR_RW = "A87988B9-694C-479C-900E-95DFA6C00A24"
 RX_CHAR_WO = "BF03260C-7205-4C25-AF43-93B1C299D159"
 TX_CHAR_RD = "18CDA784-4BD3-4370-85BB-BFED91EC86AF"
 RTS_CHAR_RD = "FDD6B4D3-046D-4330-BDEC-1FD0C90CB43B"
+# '$' flushes the BMS write buffer, returning one packet in data mode
+FLUSH = bytearray([0x24])
+# bounds of the jittered exponential backoff between connection attempts
+RECONNECT_DELAY_MIN = 0.1
+RECONNECT_DELAY_MAX = 10.0
+
+REQUIRED_KEYS = [
+    'pack_voltage', 'total_cells', 'time_hours', 'time_minutes',
+    'input_amps', 'input_watts', 'output_amps', 'output_watts',
+    'pack_soc']
+
+def merge_packet(battery_info, packet):
+    """merge_packet
+    Merge a parsed packet into a battery_info dict
+    """
+    if packet['type'] == 'invalid':
+        return
+    if packet['type'] == 'cell_info':
+        idx = packet['contents']['cell_index']
+        battery_info['cells'][idx] = {
+            'temp': packet['contents']['cell_temp'],
+            'volts': packet['contents']['cell_volts']
+        }
+        battery_info['total_cells'] = packet['contents']['total_cells']
+    else:
+        for key, val in packet['contents'].items():
+            battery_info[key] = val
+
+def has_all_battery_info(battery_info):
+    # full rescan, SnapshotAssembler tracks this per packet
+    for req in REQUIRED_KEYS:
+        if req not in battery_info:
+            return False
+    for ind in range(1, battery_info['total_cells'] + 1):
+        if ind not in battery_info['cells']:
+            return False
+    return True
+
+class SnapshotAssembler(object):
+    """SnapshotAssembler
+    Merges packets into a battery_info dict and tracks the required
+    fields and cells seen as bitmaps, so completeness is an integer
+    compare per packet. A sweep ends once every cell has been seen since
+    the last sweep ended
+    """
+    def __init__(self, battery_info=None, required=REQUIRED_KEYS):
+        self.info = battery_info if battery_info is not None else {'cells': {}}
+        self.field_bits = {key: 1 << i for i, key in enumerate(required)}
+        self.all_fields = (1 << len(required)) - 1
+        # packet type -> bits of the required fields it carries
+        self.type_bits = {}
+        # field -> packet type carrying it
+        self.field_types = {}
+        self.fields_seen = 0
+        self.total_cells = 0
+        self.all_cells = 0
+        self.cells_seen = 0
+        self.sweep_seen = 0
+        self.sweeps = 0
+        self.partial_sweeps = 0
+        self.complete = False
+        # monotonic time of the last packet per type and per cell
+        self.type_updated = {}
+        self.cell_updated = {}
+
+    def _type_bits(self, packet_type, fields):
+        bits = 0
+        for field in fields:
+            bits |= self.field_bits.get(field, 0)
+            self.field_types[field] = packet_type
+        self.type_bits[packet_type] = bits
+        return bits
+
+    def add(self, packet, timestamp=None):
+        """add
+        Merge a packet (dict or record) and track it, returns True if it
+        ended a cell sweep
+        """
+        if not isinstance(packet, dict):
+            packet = packet.to_dict()
+        merge_packet(self.info, packet)
+        return self.track(packet, timestamp)
+
+    def track(self, packet, timestamp=None):
+        """track
+        Track a packet without merging it, returns True if it ended a
+        cell sweep
+        """
+        if timestamp is None:
+            timestamp = time.monotonic()
+        if isinstance(packet, dict):
+            packet_type = packet['type']
+            contents = packet['contents']
+        else:
+            packet_type = packet.type
+            contents = None
+        if packet_type == 'invalid':
+            return False
+        self.type_updated[packet_type] = timestamp
+        bits = self.type_bits.get(packet_type)
+        if bits is None:
+            bits = self._type_bits(packet_type, packet['contents']
+                                   if contents is not None else packet._fields)
+        self.fields_seen |= bits
+        if packet_type != 'cell_info':
+            self._check()
+            return False
+
+        if contents is not None:
+            index = contents['cell_index']
+            total = contents['total_cells']
+        else:
+            index = packet.cell_index
+            total = packet.total_cells
+        if not 0 < index <= total:
+            # a corrupt record that did not come through decode_packet
+            return False
+        if total != self.total_cells:
+            self.total_cells = total
+            self.all_cells = (1 << total) - 1
+            self.cells_seen &= self.all_cells
+            self.sweep_seen &= self.all_cells
+        self.cell_updated[index] = timestamp
+        bit = 1 << (index - 1)
+        self.cells_seen |= bit
+        ended = False
+        if self.sweep_seen & bit:
+            # a cell came round again before the sweep was complete
+            self.partial_sweeps += 1
+            self.sweep_seen = 0
+        self.sweep_seen |= bit
+        if self.sweep_seen == self.all_cells:
+            self.sweeps += 1
+            self.sweep_seen = 0
+            ended = True
+        self._check()
+        return ended
+
+    def _check(self):
+        self.complete = self.fields_seen == self.all_fields and \
+            self.total_cells > 0 and self.cells_seen == self.all_cells
+
+    def field_age(self, field, now=None):
+        """field_age
+        Seconds since a field (or cell index) was last received, None if
+        it never was
+        """
+        if isinstance(field, int):
+            updated = self.cell_updated.get(field)
+        else:
+            updated = self.type_updated.get(self.field_types.get(field))
+        if updated is None:
+            return None
+        return (time.monotonic() if now is None else now) - updated
+
+    def missing(self):
+        """missing
+        Return ([missing required fields], [missing cell indices])
+        """
+        fields = [key for key, bit in self.field_bits.items()
+                  if not self.fields_seen & bit]
+        cells = [i + 1 for i in range(self.total_cells)
+                 if not self.cells_seen & (1 << i)]
+        return fields, cells
+
+def backoff_delay(failures, base=RECONNECT_DELAY_MIN, cap=RECONNECT_DELAY_MAX):
+    """backoff_delay
+    Exponential backoff with jitter, in seconds, after `failures`
+    consecutive failures
+    """
+    delay = min(cap, base * 2 ** max(0, failures - 1))
+    return delay * random.uniform(0.5, 1.0)
+
+# Compact packet records, to_dict() returns the {'type', 'contents'} shape
+class Overview(collections.namedtuple(
+        'Overview', 'pack_voltage input_amps pack_amps output_amps')):
+    __slots__ = ()
+    type = 'overview'
+
+    def to_dict(self):
+        return {'type': self.type, 'contents': self._asdict()}
+
+class MinMaxTemp(collections.namedtuple(
+        'MinMaxTemp', 'min_index min_temp max_index max_temp')):
+    __slots__ = ()
+    type = 'min_max_temp'
+
+    def to_dict(self):
+        return {
+            'type': self.type,
+            'contents': {
+                'min_temp_cell': {'index': self.min_index, 'temp': self.min_temp},
+                'max_temp_cell': {'index': self.max_index, 'temp': self.max_temp}
+            }
+        }
+
+class Energy(collections.namedtuple(
+        'Energy', 'input_kwh pack_kwh output_kwh pack_soc')):
+    __slots__ = ()
+    type = 'energy'
+
+    def to_dict(self):
+        return {'type': self.type, 'contents': self._asdict()}
+
+class Power(collections.namedtuple(
+        'Power', 'input_watts output_watts time_hours time_minutes')):
+    __slots__ = ()
+    type = 'power'
+
+    def to_dict(self):
+        return {'type': self.type, 'contents': self._asdict()}
+
+class MinMaxVolts(collections.namedtuple(
+        'MinMaxVolts', 'min_index min_volts max_index max_volts balance_volts')):
+    __slots__ = ()
+    type = 'min_max_volts'
+
+    def to_dict(self):
+        return {
+            'type': self.type,
+            'contents': {
+                'min_volt_cell': {'index': self.min_index, 'volts': self.min_volts},
+                'max_volt_cell': {'index': self.max_index, 'volts': self.max_volts},
+                'balance_volts': self.balance_volts
+            }
+        }
+
+class CellInfo(collections.namedtuple(
+        'CellInfo', 'cell_index total_cells cell_volts cell_temp')):
+    __slots__ = ()
+    type = 'cell_info'
+
+    def to_dict(self):
+        return {'type': self.type, 'contents': self._asdict()}
+
+class Invalid(collections.namedtuple('Invalid', 'message')):
+    __slots__ = ()
+    type = 'invalid'
+
+    def to_dict(self):
+        return {'type': self.type, 'contents': self._asdict()}
+
+def _decode_overview(f):
+    return Overview(int(f[1], 16) * 0.005, int(f[2], 16) * 0.05,
+                    int(f[3], 16) * 0.05, int(f[4], 16) * 0.05)
+
+def _decode_min_max_temp(f):
+    return MinMaxTemp(int(f[2], 16), int(f[1], 16) * 0.857 - 232.1,
+                      int(f[4], 16), int(f[3], 16) * 0.857 - 232.1)
+
+def _decode_energy(f):
+    return Energy(int(f[1], 16) / 1000, int(f[2], 16) / 1000,
+                  int(f[3], 16) / 1000, int(f[4], 16))
+
+def _decode_power(f):
+    hours, minutes = f[3].split(b':')
+    return Power(int(f[1], 16), int(f[2], 16),
+                 int(hours, 16), int(minutes, 16))
+
+def _decode_min_max_volts(f):
+    return MinMaxVolts(int(f[2], 16), int(f[1], 16) * 0.005,
+                       int(f[4], 16), int(f[3], 16) * 0.005,
+                       int(f[5], 16) * 0.005)
+
+def _decode_cell_info(f):
+    cell_indx = int(f[1], 16)
+    cells_len = int(f[2], 16)
+    if not 0 < cell_indx <= cells_len:
+        return Invalid("Cell %i out of bounds" % (cell_indx))
+    return CellInfo(cell_indx, cells_len,
+                    int(f[3], 16) * 0.005, int(f[4], 16) * 0.857 - 232.1)
+
+def _unset_to_zero(field):
+    parts = field.split(b':')
+    return b':'.join(b'0' if p[:1] == b'X' else p for p in parts)
+
+# packet type byte -> (number of fields, decoder)
+DECODERS = {
+    ord('U'): (5, _decode_overview),
+    ord('T'): (5, _decode_min_max_temp),
+    ord('E'): (5, _decode_energy),
+    ord('M'): (4, _decode_power),
+    ord('V'): (6, _decode_min_max_volts),
+    ord('C'): (6, _decode_cell_info)
+}
+
+def decode_packet(input_bytes):
+    """decode_packet
+    Decode a frame (bytes, bytearray or memoryview) into a packet record
+    """
+    if isinstance(input_bytes, memoryview):
+        input_bytes = input_bytes.tobytes()
+    fields = input_bytes.split(b'_')
+    decoder = None
+    if len(fields[0]) == 1:
+        decoder = DECODERS.get(fields[0][0])
+    if decoder is None or decoder[0] != len(fields):
+        return Invalid("Unknown packet " + str(fields))
+    try:
+        return decoder[1](fields)
+    except ValueError:
+        pass
+    try:
+        # 'X' filled fields are unset values
+        return decoder[1]([_unset_to_zero(f) for f in fields])
+    except ValueError:
+        # a corrupt frame must not end the stream
+        return Invalid("Corrupt packet " + str(fields))
+
+class FrameBuffer(object):
+    """FrameBuffer
+    Collects notification chunks from the BLE callback and splits them
+    into '\\r'-terminated frames. Readers block on a condition that is
+    notified as soon as a frame is complete.
+    """
+    def __init__(self, terminator=b'\r', listener=None):
+        self.terminator = terminator
+        self.listener = listener
+        self.cond = threading.Condition()
+        self.partial = bytearray()
+        self.partial_start = None
+        self.frames = collections.deque()
+        # statistics
+        self.frames_received = 0
+        self.frames_read = 0
+        self.max_depth = 0
+        self.last_latency = None
+        self.max_latency = 0.0
+        self.total_latency = 0.0
+
+    def append(self, chunk):
+        now = time.monotonic()
+        with self.cond:
+            if not self.partial:
+                self.partial_start = now
+            self.partial.extend(chunk)
+            completed = False
+            while True:
+                end = self.partial.find(self.terminator)
+                if end < 0:
+                    break
+                end += len(self.terminator)
+                self.frames.append((self.partial_start, bytearray(self.partial[:end])))
+                del self.partial[:end]
+                self.partial_start = now
+                self.frames_received += 1
+                completed = True
+            if completed:
+                self.max_depth = max(self.max_depth, len(self.frames))
+                self.cond.notify_all()
+        if completed and self.listener is not None:
+            self.listener()
+        return completed
+
+    def get(self, timeout=0):
+        """get
+        Return the next complete frame, waiting at most timeout seconds
+        (forever if timeout <= 0). Returns None on time-out
+        """
+        deadline = time.monotonic() + timeout if timeout > 0 else None
+        with self.cond:
+            while not self.frames:
+                if deadline is None:
+                    self.cond.wait()
+                    continue
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self.cond.wait(remaining)
+            return self._pop()
+
+    def get_nowait(self):
+        with self.cond:
+            if not self.frames:
+                return None
+            return self._pop()
+
+    def _pop(self):
+        started, frame = self.frames.popleft()
+        latency = time.monotonic() - started
+        self.frames_read += 1
+        self.last_latency = latency
+        self.max_latency = max(self.max_latency, latency)
+        self.total_latency += latency
+        return frame
+
+    def clear(self):
+        with self.cond:
+            self.partial = bytearray()
+            self.partial_start = None
+            self.frames.clear()
+
+    def depth(self):
+        with self.cond:
+            return len(self.frames)
+
+    def stats(self):
+        with self.cond:
+            mean_latency = None
+            if self.frames_read > 0:
+                mean_latency = self.total_latency / self.frames_read
+            return {
+                'frames_received': self.frames_received,
+                'frames_read': self.frames_read,
+                'queue_depth': len(self.frames),
+                'max_queue_depth': self.max_depth,
+                'last_latency': self.last_latency,
+                'mean_latency': mean_latency,
+                'max_latency': self.max_latency
+            }
 
 class SmartBMS(object):
-    def __init__(self):
-        self.adapter = pygatt.GATTToolBackend()
-        self.adapter.start()
+    def __init__(self, address=DEVICE_ADDR, adapter=None, pipeline=0):
+        self.address = address
+        # number of unacknowledged packet requests kept in flight while
+        # streaming, 0 waits for a write response per packet
+        self.pipeline = pipeline
+        self.handles = {}
+        self.writes = 0
+        self.round_trips = 0
+        self.connects = 0
+        self.parse_latency = Histogram()
+        # an adapter passed in is shared and is not stopped by close(),
+        # without one an adapter is started on the first connection
+        self.owns_adapter = adapter is None
+        self.adapter = adapter
         self.device = None
-        self.recv_queue = queue.Queue()
+        self.recv_buffer = FrameBuffer()
 
     def __del__(self):
-        try:
-            self.device.unsubscribe(TX_CHAR_RD)
-        except Exception as ex:
-            LOG.error("Could not unsubscribe %s", ex)
-        try:
-            self.device.disconnect()
-        except Exception as ex:
-            LOG.error("Could not disconnect %s", ex)
-        self.adapter.stop()
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def disconnect(self):
+        """disconnect
+        Drop the connection, keeping the cached handles for a reconnect
+        """
+        if self.device is not None:
+            try:
+                self.device.unsubscribe(TX_CHAR_RD)
+            except Exception as ex:
+                LOG.error("Could not unsubscribe %s", ex)
+            try:
+                self.device.disconnect()
+            except Exception as ex:
+                LOG.error("Could not disconnect %s", ex)
+            self.device = None
 
-    def _connect(self, timeout):
+    def close(self):
+        self.disconnect()
+        self.handles = {}
+        if self.owns_adapter and self.adapter is not None:
+            self.adapter.stop()
+            self.adapter = None
+
+    @traced('bms.connect')
+    def _connect(self, timeout, attempts=0):
+        # retries with backoff, forever if attempts is 0. Handles are
+        # kept, the GATT table of the BMS does not change between
+        # connections
+        if self.adapter is None:
+            self.adapter = pygatt.GATTToolBackend()
+            self.adapter.start()
+        failures = 0
         while True:
             try:
                 LOG.info("Connecting to BMS")
-                self.device = self.adapter.connect(DEVICE_ADDR, timeout=timeout)
+                self.device = self.adapter.connect(self.address, timeout=timeout)
+                self.connects += 1
                 return True
             except pygatt.exceptions.NotConnectedError as ex:
                 LOG.info("Could not connect to BMS: %s", str(ex))
-                time.sleep(1.0)
+                failures += 1
+                if attempts > 0 and failures >= attempts:
+                    return False
+                time.sleep(backoff_delay(failures))
 
     def _data_recv_callback(self, handle, value):
-        for character in value:
-            self.recv_queue.put(character)
+        self.recv_buffer.append(value)
 
-    def _send_bytes(self, ble_uuid, send_bytes, timeout):
-        try:
+    def _get_handle(self, ble_uuid):
+        # handles are resolved once per connection
+        handle = self.handles.get(ble_uuid)
+        if handle is None:
             handle = self.device.get_handle(ble_uuid)
-            self.device.char_write_handle(handle, send_bytes, timeout=timeout)
+            self.handles[ble_uuid] = handle
+        return handle
+
+    def _send_bytes(self, ble_uuid, send_bytes, timeout,
+                    wait_for_response=True):
+        try:
+            handle = self._get_handle(ble_uuid)
+            self.writes += 1
+            if wait_for_response:
+                self.round_trips += 1
+            self.device.char_write_handle(
+                handle, send_bytes, wait_for_response=wait_for_response,
+                timeout=timeout)
             return True
         except pygatt.exceptions.NotificationTimeout:
             return False
         except pygatt.exceptions.NotConnectedError:
             return False
 
-    def _send_command(self, cmd_str, timeout):
-        # package and send the command
+    @staticmethod
+    def _encode_command(cmd_str):
         command = [0] * len(cmd_str)
         for i in range(len(cmd_str)):
             command[i] = ord(cmd_str[i])
-        if not self._send_bytes(RX_CHAR_WO, bytearray(command), timeout):
+        return bytearray(command)
+
+    @traced('bms.command', lambda self, cmd_str, timeout: cmd_str.strip())
+    def _send_command(self, cmd_str, timeout):
+        # package and send the command
+        command = self._encode_command(cmd_str)
+        if not self._send_bytes(RX_CHAR_WO, command, timeout):
             LOG.error("Could not send command '%s'" % (cmd_str))
             return None
 
         # get the response
         recv = bytearray()
-        while not self._endswith(recv, bytearray(command)):
+        while not self._endswith(recv, command):
             # flush write buffer
-            self._send_bytes(RX_CHAR_WO, bytearray([0x24]), timeout)
+            self._send_bytes(RX_CHAR_WO, FLUSH, timeout)
             recv = self._wait_for_data(timeout=timeout)
             if recv is None:
                 LOG.info("Timed-out waiting for response to %s", cmd_str)
@@ -81,132 +563,14 @@ class SmartBMS(object):
 
         return self._wait_for_data(timeout=timeout)
 
+    @traced('bms.wait')
     def _wait_for_data(self, timeout=0):
-        last_char = ''
-        data = []
-        total_time = 0
-        while True:
-            while not self.recv_queue.empty():
-                last_char = self.recv_queue.get()
-                data.append(last_char)
-                if last_char == ord('\r'):
-                    return bytearray(data)
-            if timeout > 0 and total_time > timeout:
-                return None
-            time.sleep(0.1)
-            total_time += 0.1
-
-    @staticmethod
-    def _parse_int(input_bytes):
-        if isinstance(input_bytes, bytearray):
-            input_bytes = input_bytes.decode()
-        if input_bytes[0] == 'X':
-            return 0
-        return int(input_bytes, 16)
-
-    @staticmethod
-    def _parse_tmp(input_bytes):
-        return SmartBMS._parse_int(input_bytes) * 0.857 - 232.1
+        return self.recv_buffer.get(timeout=timeout)
 
     @staticmethod
+    @traced('bms.parse')
     def _parse_packet(input_bytes):
-        data_arr = input_bytes.split("_".encode())
-        pkt_type = data_arr[0].decode()
-        pkt_len = len(data_arr)
-
-        if pkt_type == 'U' and pkt_len == 5:
-            # Overview
-            return {
-                'type': 'overview',
-                'contents': {
-                    "pack_voltage": SmartBMS._parse_int(data_arr[1]) * 0.005,
-                    "input_amps": SmartBMS._parse_int(data_arr[2]) * 0.05,
-                    "pack_amps": SmartBMS._parse_int(data_arr[3]) * 0.05,
-                    "output_amps": SmartBMS._parse_int(data_arr[4]) * 0.05
-                }
-            }
-        elif pkt_type == 'T' and pkt_len == 5:
-            # Min / max temperatures
-            return {
-                'type': 'min_max_temp',
-                'contents': {
-                    'min_temp_cell': {
-                        'index': SmartBMS._parse_int(data_arr[2]),
-                        'temp': SmartBMS._parse_tmp(data_arr[1])
-                    },
-                    'max_temp_cell': {
-                        'index': SmartBMS._parse_int(data_arr[4]),
-                        'temp': SmartBMS._parse_tmp(data_arr[3])
-                    }
-                }
-            }
-        elif pkt_type == 'E' and pkt_len == 5:
-            # Energy counters / battery SOC
-            return {
-                'type': 'energy',
-                'contents': {
-                    'input_kwh': SmartBMS._parse_int(data_arr[1]) / 1000,
-                    'pack_kwh': SmartBMS._parse_int(data_arr[2]) / 1000,
-                    'output_kwh': SmartBMS._parse_int(data_arr[3]) / 1000,
-                    'pack_soc': SmartBMS._parse_int(data_arr[4])
-                }
-            }
-        elif pkt_type == 'M' and pkt_len == 4:
-            time_str = data_arr[3].decode().split(":")
-            return {
-                'type': 'power',
-                'contents': {
-                    'input_watts': SmartBMS._parse_int(data_arr[1]),
-                    'output_watts': SmartBMS._parse_int(data_arr[2]),
-                    'time_hours': SmartBMS._parse_int(time_str[0]),
-                    'time_minutes': SmartBMS._parse_int(time_str[1])
-                }
-            }
-        elif pkt_type == 'V' and pkt_len == 6:
-            # Min / max cell voltages
-            return {
-                'type': 'min_max_volts',
-                'contents': {
-                    'min_volt_cell': {
-                        'index': SmartBMS._parse_int(data_arr[2]),
-                        'volts': SmartBMS._parse_int(data_arr[1]) * 0.005
-                    },
-                    'max_volt_cell': {
-                        'index': SmartBMS._parse_int(data_arr[4]),
-                        'volts': SmartBMS._parse_int(data_arr[3]) * 0.005
-                    },
-                    'balance_volts': SmartBMS._parse_int(data_arr[5]) * 0.005
-                }
-            }
-        elif pkt_type == 'C' and pkt_len == 6:
-            # Cell voltages
-            cell_indx = SmartBMS._parse_int(data_arr[1])
-            cells_len = SmartBMS._parse_int(data_arr[2])
-            if cell_indx <= cells_len:
-                cell_volts = SmartBMS._parse_int(data_arr[3]) * 0.005
-                cell_temp = SmartBMS._parse_tmp(data_arr[4])
-                return {
-                    'type': 'cell_info',
-                    'contents': {
-                        'cell_index': cell_indx,
-                        'total_cells': cells_len,
-                        'cell_volts': cell_volts,
-                        'cell_temp': cell_temp
-                    }
-                }
-            return {
-                'type': 'invalid',
-                'contents': {
-                    'message': "Cell %i out of bounds" % (cell_indx)
-                }
-            }
-        else:
-            return {
-                'type': 'invalid',
-                'contents': {
-                    'message': "Unknown packet " + str(data_arr)
-                }
-            }
+        return decode_packet(input_bytes).to_dict()
 
     @staticmethod
     def _endswith(input_bytes, suffix_bytes):
@@ -219,62 +583,372 @@ class SmartBMS(object):
                 return False
         return True
 
-    def _all_cells_measured(self):
-        # check that all cell measurements are present
-        if self.cells_len is None:
-            return False
-        print(self.cells)
-        for i in range(self.cells_len):
-            if i not in self.cells:
-                return False
-        return True
-
-    def initialize(self, timeout):
+    def _subscribe(self):
         # Observes the given characteristics for indications.
         # When a response is available, calls data_recv_callback
+        self.recv_buffer.clear()
+        self.device.subscribe(
+            TX_CHAR_RD,
+            callback=self._data_recv_callback,
+            indication=True,
+            wait_for_response=True)
+        LOG.info("Subscribed")
+
+    def _open(self, timeout, attempts=0):
         try:
-            #self.device = self.adapter.connect(DEVICE_ADDR, timeout=timeout)
-            #LOG.info("Connection Established")
-            self._connect(timeout)
+            if self.device is None and not self._connect(timeout, attempts):
+                return False
             LOG.info("Connected")
-
-            self.device.subscribe(
-                TX_CHAR_RD,
-                callback=self._data_recv_callback,
-                indication=True,
-                wait_for_response=True)
-            LOG.info("Subscribed")
+            self._subscribe()
+            return True
         except pygatt.exceptions.NotificationTimeout as ex:
             LOG.info("Timed out in connecting %s", str(ex))
-            time.sleep(0.5)
-            return None
         except pygatt.exceptions.NotConnectedError as ex:
             LOG.info("Not connected %s", str(ex))
-            time.sleep(0.5)
-            return None
+        self.disconnect()
+        return False
 
+    def _enter_data_mode(self, timeout):
         # Enable data mode
         if not self._send_bytes(MODE_CHAR_RW, bytearray([0x01]), timeout):
             return None
-        for i in range(10):
-            self._send_bytes(RX_CHAR_WO, bytearray([0x24]), timeout)
+        self._request_packets(10, timeout)
         # Disable cell data
         return self._send_command("D!\r", timeout)
 
-    def get_battery_info(self, timeout):
+    def in_data_mode(self, timeout):
+        """in_data_mode
+        Read the mode characteristic, also serves as a link health check
+        """
+        try:
+            mode = self.device.char_read_handle(
+                self._get_handle(MODE_CHAR_RW), timeout=timeout)
+            return len(mode) > 0 and mode[0] == 0x01
+        except (pygatt.exceptions.NotificationTimeout,
+                pygatt.exceptions.NotConnectedError) as ex:
+            LOG.info("Could not read mode %s", str(ex))
+            return False
+
+    def initialize(self, timeout):
+        if not self._open(timeout):
+            time.sleep(0.5)
+            return None
+        return self._enter_data_mode(timeout)
+
+    def resume(self, timeout, attempts=0):
+        """resume
+        Reconnect after a drop. The BMS keeps data mode across
+        connections, so the mode write, buffer flushes and stop command of
+        initialize are skipped while it is still in data mode. Returns
+        True once ready to stream
+        """
+        if not self._open(timeout, attempts):
+            return False
+        if self.in_data_mode(timeout):
+            LOG.info("BMS still in data mode, resuming")
+            return True
+        return self._enter_data_mode(timeout) is not None
+
+    def _request_packets(self, count, timeout):
+        # unacknowledged flushes, the packets arrive as notifications
+        for i in range(count):
+            if not self._send_bytes(RX_CHAR_WO, FLUSH, timeout,
+                                    wait_for_response=False):
+                return False
+        return True
+
+    def get_battery_info(self, timeout, records=False, idle_timeout=None,
+                         scheduler=None):
+        # records=True yields packet records instead of dicts. The stream
+        # ends when no packet arrives for idle_timeout (default timeout)
+        # seconds or a write fails, cell data is left on in that case.
+        # A scheduler (AdaptiveScheduler) paces the requests between
+        # sweeps, packets already in flight arrive before the pause
+        failed = False
+        if idle_timeout is None:
+            idle_timeout = timeout
         try:
             # Enable cell data
             if not self._send_command("E!\r", timeout):
                 LOG.info("Could not send start data command")
+                failed = True
+                return False
+
+            pipelined = self.pipeline > 0
+            if pipelined and not self._request_packets(self.pipeline, timeout):
+                failed = True
                 return False
 
             while True:
-                LOG.info("Waiting for packet")
+                LOG.debug("Waiting for packet")
                 # get another packet
-                if not self._send_bytes(RX_CHAR_WO, bytearray([0x24]), timeout):
+                if not pipelined and \
+                        not self._send_bytes(RX_CHAR_WO, FLUSH, timeout):
+                    failed = True
+                    break
+                data = self._wait_for_data(timeout=idle_timeout)
+                if data is None:
+                    LOG.info("Timed-out waiting for packet")
+                    failed = True
+                    break
+                # keep the pipeline full
+                if pipelined and not self._request_packets(1, timeout):
+                    failed = True
+                    break
+                started = time.perf_counter_ns()
+                packet = decode_packet(data)
+                ended = time.perf_counter_ns()
+                self.parse_latency.observe((ended - started) / 1e9)
+                if TRACER.enabled:
+                    TRACER.record('bms.parse', started, ended)
+                yield packet if records else packet.to_dict()
+                if scheduler is not None:
+                    delay = scheduler.observe(packet)
+                    if delay > 0:
+                        scheduler.pause(delay)
+        finally:
+            # Stop cell data, unless the link is down
+            if not failed:
+                return self._send_command("D!\r", timeout)
+
+
+class ConnectionSupervisor(object):
+    """ConnectionSupervisor
+    Keeps a SmartBMS streaming across BLE drops. The subscription is
+    stale when no notification arrives for stale_after seconds; if the
+    link still passes a health check only the subscription is renewed,
+    otherwise the session is resumed on a new connection with jittered
+    exponential backoff between attempts. heartbeat, if given, is called
+    before each attempt so a watchdog knows the reconnect loop is alive
+    """
+    def __init__(self, bms, stale_after=5.0, backoff_min=RECONNECT_DELAY_MIN,
+                 backoff_max=RECONNECT_DELAY_MAX, heartbeat=None):
+        self.bms = bms
+        self.heartbeat = heartbeat
+        self.stale_after = stale_after
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+        self.ready = False
+        self.reconnects = 0
+        self.resubscribes = 0
+        # seconds from a drop to the next packet
+        self.reconnect_latency = Histogram()
+        self.last_downtime = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.ready = False
+        self.bms.close()
+
+    def healthy(self, timeout):
+        """healthy
+        True if the device is connected and answers a mode read
+        """
+        return self.bms.device is not None and self.bms.in_data_mode(timeout)
+
+    def _recover(self, timeout):
+        if self.ready and self.healthy(timeout):
+            LOG.info("Link up but subscription stale, resubscribing")
+            self.resubscribes += 1
+            try:
+                self.bms.device.unsubscribe(TX_CHAR_RD)
+                self.bms._subscribe()
+                return
+            except (pygatt.exceptions.NotificationTimeout,
+                    pygatt.exceptions.NotConnectedError) as ex:
+                LOG.info("Could not resubscribe %s", str(ex))
+        if self.ready:
+            self.reconnects += 1
+        self.bms.disconnect()
+        failures = 0
+        while True:
+            if self.heartbeat is not None:
+                self.heartbeat()
+            if self.bms.resume(timeout, attempts=1):
+                break
+            failures += 1
+            delay = backoff_delay(failures, self.backoff_min, self.backoff_max)
+            LOG.info("Could not resume BMS session, retrying in %.1fs", delay)
+            time.sleep(delay)
+        self.ready = True
+
+    def stream(self, timeout, records=True, scheduler=None):
+        """stream
+        Generator of packets that never ends, reconnecting as needed.
+        scheduler, if given, paces the sweeps
+        """
+        dropped = None
+        while True:
+            self._recover(timeout)
+            packets = self.bms.get_battery_info(
+                timeout, records=records, idle_timeout=self.stale_after,
+                scheduler=scheduler)
+            try:
+                for packet in packets:
+                    if dropped is not None:
+                        self.last_downtime = time.monotonic() - dropped
+                        self.reconnect_latency.observe(self.last_downtime)
+                        LOG.info("Streaming again after %.2fs",
+                                 self.last_downtime)
+                        dropped = None
+                    yield packet
+            finally:
+                # stop cell data while the connection is still open
+                packets.close()
+            if dropped is None:
+                dropped = time.monotonic()
+            LOG.info("BMS stream ended")
+
+    def stats(self):
+        return {
+            'connects': self.bms.connects,
+            'reconnects': self.reconnects,
+            'resubscribes': self.resubscribes,
+            'last_downtime': self.last_downtime,
+            'reconnect_p50': self.reconnect_latency.quantile(0.5),
+            'reconnect_p99': self.reconnect_latency.quantile(0.99)
+        }
+
+
+class AsyncSmartBMS(SmartBMS):
+    """AsyncSmartBMS
+    asyncio client sharing the protocol logic of SmartBMS. Blocking
+    adapter calls run in the loop's default executor and notifications
+    wake the reader through an asyncio.Event
+    """
+    def __init__(self, address=DEVICE_ADDR, adapter=None, pipeline=0):
+        super().__init__(address, adapter=adapter, pipeline=pipeline)
+        self.recv_buffer.listener = self._frame_ready
+        self.loop = None
+        self.frame_event = None
+
+    def __del__(self):
+        # close() is a coroutine here, the loop may already be gone
+        SmartBMS.close(self)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    def _frame_ready(self):
+        if self.loop is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.frame_event.set)
+
+    async def _call(self, func, *args, **kwargs):
+        return await self.loop.run_in_executor(
+            None, functools.partial(func, *args, **kwargs))
+
+    async def _write(self, ble_uuid, send_bytes, timeout):
+        return await self._call(self._send_bytes, ble_uuid, send_bytes, timeout)
+
+    async def _request(self, count, timeout):
+        return await self._call(self._request_packets, count, timeout)
+
+    async def _read_frame(self, timeout=0):
+        deadline = self.loop.time() + timeout if timeout > 0 else None
+        while True:
+            self.frame_event.clear()
+            frame = self.recv_buffer.get_nowait()
+            if frame is not None:
+                return frame
+            if deadline is None:
+                await self.frame_event.wait()
+                continue
+            remaining = deadline - self.loop.time()
+            if remaining <= 0:
+                return None
+            try:
+                await asyncio.wait_for(self.frame_event.wait(), remaining)
+            except asyncio.TimeoutError:
+                return None
+
+    async def connect(self, timeout, retry_delay=1.0, attempts=0):
+        """connect
+        Connect, subscribe and put the BMS in data mode with the steps of
+        SmartBMS run in the executor. Retries every retry_delay seconds,
+        forever if attempts is 0. Returns the response to the disable cell
+        data command or None on failure, disconnected
+        """
+        self.loop = asyncio.get_running_loop()
+        self.frame_event = asyncio.Event()
+        tries = 0
+        # one attempt per call, the retries wait on the loop
+        while not await self._call(self._open, timeout, attempts=1):
+            tries += 1
+            if attempts > 0 and tries >= attempts:
+                return None
+            await asyncio.sleep(retry_delay)
+        resp = await self._call(self._enter_data_mode, timeout)
+        if resp is None:
+            LOG.info("Could not enter data mode")
+            await self._call(self.disconnect)
+        return resp
+
+    async def close(self):
+        if self.loop is None:
+            SmartBMS.close(self)
+        else:
+            await self._call(SmartBMS.close, self)
+
+    async def send_command(self, cmd_str, timeout):
+        command = self._encode_command(cmd_str)
+        if not await self._write(RX_CHAR_WO, command, timeout):
+            LOG.error("Could not send command '%s'" % (cmd_str))
+            return None
+
+        recv = bytearray()
+        while not self._endswith(recv, command):
+            # flush write buffer
+            await self._write(RX_CHAR_WO, FLUSH, timeout)
+            recv = await self._read_frame(timeout=timeout)
+            if recv is None:
+                LOG.info("Timed-out waiting for response to %s", cmd_str)
+                return None
+
+        return await self._read_frame(timeout=timeout)
+
+    async def stream(self, timeout, records=False):
+        """stream
+        Async generator of parsed packets (packet records if records is
+        True), cell data is disabled again when the generator is closed
+        """
+        if not await self.send_command("E!\r", timeout):
+            LOG.info("Could not send start data command")
+            return
+        failed = False
+        try:
+            pipelined = self.pipeline > 0
+            if pipelined and not await self._request(self.pipeline, timeout):
+                failed = True
+                return
+            while True:
+                if not pipelined and \
+                        not await self._write(RX_CHAR_WO, FLUSH, timeout):
+                    failed = True
+                    break
+                data = await self._read_frame(timeout=timeout)
+                if data is None:
+                    LOG.info("Timed-out waiting for packet")
+                    failed = True
+                    break
+                if pipelined and not await self._request(1, timeout):
+                    failed = True
                     break
-                data = self._wait_for_data(timeout=timeout)
-                yield self._parse_packet(data)
+                started = time.perf_counter_ns()
+                packet = decode_packet(data)
+                ended = time.perf_counter_ns()
+                self.parse_latency.observe((ended - started) / 1e9)
+                if TRACER.enabled:
+                    TRACER.record('bms.parse', started, ended)
+                yield packet if records else packet.to_dict()
         finally:
-            # Stop cell data
-            return self._send_command("D!\r", timeout)
+            # Stop cell data, unless the link is down
+            if not failed:
+                await self.send_command("D!\r", timeout)
@@ -1,38 +1,284 @@
+import collections
+import functools
+import heapq
+import json
 import logging
+import os
 import re
-import serial
+import threading
+import time
+
+from lazy import lazy_import
+from tracing import traced
+
+# loaded on first use, they are slow to import
+asyncio = lazy_import('asyncio')
+serial = lazy_import('serial')
 
 LOG = logging.getLogger("SixFabSMS")
 LOG.setLevel(logging.INFO)
 
+CTRL_Z = chr(26)
+
+FINAL_CODES = ('OK', 'ERROR', 'NO CARRIER', 'BUSY', 'NO ANSWER')
+FINAL_PREFIXES = ('+CMS ERROR:', '+CME ERROR:')
+URC_PREFIXES = ('+CMTI:', '+CDSI:', '+CMT:', 'RING', '+CRING:', '+QIND:',
+                'RDY', '+CPIN:', '+CFUN:')
+# the line after these headers is a message body, not a result code or URC
+BODY_HEADERS = ('+CMGL:', '+CMGR:')
+
+# per-command deadlines in seconds, by command prefix
+COMMAND_TIMEOUTS = [
+    ('AT+CMGS', 5.0),
+    ('AT+CMGL', 10.0),
+    ('AT+CMGR', 5.0),
+    ('AT+CMGD', 5.0),
+    ('AT+CPMS', 5.0),
+    ('AT&F', 5.0)
+]
+DEFAULT_TIMEOUT = 2.0
+# seconds to wait for the late reply of a timed-out command
+DRAIN_TIMEOUT = 2.0
+# the network can take a long time to accept a message body
+SEND_BODY_TIMEOUT = 120.0
+# modem setup on one command line, AT&F first as it resets the others and
+# I last to check the modem answers for its identity
+INIT_COMMAND = 'AT&F;+CPMS="SM","SM","SM";+CMGF=1;I'
+
+SMS_LENGTH = 160
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+def _command_name(command):
+    # span detail, message bodies and numbers are left out
+    if command.upper().startswith('AT'):
+        return command.split('=')[0].strip()
+    return 'message body'
+
+class ATResponse(object):
+    def __init__(self, command, final, lines, elapsed):
+        self.command = command
+        self.final = final
+        self.lines = lines
+        self.elapsed = elapsed
+
+    @property
+    def ok(self):
+        return self.final == 'OK'
+
+    @property
+    def raw(self):
+        # response text after the command echo, as read from the modem
+        return ''.join(self.lines)
+
+class ATEngine(object):
+    """ATEngine
+    Sends AT commands and reads the reply incrementally until a final
+    result code (or the '>' prompt) or the command deadline. Unsolicited
+    result codes seen while reading are passed to their handlers. The
+    reply of a command that timed out is drained before the next command
+    so it is not taken as that command's
+    """
+    def __init__(self, port):
+        self.port = port
+        self.lock = threading.RLock()
+        self.buffer = bytearray()
+        # a timed-out command has not sent its final result code yet
+        self.owed = False
+        self.urc_handlers = []
+        self.commands = 0
+        self.total_latency = 0.0
+
+    def add_urc_handler(self, prefix, callback):
+        """add_urc_handler
+        Call callback(line) for unsolicited lines starting with prefix
+        """
+        self.urc_handlers.append((prefix, callback))
+
+    @staticmethod
+    def timeout_for(command):
+        for prefix, timeout in COMMAND_TIMEOUTS:
+            if command.startswith(prefix):
+                return timeout
+        return DEFAULT_TIMEOUT
+
+    @staticmethod
+    def is_final(text):
+        return text in FINAL_CODES or text.startswith(FINAL_PREFIXES)
+
+    def _dispatch_urc(self, text):
+        if not text.startswith(URC_PREFIXES):
+            return False
+        handled = False
+        for prefix, callback in self.urc_handlers:
+            if text.startswith(prefix):
+                handled = True
+                try:
+                    callback(text)
+                except Exception as ex:
+                    LOG.error("URC handler failed for %s: %s", text, ex)
+        if not handled:
+            LOG.info("Unsolicited: %s", text)
+        return True
+
+    def _read_line(self, deadline, expect_prompt=False, wake=None):
+        while True:
+            end = self.buffer.find(b'\n')
+            if end >= 0:
+                line = self.buffer[:end + 1]
+                del self.buffer[:end + 1]
+                return line.decode(errors='replace')
+            if expect_prompt and self.buffer.lstrip().startswith(b'>'):
+                line = self.buffer
+                self.buffer = bytearray()
+                return line.decode(errors='replace')
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or (wake is not None and wake.is_set()):
+                return None
+            self.port.timeout = min(remaining, 1.0)
+            data = self.port.read(max(1, self.port.in_waiting))
+            if data:
+                self.buffer += data
+
+    def _drain(self):
+        # read up to the final result code of the timed-out command, or
+        # drop whatever arrived if it does not come
+        deadline = time.monotonic() + DRAIN_TIMEOUT
+        body = False
+        while True:
+            line = self._read_line(deadline)
+            if line is None:
+                LOG.info("No reply to the timed-out command, discarding input")
+                self.port.reset_input_buffer()
+                self.buffer = bytearray()
+                break
+            text = line.strip()
+            if body:
+                body = False
+            elif text.startswith(BODY_HEADERS):
+                body = True
+            elif self._dispatch_urc(text):
+                continue
+            elif self.is_final(text):
+                LOG.info("Discarded late reply %s", text)
+                break
+        self.owed = False
+
+    @traced('sms.at', lambda self, command, *args, **kwargs:
+            _command_name(command))
+    def send(self, command, timeout=None, expect_prompt=False):
+        """send
+        Send a command and return its ATResponse. final is None if the
+        deadline passed before a final result code
+        """
+        if timeout is None:
+            timeout = self.timeout_for(command)
+        with self.lock:
+            if self.owed:
+                self._drain()
+            start = time.monotonic()
+            deadline = start + timeout
+            out = command if command.endswith(CTRL_Z) else command + "\r"
+            self.port.write(out.encode())
+            self.port.flush()
+
+            echo = command.strip('\r' + CTRL_Z)
+            lines = []
+            final = None
+            body = False
+            while final is None:
+                line = self._read_line(deadline, expect_prompt)
+                if line is None:
+                    break
+                text = line.strip()
+                if echo is not None and len(text) > 0:
+                    # disregard command echo
+                    if text.rstrip(CTRL_Z).endswith(echo):
+                        echo = None
+                        continue
+                    echo = None
+                if body:
+                    # a body of "OK" or "RING ..." is still the message
+                    body = False
+                    lines.append(line)
+                    continue
+                body = text.startswith(BODY_HEADERS)
+                if not body and self._dispatch_urc(text):
+                    continue
+                lines.append(line)
+                if expect_prompt and text.startswith('>'):
+                    final = '>'
+                elif self.is_final(text):
+                    final = text
+            elapsed = time.monotonic() - start
+            self.commands += 1
+            self.total_latency += elapsed
+            self.owed = final is None
+        if final is None:
+            LOG.error('Timed-out after %.1fs waiting for "%s"',
+                      elapsed, command.strip())
+        return ATResponse(command, final, lines, elapsed)
+
+    def poll(self, timeout, until_urc=False, wake=None):
+        """poll
+        Read for up to timeout seconds while idle, dispatching unsolicited
+        result codes. Returns the number of URCs seen, as soon as there is
+        one if until_urc is set, or early once the wake event is set
+        """
+        seen = 0
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            while True:
+                line = self._read_line(deadline, wake=wake)
+                if line is None:
+                    return seen
+                text = line.strip()
+                if len(text) > 0:
+                    if self._dispatch_urc(text):
+                        seen += 1
+                        if until_urc and len(self.buffer) == 0:
+                            return seen
+                    else:
+                        if self.owed and self.is_final(text):
+                            # the late reply of a timed-out command
+                            self.owed = False
+                        LOG.info("Ignoring stray line %s", text)
+
+    async def send_async(self, command, timeout=None, expect_prompt=False):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, functools.partial(
+            self.send, command, timeout=timeout, expect_prompt=expect_prompt))
+
 class SixFabSMS(object):
-    def __init__(self, whitelist, disable_sending=False, timeout=15):
+    def __init__(self, whitelist, disable_sending=False, timeout=15,
+                 port="/dev/ttyUSB2"):
         with open(whitelist) as myfile:
             self.whitelist = myfile.read().split('\n')
         self.whitelist = [w for w in self.whitelist if len(w) > 0]
         LOG.info("Whitelist: %s", str(self.whitelist))
-        self.sim_serial = serial.Serial(
-            "/dev/ttyUSB2", baudrate=115200, timeout=timeout)
+        self.sim_serial = serial.Serial(port, baudrate=115200, timeout=timeout)
+        self.at = ATEngine(self.sim_serial)
+        # message indices announced by +CMTI and not read yet
+        self.new_indices = collections.deque()
+        self.at.add_urc_handler('+CMTI:', self._new_message_indication)
 
     def _clear_buffer(self):
-        self.sim_serial.write((chr(26) + "\rAT\r").encode())
-        self.sim_serial.flush()
-        self.sim_serial.read(self.sim_serial.in_waiting)
-
-    def _communicate(self, input_str):
-        self.sim_serial.write((input_str + "\r").encode())
-        self.sim_serial.flush()
-        # disregard command echo
-        self.sim_serial.readline()
-        # get response as string
-        return self.sim_serial.read(self.sim_serial.in_waiting).decode()
-
-    def _check_success(self, at_cmd):
-        resp = self._communicate(at_cmd)
-        success = resp.endswith("\r\nOK\r\n") or resp == "OK\r\n"
-        if not success:
-            LOG.error('Failed command "%s" -> %s', at_cmd, str(resp.encode()))
-        return success
+        # abort any half written message and resynchronize on an OK
+        self.at.send(CTRL_Z + "\rAT")
+        self.sim_serial.reset_input_buffer()
+        self.at.buffer = bytearray()
+
+    @traced('sms.communicate')
+    def _communicate(self, input_str, timeout=None):
+        return self.at.send(input_str, timeout=timeout).raw
+
+    def _check_success(self, at_cmd, timeout=None):
+        resp = self.at.send(at_cmd, timeout=timeout)
+        if not resp.ok:
+            LOG.error('Failed command "%s" -> %s', at_cmd,
+                      str(resp.raw.encode()))
+        return resp.ok
 
     @staticmethod
     def _phone_match(phone_number, phone_list):
@@ -40,6 +286,11 @@ class SixFabSMS(object):
 
     def initialize(self):
         self._clear_buffer()
+        # one round trip, or one command at a time for modems that do not
+        # take them on one line
+        if self.at.send(INIT_COMMAND).ok:
+            return True
+        LOG.info("Initializing SMS one command at a time")
         if not self._check_success("AT&F"):
             LOG.error("Could not factory reset SMS")
             return False
@@ -123,6 +374,66 @@ class SixFabSMS(object):
             self.delete_message(msg['index'])
         return ok_list
 
+    def _new_message_indication(self, line):
+        # +CMTI: "SM",3
+        match = re.match(r'\+CMTI: "([^"]*)",(\d+)', line)
+        if not match:
+            LOG.error("Could not parse indication %s", line)
+            return
+        LOG.info("New message %s in %s", match.group(2), match.group(1))
+        if match.group(2) not in self.new_indices:
+            self.new_indices.append(match.group(2))
+
+    def enable_new_message_indications(self):
+        """enable_new_message_indications
+        Have the modem report newly stored messages with +CMTI
+        """
+        return self._check_success("AT+CNMI=2,1,0,0,0")
+
+    def read_message(self, msg_index):
+        """read_message
+        Read one stored message. Messages from non-whitelisted numbers are
+        deleted and None is returned, as it is on errors
+        """
+        resp = self._communicate('AT+CMGR=' + msg_index)
+        if not resp.endswith("\r\nOK\r\n"):
+            LOG.error("Error in reading message %s: %s", msg_index, resp)
+            return None
+        msg_regex = re.compile(
+            r'\+CMGR: "([^"]*)","([^"]*)",(?:"[^"]*")?,"([^"]*)"\r\n(.*)\r\n')
+        match = msg_regex.match(resp)
+        if not match:
+            LOG.error("Could not match message regex %s", resp)
+            return None
+        message = {
+            'index': msg_index,
+            'status': match.group(1),
+            'number': match.group(2),
+            'timestamp': match.group(3),
+            'message': match.group(4)
+        }
+        ok_list, ban_list = self.whitelist_messages([message])
+        for msg in ban_list:
+            LOG.info("Deleting message from number %s: %s",
+                     msg['number'], msg['message'])
+            self.delete_message(msg['index'])
+        return ok_list[0] if ok_list else None
+
+    def wait_for_messages(self, timeout, wake=None):
+        """wait_for_messages
+        Wait up to timeout seconds (or until wake is set) for +CMTI
+        indications and return the new whitelisted messages, read one index
+        at a time
+        """
+        if not self.new_indices:
+            self.at.poll(timeout, until_urc=True, wake=wake)
+        messages = []
+        while self.new_indices:
+            message = self.read_message(self.new_indices.popleft())
+            if message is not None:
+                messages.append(message)
+        return messages
+
     def whitelist_messages(self, all_messages):
         ok_list = []
         ban_list = []
@@ -142,5 +453,236 @@ class SixFabSMS(object):
     def send_message(self, number, message):
         LOG.info("Sending message to %s: %s", number, message)
         LOG.info("Message length %s chars", len(message))
-        resp = self._communicate('AT+CMGS="' + number + '"\r')
-        return self._check_success(message + chr(26))
+        resp = self.at.send('AT+CMGS="' + number + '"', expect_prompt=True)
+        if resp.final != '>':
+            LOG.error("No prompt to send message: %s", resp.raw)
+            # cancel the half written message
+            self.at.send(CTRL_Z)
+            return False
+        return self._check_success(message + CTRL_Z, timeout=SEND_BODY_TIMEOUT)
+
+def split_message(body, limit=SMS_LENGTH):
+    """split_message
+    Split a body longer than one SMS into parts prefixed with "(i/n) ",
+    breaking on spaces where possible
+    """
+    if len(body) <= limit:
+        return [body]
+    # room for the "(i/n) " prefix, assuming fewer than 100 parts
+    size = limit - len("(99/99) ")
+    chunks = []
+    rest = body
+    while len(rest) > size:
+        cut = rest.rfind(' ', 0, size + 1)
+        if cut <= 0:
+            cut = size
+        chunks.append(rest[:cut])
+        rest = rest[cut:].lstrip(' ')
+    if rest:
+        chunks.append(rest)
+    return ["(%d/%d) %s" % (i + 1, len(chunks), chunk)
+            for i, chunk in enumerate(chunks)]
+
+class OutboundQueue(object):
+    """OutboundQueue
+    Queue of outgoing messages sent in priority order by process().
+    Identical bodies to the same number within dedupe_window seconds are
+    dropped, each number gets at most rate_count messages per rate_period
+    seconds, and failed sends are retried with exponential backoff. The
+    queue is saved to path (if given) on every change
+    """
+    def __init__(self, sms, path=None, dedupe_window=300.0, rate_count=5,
+                 rate_period=60.0, max_attempts=5, backoff_base=5.0,
+                 backoff_max=600.0):
+        self.sms = sms
+        self.path = path
+        self.dedupe_window = dedupe_window
+        self.rate_count = rate_count
+        self.rate_period = rate_period
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.lock = threading.Lock()
+        # set when a message is queued, to wake a waiting sender
+        self.added = threading.Event()
+        self.heap = []
+        self.seq = 0
+        # (number, body) -> time it was last queued
+        self.recent = {}
+        # number -> times of the last sends
+        self.send_times = collections.defaultdict(collections.deque)
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.deduplicated = 0
+        self.last_latency = None
+        self.max_latency = 0.0
+        self.total_latency = 0.0
+        self._load()
+
+    def _load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return
+        heap = []
+        try:
+            with open(self.path) as myfile:
+                saved = json.load(myfile)
+            for msg in saved:
+                missing = [key for key in ('number', 'body', 'created',
+                                           'attempts', 'next_attempt')
+                           if key not in msg]
+                if missing:
+                    raise KeyError(', '.join(missing))
+                heap.append((int(msg['priority']), int(msg['seq']), msg))
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            # a bad outbox must not keep the modem thread from starting
+            bad_path = self.path + '.bad'
+            LOG.error("Could not load outbox %s, moved to %s: %s",
+                      self.path, bad_path, e)
+            try:
+                os.replace(self.path, bad_path)
+            except OSError as ex:
+                LOG.error("Could not move outbox %s: %s", self.path, ex)
+            return
+        for entry in heap:
+            self.seq = max(self.seq, entry[1] + 1)
+            heapq.heappush(self.heap, entry)
+        LOG.info("Loaded %d queued messages", len(self.heap))
+
+    def _save(self):
+        if self.path is None:
+            return
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as myfile:
+            json.dump([entry[2] for entry in self.heap], myfile)
+        os.replace(tmp_path, self.path)
+
+    def enqueue(self, number, body, priority=PRIORITY_NORMAL):
+        """enqueue
+        Queue a message, split into parts if needed. Returns False if it
+        was dropped as a duplicate
+        """
+        now = time.time()
+        with self.lock:
+            key = (number, body)
+            last = self.recent.get(key)
+            if last is not None and now - last < self.dedupe_window:
+                LOG.info("Dropping duplicate message to %s", number)
+                self.deduplicated += 1
+                return False
+            self.recent[key] = now
+            for part in split_message(body):
+                msg = {
+                    'seq': self.seq,
+                    'number': number,
+                    'body': part,
+                    'priority': priority,
+                    'created': now,
+                    'attempts': 0,
+                    'next_attempt': now
+                }
+                heapq.heappush(self.heap, (priority, self.seq, msg))
+                self.seq += 1
+            self._save()
+        self.added.set()
+        return True
+
+    def depth(self):
+        return len(self.heap)
+
+    def _rate_limited(self, number, now):
+        times = self.send_times[number]
+        while times and now - times[0] >= self.rate_period:
+            times.popleft()
+        return len(times) >= self.rate_count
+
+    def _next_ready(self, now):
+        # highest priority message that is due and not rate limited
+        for entry in sorted(self.heap):
+            msg = entry[2]
+            if msg['next_attempt'] <= now and \
+                    not self._rate_limited(msg['number'], now):
+                return entry
+        return None
+
+    def seconds_until_due(self):
+        """seconds_until_due
+        Seconds until process() has something to send, None when empty
+        """
+        with self.lock:
+            if not self.heap:
+                return None
+            now = time.time()
+            due = []
+            for entry in self.heap:
+                msg = entry[2]
+                times = self.send_times[msg['number']]
+                ready = msg['next_attempt']
+                if len(times) >= self.rate_count:
+                    ready = max(ready, times[0] + self.rate_period)
+                due.append(ready)
+            return max(0.0, min(due) - now)
+
+    def process(self, limit=None):
+        """process
+        Send due messages, at most limit of them. Returns the number sent
+        """
+        sent = 0
+        self.added.clear()
+        while limit is None or sent < limit:
+            with self.lock:
+                now = time.time()
+                # expire old deduplication entries
+                for key, last in list(self.recent.items()):
+                    if now - last >= self.dedupe_window:
+                        del self.recent[key]
+                entry = self._next_ready(now)
+                if entry is None:
+                    return sent
+                msg = entry[2]
+            ok = self.sms.send_message(msg['number'], msg['body'])
+            with self.lock:
+                now = time.time()
+                if ok:
+                    self.heap.remove(entry)
+                    heapq.heapify(self.heap)
+                    self.send_times[msg['number']].append(now)
+                    latency = now - msg['created']
+                    self.sent += 1
+                    self.last_latency = latency
+                    self.max_latency = max(self.max_latency, latency)
+                    self.total_latency += latency
+                    sent += 1
+                else:
+                    self.failed += 1
+                    msg['attempts'] += 1
+                    if msg['attempts'] >= self.max_attempts:
+                        LOG.error("Giving up on message to %s after %d "
+                                  "attempts", msg['number'], msg['attempts'])
+                        self.heap.remove(entry)
+                        heapq.heapify(self.heap)
+                        self.dropped += 1
+                    else:
+                        delay = min(self.backoff_max, self.backoff_base *
+                                    2 ** (msg['attempts'] - 1))
+                        msg['next_attempt'] = now + delay
+                        LOG.info("Retrying message to %s in %.0fs",
+                                 msg['number'], delay)
+                self._save()
+        return sent
+
+    def stats(self):
+        with self.lock:
+            mean_latency = None
+            if self.sent > 0:
+                mean_latency = self.total_latency / self.sent
+            return {
+                'queue_depth': len(self.heap),
+                'sent': self.sent,
+                'failed': self.failed,
+                'dropped': self.dropped,
+                'deduplicated': self.deduplicated,
+                'last_latency': self.last_latency,
+                'mean_latency': mean_latency,
+                'max_latency': self.max_latency
+            }
@@ -0,0 +1,215 @@
+import bisect
+import json
+import logging
+import time
+
+import BMS
+
+LOG = logging.getLogger("Alerts")
+LOG.setLevel(logging.INFO)
+
+RECORD_TYPES = {
+    record.type: record for record in (
+        BMS.Overview, BMS.MinMaxTemp, BMS.Energy, BMS.Power,
+        BMS.MinMaxVolts, BMS.CellInfo)
+}
+
+class Rule(object):
+    """Rule
+    Fires when packet field goes above (or below) threshold for debounce
+    consecutive packets and clears once it is back past clear. Repeat
+    notifications for the same rule (and cell) wait for cooldown seconds
+    """
+    def __init__(self, name, packet, field, above=None, below=None,
+                 clear=None, debounce=1, cooldown=3600.0, notify_clear=False):
+        if packet not in RECORD_TYPES:
+            raise ValueError("Unknown packet type %s" % packet)
+        if field not in RECORD_TYPES[packet]._fields:
+            raise ValueError("Unknown field %s for %s" % (field, packet))
+        if (above is None) == (below is None):
+            raise ValueError("Rule %s needs one of above or below" % name)
+        self.name = name
+        self.packet = packet
+        self.field = field
+        self.above = above is not None
+        self.threshold = above if self.above else below
+        self.clear = self.threshold if clear is None else clear
+        if (self.above and self.clear > self.threshold) or \
+                (not self.above and self.clear < self.threshold):
+            raise ValueError("Rule %s clears past its threshold" % name)
+        self.debounce = max(1, debounce)
+        self.cooldown = cooldown
+        self.notify_clear = notify_clear
+
+    def describe(self, value, cell):
+        where = "" if cell is None else "cell %d " % cell
+        return "%s: %s%s %.3f %s %.3f" % (
+            self.name, where, self.field, value,
+            '>' if self.above else '<', self.threshold)
+
+def load_rules(path):
+    with open(path) as myfile:
+        return [Rule(**spec) for spec in json.load(myfile)]
+
+class Alert(object):
+    def __init__(self, rule, cell, value, cleared=False):
+        self.rule = rule
+        self.cell = cell
+        self.value = value
+        self.cleared = cleared
+        self.timestamp = time.time()
+
+    def message(self):
+        if self.cleared:
+            return "CLEARED " + self.rule.describe(self.value, self.cell)
+        return "ALERT " + self.rule.describe(self.value, self.cell)
+
+class _FieldIndex(object):
+    # Rules of one direction on one packet field. Values and thresholds
+    # of 'below' rules are negated so both directions trigger on v > t.
+    # Rules are sorted by threshold and clear level, so a new value only
+    # touches the rules whose condition changed since the last value plus
+    # the rules still debouncing
+    def __init__(self, rules, sign):
+        self.sign = sign
+        self.by_threshold = sorted(rules, key=lambda r: sign * r.threshold)
+        self.thresholds = [sign * r.threshold for r in self.by_threshold]
+        self.by_clear = sorted(rules, key=lambda r: sign * r.clear)
+        self.clears = [sign * r.clear for r in self.by_clear]
+        # cell (None for pack fields) -> state
+        self.last = {}
+        self.pending = {}
+        self.active = {}
+
+    def update(self, cell, raw_value):
+        value = self.sign * raw_value
+        last = self.last.get(cell)
+        self.last[cell] = value
+        pending = self.pending.setdefault(cell, {})
+        active = self.active.setdefault(cell, set())
+        cleared = []
+
+        if last is None:
+            # first value, every rule below it is over its threshold
+            for rule in self.by_threshold[:bisect.bisect_left(
+                    self.thresholds, value)]:
+                pending[rule] = 0
+        elif value > last:
+            low = bisect.bisect_left(self.thresholds, last)
+            high = bisect.bisect_left(self.thresholds, value)
+            for rule in self.by_threshold[low:high]:
+                if rule not in active:
+                    pending[rule] = 0
+        elif value < last:
+            low = bisect.bisect_left(self.thresholds, value)
+            high = bisect.bisect_left(self.thresholds, last)
+            for rule in self.by_threshold[low:high]:
+                pending.pop(rule, None)
+            low = bisect.bisect_left(self.clears, value)
+            high = bisect.bisect_left(self.clears, last)
+            for rule in self.by_clear[low:high]:
+                if rule in active:
+                    active.discard(rule)
+                    cleared.append(rule)
+
+        fired = []
+        for rule in list(pending):
+            pending[rule] += 1
+            if pending[rule] >= rule.debounce:
+                del pending[rule]
+                active.add(rule)
+                fired.append(rule)
+        return fired, cleared
+
+    def near(self, margin):
+        # whether a rule is firing or any last value is within margin
+        # (a fraction of the threshold) of the next threshold above it
+        for cell, value in self.last.items():
+            if self.active.get(cell) or self.pending.get(cell):
+                return True
+            index = bisect.bisect_right(self.thresholds, value)
+            if index < len(self.thresholds) and \
+                    self.thresholds[index] - value <= \
+                    margin * abs(self.thresholds[index]):
+                return True
+        return False
+
+class AlertEngine(object):
+    """AlertEngine
+    Evaluates rules on each decoded packet record. Rules are indexed by
+    packet type and field so a packet only evaluates its own rules.
+    notify(alert) is called for every alert that is not in cooldown
+    """
+    def __init__(self, rules, notify):
+        self.rules = rules
+        self.notify = notify
+        self.index = {}
+        for packet, record in RECORD_TYPES.items():
+            fields = []
+            for pos, field in enumerate(record._fields):
+                for sign, above in ((1, True), (-1, False)):
+                    matching = [r for r in rules if r.packet == packet and
+                                r.field == field and r.above == above]
+                    if matching:
+                        fields.append((pos, _FieldIndex(matching, sign)))
+            if fields:
+                self.index[packet] = fields
+        self.last_notified = {}
+        self.evaluated = 0
+        self.alerts = 0
+
+    def evaluate(self, packet):
+        """evaluate
+        Evaluate the rules depending on a packet record, returns the
+        alerts that were notified
+        """
+        fields = self.index.get(packet.type)
+        if fields is None:
+            return []
+        self.evaluated += 1
+        cell = packet.cell_index if packet.type == 'cell_info' else None
+        out = []
+        for pos, field_index in fields:
+            value = packet[pos]
+            fired, cleared = field_index.update(cell, value)
+            for rule in fired:
+                out += self._notify(Alert(rule, cell, value))
+            for rule in cleared:
+                if rule.notify_clear:
+                    out += self._notify(Alert(rule, cell, value, True))
+        return out
+
+    def _notify(self, alert):
+        key = (alert.rule.name, alert.cell, alert.cleared)
+        now = time.monotonic()
+        last = self.last_notified.get(key)
+        if last is not None and now - last < alert.rule.cooldown:
+            LOG.info("Suppressed %s", alert.message())
+            return []
+        self.last_notified[key] = now
+        self.alerts += 1
+        LOG.info(alert.message())
+        self.notify(alert)
+        return [alert]
+
+    def near(self, margin=0.05):
+        """near
+        True if a rule is firing, debouncing or within margin (a fraction
+        of its threshold) of firing
+        """
+        for fields in self.index.values():
+            for pos, field_index in fields:
+                if field_index.near(margin):
+                    return True
+        return False
+
+    def active(self):
+        """active
+        Return [(rule, cell)] of the rules currently firing
+        """
+        out = []
+        for fields in self.index.values():
+            for pos, field_index in fields:
+                for cell, rules in field_index.active.items():
+                    out += [(rule, cell) for rule in rules]
+        return sorted(out, key=lambda a: (a[0].name, a[1] or 0))
@@ -0,0 +1,135 @@
+import logging
+import time
+
+import numpy as np
+
+LOG = logging.getLogger("PackAnalytics")
+LOG.setLevel(logging.INFO)
+
+class CellHistory(object):
+    """CellHistory
+    Ring buffers of cell volts and temperatures (cells x samples) plus
+    pack amps, one sample per complete cell sweep. All statistics are
+    computed over the last `window` samples with NumPy
+    """
+    def __init__(self, max_cells=256, samples=720):
+        self.max_cells = max_cells
+        self.samples = samples
+        self.volts = np.full((max_cells, samples), np.nan)
+        self.temps = np.full((max_cells, samples), np.nan)
+        self.amps = np.full(samples, np.nan)
+        self.timestamps = np.full(samples, np.nan)
+        self.total_cells = 0
+        self.count = 0
+        self.head = 0
+
+    def add_sample(self, info, timestamp=None):
+        """add_sample
+        Add one column from a battery_info dict
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        cells = info['cells']
+        indices = np.fromiter((int(i) - 1 for i in cells), dtype=np.intp,
+                              count=len(cells))
+        keep = (indices >= 0) & (indices < self.max_cells)
+        col = self.head
+        self.volts[:, col] = np.nan
+        self.temps[:, col] = np.nan
+        self.volts[indices[keep], col] = np.fromiter(
+            (c['volts'] for c in cells.values()), dtype=float,
+            count=len(cells))[keep]
+        self.temps[indices[keep], col] = np.fromiter(
+            (c['temp'] for c in cells.values()), dtype=float,
+            count=len(cells))[keep]
+        self.amps[col] = info.get('pack_amps', np.nan)
+        self.timestamps[col] = timestamp
+        self.total_cells = min(self.max_cells,
+                               max(self.total_cells,
+                                   info.get('total_cells', len(cells))))
+        self.head = (self.head + 1) % self.samples
+        self.count = min(self.count + 1, self.samples)
+
+    def _window(self, window):
+        # column indices of the last `window` samples, oldest first
+        window = min(window or self.count, self.count)
+        return (self.head - window + np.arange(window)) % self.samples
+
+    def _cells(self, array, window):
+        return array[:self.total_cells][:, self._window(window)]
+
+    def cell_stats(self, window=None):
+        """cell_stats
+        Rolling per-cell (mean volts, stddev volts, mean temp)
+        """
+        volts = self._cells(self.volts, window)
+        temps = self._cells(self.temps, window)
+        with np.errstate(invalid='ignore'):
+            return (np.nanmean(volts, axis=1), np.nanstd(volts, axis=1),
+                    np.nanmean(temps, axis=1))
+
+    def imbalance(self, window=None):
+        """imbalance
+        Max - min cell volts per sample, oldest first
+        """
+        volts = self._cells(self.volts, window)
+        with np.errstate(invalid='ignore'):
+            return np.nanmax(volts, axis=0) - np.nanmin(volts, axis=0)
+
+    def drifting_cells(self, window=None, threshold=0.02, persistence=0.8):
+        """drifting_cells
+        Cells (1 based) that sit more than threshold volts away from the
+        pack median, on the same side, in at least `persistence` of the
+        samples. Returns {cell: mean deviation}
+        """
+        volts = self._cells(self.volts, window)
+        if volts.shape[1] == 0:
+            return {}
+        with np.errstate(invalid='ignore'):
+            deviation = volts - np.nanmedian(volts, axis=0)
+            high = np.mean(deviation > threshold, axis=1)
+            low = np.mean(deviation < -threshold, axis=1)
+            mean_dev = np.nanmean(deviation, axis=1)
+        drifting = np.nonzero(np.maximum(high, low) >= persistence)[0]
+        return {int(i) + 1: float(mean_dev[i]) for i in drifting}
+
+    def internal_resistance(self, window=None, min_amps_range=2.0):
+        """internal_resistance
+        Per-cell resistance estimate in ohms from the least squares slope
+        of cell volts against pack amps. NaN while the current has not
+        varied by at least min_amps_range amps
+        """
+        cols = self._window(window)
+        amps = self.amps[cols]
+        volts = self.volts[:self.total_cells][:, cols]
+        valid = ~np.isnan(amps)
+        result = np.full(self.total_cells, np.nan)
+        if valid.sum() < 2 or np.ptp(amps[valid]) < min_amps_range:
+            return result
+        amps = amps[valid] - amps[valid].mean()
+        volts = volts[:, valid]
+        with np.errstate(invalid='ignore'):
+            volts = volts - np.nanmean(volts, axis=1, keepdims=True)
+            return np.abs(np.nansum(volts * amps, axis=1) /
+                          np.sum(amps * amps))
+
+    def summary(self, window=None):
+        """summary
+        Plain dict of the analytics for SMS replies and exporters
+        """
+        if self.count == 0:
+            return None
+        mean, std, temp = self.cell_stats(window)
+        spread = self.imbalance(window)
+        resistance = self.internal_resistance(window)
+        with np.errstate(invalid='ignore'):
+            return {
+                'samples': int(min(window or self.count, self.count)),
+                'spread_volts': float(spread[-1]),
+                'max_spread_volts': float(np.nanmax(spread)),
+                'mean_volts': mean.tolist(),
+                'std_volts': std.tolist(),
+                'mean_temp': temp.tolist(),
+                'drifting_cells': self.drifting_cells(window),
+                'resistance_ohms': resistance.tolist()
+            }
@@ -0,0 +1,808 @@
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+import tracemalloc
+
+import BMS
+from transport import (FakeAdapter, RecordingAdapter, ReplayAdapter,
+                       load_capture, sample_frames)
+
+class LegacyParser(object):
+    # string based parser SmartBMS used before the table driven decoder
+    @staticmethod
+    def _parse_int(input_bytes):
+        if isinstance(input_bytes, bytearray):
+            input_bytes = input_bytes.decode()
+        if input_bytes[0] == 'X':
+            return 0
+        return int(input_bytes, 16)
+
+    @staticmethod
+    def _parse_tmp(input_bytes):
+        return LegacyParser._parse_int(input_bytes) * 0.857 - 232.1
+
+    @staticmethod
+    def _parse_packet(input_bytes):
+        data_arr = input_bytes.split("_".encode())
+        pkt_type = data_arr[0].decode()
+        pkt_len = len(data_arr)
+
+        if pkt_type == 'U' and pkt_len == 5:
+            # Overview
+            return {
+                'type': 'overview',
+                'contents': {
+                    "pack_voltage": LegacyParser._parse_int(data_arr[1]) * 0.005,
+                    "input_amps": LegacyParser._parse_int(data_arr[2]) * 0.05,
+                    "pack_amps": LegacyParser._parse_int(data_arr[3]) * 0.05,
+                    "output_amps": LegacyParser._parse_int(data_arr[4]) * 0.05
+                }
+            }
+        elif pkt_type == 'T' and pkt_len == 5:
+            # Min / max temperatures
+            return {
+                'type': 'min_max_temp',
+                'contents': {
+                    'min_temp_cell': {
+                        'index': LegacyParser._parse_int(data_arr[2]),
+                        'temp': LegacyParser._parse_tmp(data_arr[1])
+                    },
+                    'max_temp_cell': {
+                        'index': LegacyParser._parse_int(data_arr[4]),
+                        'temp': LegacyParser._parse_tmp(data_arr[3])
+                    }
+                }
+            }
+        elif pkt_type == 'E' and pkt_len == 5:
+            # Energy counters / battery SOC
+            return {
+                'type': 'energy',
+                'contents': {
+                    'input_kwh': LegacyParser._parse_int(data_arr[1]) / 1000,
+                    'pack_kwh': LegacyParser._parse_int(data_arr[2]) / 1000,
+                    'output_kwh': LegacyParser._parse_int(data_arr[3]) / 1000,
+                    'pack_soc': LegacyParser._parse_int(data_arr[4])
+                }
+            }
+        elif pkt_type == 'M' and pkt_len == 4:
+            time_str = data_arr[3].decode().split(":")
+            return {
+                'type': 'power',
+                'contents': {
+                    'input_watts': LegacyParser._parse_int(data_arr[1]),
+                    'output_watts': LegacyParser._parse_int(data_arr[2]),
+                    'time_hours': LegacyParser._parse_int(time_str[0]),
+                    'time_minutes': LegacyParser._parse_int(time_str[1])
+                }
+            }
+        elif pkt_type == 'V' and pkt_len == 6:
+            # Min / max cell voltages
+            return {
+                'type': 'min_max_volts',
+                'contents': {
+                    'min_volt_cell': {
+                        'index': LegacyParser._parse_int(data_arr[2]),
+                        'volts': LegacyParser._parse_int(data_arr[1]) * 0.005
+                    },
+                    'max_volt_cell': {
+                        'index': LegacyParser._parse_int(data_arr[4]),
+                        'volts': LegacyParser._parse_int(data_arr[3]) * 0.005
+                    },
+                    'balance_volts': LegacyParser._parse_int(data_arr[5]) * 0.005
+                }
+            }
+        elif pkt_type == 'C' and pkt_len == 6:
+            # Cell voltages
+            cell_indx = LegacyParser._parse_int(data_arr[1])
+            cells_len = LegacyParser._parse_int(data_arr[2])
+            if cell_indx <= cells_len:
+                cell_volts = LegacyParser._parse_int(data_arr[3]) * 0.005
+                cell_temp = LegacyParser._parse_tmp(data_arr[4])
+                return {
+                    'type': 'cell_info',
+                    'contents': {
+                        'cell_index': cell_indx,
+                        'total_cells': cells_len,
+                        'cell_volts': cell_volts,
+                        'cell_temp': cell_temp
+                    }
+                }
+            return {
+                'type': 'invalid',
+                'contents': {
+                    'message': "Cell %i out of bounds" % (cell_indx)
+                }
+            }
+        else:
+            return {
+                'type': 'invalid',
+                'contents': {
+                    'message': "Unknown packet " + str(data_arr)
+                }
+            }
+
+def bench_decode(cells, repeat):
+    """bench_decode
+    Packets/sec of the legacy parser against the table driven decoder,
+    with and without the dict adapter
+    """
+    frames = [bytearray(f) for f in sample_frames(cells)] * repeat
+    for frame in frames[:len(frames) // repeat]:
+        assert LegacyParser._parse_packet(frame) == \
+            BMS.decode_packet(frame).to_dict()
+
+    parsers = [
+        ("legacy dicts", LegacyParser._parse_packet),
+        ("decoder records", BMS.decode_packet),
+        ("decoder + to_dict", lambda f: BMS.decode_packet(f).to_dict())
+    ]
+    print("parser              packets/s   us/packet")
+    for name, parse in parsers:
+        start = time.perf_counter()
+        for frame in frames:
+            parse(frame)
+        elapsed = time.perf_counter() - start
+        print("%-18s %10.0f  %10.2f" % (
+            name, len(frames) / elapsed, elapsed * 1e6 / len(frames)))
+
+def bench_flush(cells, sweeps, latency, pipelines):
+    """bench_flush
+    BLE round-trips and handle lookups per full cell sweep, and sweep
+    time, with acknowledged '$' flushes against pipelined ones
+    """
+    from BMS import SmartBMS
+
+    frames = sample_frames(cells)
+    print("pipeline  round-trips/sweep  writes/sweep  lookups  ms/sweep")
+    for pipeline in pipelines:
+        adapter = FakeAdapter(frames=frames, latency=latency)
+        bms = SmartBMS(adapter=adapter, pipeline=pipeline)
+        bms.initialize(timeout=5)
+        device = adapter.devices[bms.address]
+        packets = len(frames) * sweeps
+
+        round_trips = device.round_trips
+        writes = device.writes
+        lookups = device.handle_lookups
+        start = time.perf_counter()
+        stream = bms.get_battery_info(timeout=5, records=True)
+        for i, packet in zip(range(packets), stream):
+            pass
+        elapsed = time.perf_counter() - start
+        # exclude the stop command
+        round_trips = device.round_trips - round_trips
+        writes = device.writes - writes
+        lookups = device.handle_lookups - lookups
+        stream.close()
+        bms.close()
+        print("%8d  %17.1f  %12.1f  %7d  %8.1f" % (
+            pipeline, round_trips / sweeps, writes / sweeps, lookups,
+            elapsed * 1000 / sweeps))
+
+def capture_fake_session(capture_path, cells, sweeps):
+    """capture_fake_session
+    Record a session against the fake BMS, used when no capture of a
+    real pack is given
+    """
+    frames = sample_frames(cells)
+    adapter = RecordingAdapter(FakeAdapter(frames=frames), capture_path)
+    bms = BMS.SmartBMS(adapter=adapter)
+    bms.initialize(timeout=5)
+    stream = bms.get_battery_info(timeout=5, records=True)
+    for i, packet in zip(range(len(frames) * sweeps), stream):
+        pass
+    stream.close()
+    bms.close()
+    adapter.stop()
+
+def bench_suite(capture_path, cells, sweeps, realtime):
+    """bench_suite
+    Hot path benchmarks on a replayed capture: frame assembly, packet
+    decoding, end-to-end sweep latency through SmartBMS and peak memory
+    """
+    tmp_dir = None
+    if capture_path is None:
+        tmp_dir = tempfile.TemporaryDirectory()
+        capture_path = os.path.join(tmp_dir.name, 'capture.jsonl')
+        capture_fake_session(capture_path, cells, sweeps + 1)
+    events = load_capture(capture_path)
+    chunks = [e['value'] for e in events if e['event'] == 'notify']
+
+    # frame assembly
+    buf = BMS.FrameBuffer()
+    frames = []
+    start = time.perf_counter()
+    for chunk in chunks:
+        if buf.append(chunk):
+            frame = buf.get_nowait()
+            while frame is not None:
+                frames.append(frame)
+                frame = buf.get_nowait()
+    elapsed = time.perf_counter() - start
+    print("frame assembly  %10.0f frames/s" % (len(frames) / elapsed))
+
+    # decoding
+    start = time.perf_counter()
+    for frame in frames:
+        BMS.decode_packet(frame)
+    elapsed = time.perf_counter() - start
+    print("decode          %10.2f us/frame" % (elapsed * 1e6 / len(frames)))
+
+    # end-to-end sweeps through SmartBMS, replaying the capture
+    tracemalloc.start()
+    bms = BMS.SmartBMS(adapter=ReplayAdapter(
+        events=events, realtime=realtime, repeat=True))
+    bms.initialize(timeout=5)
+    sweep_times = []
+    start = time.perf_counter()
+    for packet in bms.get_battery_info(timeout=5, records=True):
+        if packet.type == 'cell_info' and \
+                packet.cell_index == packet.total_cells:
+            now = time.perf_counter()
+            sweep_times.append(now - start)
+            start = now
+            if len(sweep_times) >= sweeps:
+                break
+    bms.close()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    if sweep_times:
+        # the first sweep starts mid pack
+        sweep_times = sweep_times[1:] or sweep_times
+        print("sweep latency   %10.2f ms mean, %.2f ms max" % (
+            sum(sweep_times) * 1000 / len(sweep_times),
+            max(sweep_times) * 1000))
+    else:
+        print("sweep latency   no complete sweep in capture")
+    print("peak memory     %10.1f KiB" % (peak / 1024))
+    if tmp_dir is not None:
+        tmp_dir.cleanup()
+
+def bench_alerts(rule_counts, sweeps):
+    """bench_alerts
+    Per-packet rule evaluation cost as the number of rules grows
+    """
+    import random
+    from alerts import AlertEngine, Rule
+
+    fields = [('cell_info', 'cell_volts', 2.5, 3.7),
+              ('cell_info', 'cell_temp', -10, 60),
+              ('overview', 'pack_voltage', 40, 58),
+              ('energy', 'pack_soc', 0, 100),
+              ('min_max_volts', 'max_volts', 2.5, 3.7)]
+    packets = [BMS.decode_packet(f) for f in sample_frames(16)] * sweeps
+    rnd = random.Random(1)
+    print("rules  us/packet  alerts")
+    for count in rule_counts:
+        rules = []
+        for i in range(count):
+            packet, field, low, high = fields[i % len(fields)]
+            threshold = rnd.uniform(low, high)
+            if i % 2:
+                rules.append(Rule("r%d" % i, packet, field, above=threshold))
+            else:
+                rules.append(Rule("r%d" % i, packet, field, below=threshold))
+        engine = AlertEngine(rules, lambda alert: None)
+        # the first packets set every rule's initial state
+        for packet in packets[:len(packets) // sweeps]:
+            engine.evaluate(packet)
+        start = time.perf_counter()
+        for packet in packets:
+            engine.evaluate(packet)
+        elapsed = time.perf_counter() - start
+        print("%5d  %9.2f  %6d" % (count, elapsed * 1e6 / len(packets),
+                                   engine.alerts))
+
+def bench_packs(pack_counts, rounds, latency):
+    """bench_packs
+    Aggregate packets/sec while polling a growing number of simulated
+    packs concurrently from one event loop
+    """
+    from packs import PackMonitor
+
+    print("packs  sweeps  packets   seconds  packets/s")
+    for count in pack_counts:
+        adapter = FakeAdapter(frames=sample_frames(16), latency=latency)
+        packs = [("pack%d" % i, "00:00:00:00:00:%02X" % i)
+                 for i in range(count)]
+        monitor = PackMonitor(packs, adapter, concurrency=count, timeout=5)
+
+        async def run():
+            # first round connects, only time the steady state
+            await monitor.poll_once()
+            start = time.perf_counter()
+            sweeps = 0
+            for i in range(rounds):
+                sweeps += await monitor.poll_once()
+            elapsed = time.perf_counter() - start
+            await monitor.close()
+            return sweeps, elapsed
+
+        packets_before = sum(s.packets for s in monitor.states)
+        sweeps, elapsed = asyncio.run(run())
+        packets = sum(s.packets for s in monitor.states) - packets_before
+        print("%5d  %6d  %7d  %8.3f  %9.0f" % (
+            count, sweeps, packets, elapsed, packets / elapsed))
+
+def legacy_has_all_battery_info(battery_info):
+    # the per-packet rescan used before SnapshotAssembler
+    for req in BMS.REQUIRED_KEYS:
+        if req not in battery_info:
+            return False
+    for ind in range(1, battery_info['total_cells']):
+        if ind not in battery_info['cells']:
+            BMS.LOG.info("Missing cell %i", ind)
+            return False
+    return True
+
+def bench_completeness(cell_counts, sweeps):
+    """bench_completeness
+    Per-packet cost of merging and checking completeness, rescanning
+    battery_info against the SnapshotAssembler bitmaps
+    """
+    print("cells  rescan us/packet  assembler us/packet")
+    for cells in cell_counts:
+        packets = [BMS.decode_packet(f).to_dict() for f in sample_frames(cells)]
+        packets = packets * sweeps
+        info = {'cells': {}}
+        start = time.perf_counter()
+        for packet in packets:
+            BMS.merge_packet(info, packet)
+            legacy_has_all_battery_info(info)
+        rescan = time.perf_counter() - start
+
+        assembler = BMS.SnapshotAssembler()
+        start = time.perf_counter()
+        for packet in packets:
+            assembler.add(packet)
+        bitmap = time.perf_counter() - start
+        print("%5d  %16.2f  %19.2f" % (cells, rescan * 1e6 / len(packets),
+                                       bitmap * 1e6 / len(packets)))
+
+def bench_history(cells, days, interval):
+    """bench_history
+    Rows read and query time of the 'history' reply from raw records and
+    from rollups, for a recording of `days` days with one sweep every
+    `interval` seconds
+    """
+    from commands import format_history
+    from recorder import Recorder, Rollups
+
+    sweep = [BMS.decode_packet(f) for f in sample_frames(cells)]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        recorder = Recorder(os.path.join(tmp_dir, 'raw'))
+        rollups = Rollups(os.path.join(tmp_dir, 'rollups'))
+        now = time.time()
+        t = now - days * 86400
+        start = time.perf_counter()
+        while t < now:
+            for packet in sweep:
+                recorder.record(packet, t)
+                rollups.add(packet, t)
+            t += interval
+        print("recorded %d packets in %.1fs" % (
+            recorder.records, time.perf_counter() - start))
+        print("window  raw rows  raw ms  rollup rows  rollup ms")
+        for label, seconds in (('1h', 3600), ('1d', 86400),
+                               ('%dd' % days, days * 86400)):
+            raw = len(recorder.query('overview', now - seconds, now))
+            rollup = len(rollups.query('overview', now - seconds, now,
+                                       seconds / 48)[1])
+            start = time.perf_counter()
+            format_history(recorder, seconds, label)
+            raw_time = time.perf_counter() - start
+            start = time.perf_counter()
+            format_history(recorder, seconds, label, rollups)
+            rollup_time = time.perf_counter() - start
+            print("%6s  %8d  %6.1f  %11d  %9.1f" % (
+                label, raw, raw_time * 1000, rollup, rollup_time * 1000))
+        recorder.close()
+        rollups.close()
+
+def bench_ring(cell_counts, repeat):
+    """bench_ring
+    Cost of handing a snapshot to another process through the shared
+    memory ring against pickling it, as a multiprocessing queue would
+    """
+    import pickle
+    from state import LiveState
+    from workers import SnapshotRing
+
+    print("cells  ring write us  ring read us  pickle+unpickle us")
+    for cells in cell_counts:
+        state = LiveState()
+        for frame in sample_frames(cells):
+            state.update(BMS.decode_packet(frame))
+        snapshot = state.snapshot()
+        ring = SnapshotRing.create(max_cells=cells)
+        start = time.perf_counter()
+        for i in range(repeat):
+            ring.write(snapshot)
+        write = time.perf_counter() - start
+        start = time.perf_counter()
+        for i in range(repeat):
+            ring.read()
+        read = time.perf_counter() - start
+        ring.close()
+        start = time.perf_counter()
+        for i in range(repeat):
+            pickle.loads(pickle.dumps((snapshot.info,
+                                       snapshot.field_versions)))
+        pickled = time.perf_counter() - start
+        print("%5d  %13.1f  %12.1f  %18.1f" % (
+            cells, write * 1e6 / repeat, read * 1e6 / repeat,
+            pickled * 1e6 / repeat))
+
+def bench_mqtt(cells, hours, sweep_seconds, interval):
+    """bench_mqtt
+    Bytes and messages per hour sent to the broker for a noisy pack, one
+    message per packet field on its own topic against the batched
+    deadband deltas of MqttPublisher
+    """
+    import json
+    import random
+    from publisher import DeltaEncoder, _encode
+    from state import LiveState
+
+    # fixed header, topic length and packet id of a QoS 1 publish
+    overhead = 6
+    rng = random.Random(0)
+    state = LiveState()
+    encoder = DeltaEncoder()
+    naive = [0, 0]
+    batched = [0, 0]
+    sweeps = int(hours * 3600 / sweep_seconds)
+    per_interval = max(1, int(interval / sweep_seconds))
+    for sweep in range(sweeps):
+        for frame in sample_frames(cells):
+            packet = BMS.decode_packet(frame)
+            if packet.type == 'cell_info':
+                packet = packet._replace(
+                    cell_volts=round(packet.cell_volts +
+                                     rng.choice((-0.001, 0, 0.001)), 3))
+            elif packet.type == 'overview':
+                packet = packet._replace(
+                    pack_amps=round(packet.pack_amps +
+                                    rng.uniform(-0.1, 0.1), 2))
+            state.update(packet)
+            contents = packet.to_dict()['contents']
+            if packet.type == 'cell_info':
+                contents = {'cell/%d' % packet.cell_index:
+                            [packet.cell_volts, packet.cell_temp]}
+            for field, value in contents.items():
+                naive[0] += 1
+                naive[1] += overhead + len('bms/pack/' + field) + \
+                    len(json.dumps(value))
+        if (sweep + 1) % per_interval == 0:
+            info = encoder.delta(state.snapshot())
+            if info:
+                batched[0] += 1
+                batched[1] += overhead + len('bms/pack/delta') + len(
+                    _encode({'ts': round(time.time(), 1), 'info': info}))
+    print("%d cells, a sweep every %.0fs, deltas every %.0fs" % (
+        cells, sweep_seconds, interval))
+    print("                 messages/h    bytes/h")
+    for name, (messages, size) in (('per packet', naive),
+                                   ('batched delta', batched)):
+        print("%-15s  %10d  %9d" % (name, messages / hours, size / hours))
+
+def bench_sweeps(cells, sweep_seconds, min_interval, max_interval):
+    """bench_sweeps
+    Cell sweeps (BLE requests and recorded packets) over a simulated day
+    of idle nights, a charge and load events, back to back against paced
+    by AdaptiveScheduler. Runs on a virtual clock
+    """
+    from scheduler import AdaptiveScheduler
+
+    # (hours, pack amps, cell volts drift per hour)
+    day = [('night', 8, 0.3, 0.0), ('morning load', 1, 15.0, -0.02),
+           ('idle', 2, 0.3, 0.0), ('charge', 5, -25.0, 0.03),
+           ('evening load', 3, 12.0, -0.02), ('night', 5, 0.3, 0.0)]
+    sweep = [BMS.decode_packet(f) for f in sample_frames(cells)]
+    scheduler = AdaptiveScheduler(min_interval, max_interval)
+    print("%d cells, %.1fs per sweep, paced %.0f-%.0fs" % (
+        cells, sweep_seconds, min_interval, max_interval))
+    print("period          hours  back to back  paced  ratio")
+    now = 0.0
+    volts = 3.3
+    totals = [0, 0]
+    for name, hours, amps, drift in day:
+        end = now + hours * 3600
+        fixed = int(hours * 3600 / sweep_seconds)
+        paced = 0
+        while now < end:
+            delay = 0.0
+            volts += drift * sweep_seconds / 3600
+            for packet in sweep:
+                if packet.type == 'overview':
+                    packet = packet._replace(pack_amps=amps)
+                elif packet.type == 'cell_info':
+                    packet = packet._replace(cell_volts=round(volts, 3))
+                now += sweep_seconds / len(sweep)
+                delay = scheduler.observe(packet, now)
+            now += delay
+            paced += 1
+        totals[0] += fixed
+        totals[1] += paced
+        print("%-14s  %5d  %12d  %5d  %5.1f" % (name, hours, fixed, paced,
+                                                fixed / paced))
+    print("%-14s  %5d  %12d  %5d  %5.1f" % ('day', 24, totals[0], totals[1],
+                                            totals[0] / totals[1]))
+
+def bench_startup(cells, latency, connect_latency, repeat):
+    """bench_startup
+    Time to import main with the BLE and serial modules loaded on first
+    use against loaded up front, and time from start to the first reply
+    waiting for a BMS sweep against restoring a checkpoint
+    """
+    import statistics
+    import subprocess
+    import sys
+    from commands import default_registry
+    from state import Checkpoint, LiveState
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    code = ("import time; start = time.perf_counter(); {}; "
+            "print(time.perf_counter() - start)")
+    print("import                          median ms")
+    for name, statement in (
+            ('main, lazy', 'import main'),
+            ('main, eager', 'import main, pygatt, serial, asyncio; '
+                            'pygatt.exceptions, serial.Serial, asyncio.Event')):
+        times = [float(subprocess.check_output(
+            [sys.executable, '-c', code.format(statement)], cwd=here))
+            for i in range(repeat)]
+        print("%-30s  %9.1f" % (name, 1e3 * statistics.median(times)))
+
+    frames = sample_frames(cells)
+    registry = default_registry()
+    with tempfile.TemporaryDirectory() as tmp:
+        checkpoint = Checkpoint(os.path.join(tmp, 'checkpoint.json'))
+        print("first reply                     ms")
+        start = time.perf_counter()
+        state = LiveState()
+        adapter = FakeAdapter(frames=frames, latency=latency,
+                              connect_latency=connect_latency)
+        with BMS.ConnectionSupervisor(BMS.SmartBMS(adapter=adapter)) as sup:
+            for packet in sup.stream(timeout=5):
+                state.update(packet)
+                if state.snapshot().complete:
+                    break
+        registry.reply("overview", state.snapshot())
+        print("%-30s  %9.1f" % ('waiting for the BMS',
+                                1e3 * (time.perf_counter() - start)))
+        checkpoint.save(state.snapshot())
+
+        start = time.perf_counter()
+        state = LiveState()
+        state.restore(Checkpoint(checkpoint.path).load())
+        default_registry().reply("overview", state.wait_ready())
+        print("%-30s  %9.1f" % ('from the checkpoint',
+                                1e3 * (time.perf_counter() - start)))
+
+def bench_trace(cells, sweeps, repeat):
+    """bench_trace
+    Cost of the tracing layer: a bare function call against a traced one
+    with tracing off and on, and the per-packet cost of streaming from a
+    zero latency fake BMS with the spans removed, off and on
+    """
+    from tracing import TRACER, traced
+
+    def bare(value):
+        return value
+
+    wrapped = traced('bench.call')(bare)
+    print("                  bare ns  off ns   on ns")
+    results = []
+    TRACER.enable(False)
+    for func, enabled in ((bare, False), (wrapped, False), (wrapped, True)):
+        TRACER.enabled = enabled
+        start = time.perf_counter()
+        for i in range(repeat):
+            func(i)
+        results.append((time.perf_counter() - start) * 1e9 / repeat)
+    print("call             %8.0f %7.0f %7.0f" % tuple(results))
+
+    frames = sample_frames(cells)
+    methods = ('_connect', '_send_command', '_wait_for_data')
+    traced_methods = {name: getattr(BMS.SmartBMS, name) for name in methods}
+
+    def stream_packets():
+        adapter = FakeAdapter(frames=frames, latency=0)
+        with BMS.SmartBMS(adapter=adapter) as bms:
+            bms.initialize(timeout=1)
+            count = len(frames) * sweeps
+            stream = bms.get_battery_info(timeout=1, records=True)
+            start = time.perf_counter()
+            for i, packet in zip(range(count), stream):
+                pass
+            elapsed = time.perf_counter() - start
+            stream.close()
+        return elapsed * 1e9 / count
+
+    results = []
+    try:
+        for name in methods:
+            setattr(BMS.SmartBMS, name, traced_methods[name].__wrapped__)
+        TRACER.enabled = False
+        results.append(stream_packets())
+    finally:
+        for name in methods:
+            setattr(BMS.SmartBMS, name, traced_methods[name])
+    for enabled in (False, True):
+        TRACER.enabled = enabled
+        results.append(stream_packets())
+    TRACER.enabled = False
+    print("packet (%3d cells) %6.0f %7.0f %7.0f" % ((cells,) + tuple(results)))
+
+def legacy_stream(bms, timeout):
+    # the recovery loop main.py used before ConnectionSupervisor: stop
+    # cell data, reconnect and fully initialize after every drop
+    while True:
+        bms.disconnect()
+        bms.handles = {}
+        if bms.initialize(timeout) is None:
+            continue
+        for packet in bms.get_battery_info(timeout, records=True):
+            yield packet
+        bms._send_command("D!\r", timeout)
+
+def bench_reconnect(cells, drops, latency, connect_latency, timeout,
+                    stale_after):
+    """bench_reconnect
+    Time from a dropped link (or a subscription that stopped delivering)
+    to the next packet, with the legacy recovery loop and with
+    ConnectionSupervisor
+    """
+    frames = sample_frames(cells)
+    print("scenario  client      mean s  max s  connects  round-trips")
+    for scenario in ('drop', 'stale'):
+        for client in ('legacy', 'supervisor'):
+            adapter = FakeAdapter(frames=frames, latency=latency,
+                                  connect_latency=connect_latency)
+            bms = BMS.SmartBMS(adapter=adapter)
+            if client == 'legacy':
+                stream = legacy_stream(bms, timeout)
+            else:
+                stream = BMS.ConnectionSupervisor(
+                    bms, stale_after=stale_after).stream(timeout)
+            downtimes = []
+            round_trips = 0
+            for i in range(drops):
+                for j, packet in zip(range(len(frames)), stream):
+                    pass
+                device = adapter.devices[bms.address]
+                before = device.round_trips
+                if scenario == 'drop':
+                    device.disconnect()
+                else:
+                    device.callbacks.clear()
+                start = time.perf_counter()
+                next(stream)
+                downtimes.append(time.perf_counter() - start)
+                after = adapter.devices[bms.address]
+                round_trips += after.round_trips
+                if after is device:
+                    round_trips -= before
+            stream.close()
+            bms.close()
+            print("%-8s  %-10s  %6.2f  %5.2f  %8d  %11.1f" % (
+                scenario, client, sum(downtimes) / drops, max(downtimes),
+                bms.connects, round_trips / drops))
+
+def main():
+    parser = argparse.ArgumentParser(description='SmartBMS benchmarks')
+    sub = parser.add_subparsers(dest='bench', required=True)
+    packs = sub.add_parser('packs', help="Multi-pack polling throughput")
+    packs.add_argument('--counts', default="1,2,4,8,16,32",
+                       help="Comma separated pack counts")
+    packs.add_argument('--rounds', type=int, default=3)
+    packs.add_argument('--latency', type=float, default=0.002,
+                       help="Simulated radio latency per flush in seconds")
+    decode = sub.add_parser('decode', help="Packet decoder throughput")
+    decode.add_argument('--cells', type=int, default=16)
+    decode.add_argument('--repeat', type=int, default=5000)
+    flush = sub.add_parser('flush', help="Round-trips per cell sweep")
+    flush.add_argument('--cells', type=int, default=16)
+    flush.add_argument('--sweeps', type=int, default=5)
+    flush.add_argument('--latency', type=float, default=0.005,
+                       help="Simulated radio latency per flush in seconds")
+    flush.add_argument('--pipelines', default="0,1,4,8",
+                       help="Comma separated packets in flight, 0 for "
+                            "acknowledged flushes")
+    suite = sub.add_parser('suite', help="Hot path benchmarks on a capture")
+    suite.add_argument('--capture',
+                       help="Capture from RecordingAdapter, a fake session "
+                            "is recorded if not given")
+    suite.add_argument('--cells', type=int, default=16)
+    suite.add_argument('--sweeps', type=int, default=20)
+    suite.add_argument('--realtime', action='store_true', default=False,
+                       help="Replay with the recorded timing")
+    alerts = sub.add_parser('alerts', help="Alert rule evaluation cost")
+    alerts.add_argument('--rules', default="10,100,500,1000",
+                        help="Comma separated rule counts")
+    alerts.add_argument('--sweeps', type=int, default=200)
+    sweeps = sub.add_parser('sweeps', help="Sweeps per day when paced")
+    sweeps.add_argument('--cells', type=int, default=16)
+    sweeps.add_argument('--sweep-seconds', type=float, default=2.0,
+                        help="Time one cell sweep takes")
+    sweeps.add_argument('--min-interval', type=float, default=1.0)
+    sweeps.add_argument('--max-interval', type=float, default=60.0)
+    startup = sub.add_parser('startup', help="Import and first reply time")
+    startup.add_argument('--cells', type=int, default=16)
+    startup.add_argument('--latency', type=float, default=0.03,
+                         help="Simulated radio latency per round-trip")
+    startup.add_argument('--connect-latency', type=float, default=1.0,
+                         help="Simulated connection setup time")
+    startup.add_argument('--repeat', type=int, default=10)
+    trace = sub.add_parser('trace', help="Tracing overhead")
+    trace.add_argument('--cells', type=int, default=16)
+    trace.add_argument('--sweeps', type=int, default=200)
+    trace.add_argument('--repeat', type=int, default=1000000)
+    mqtt = sub.add_parser('mqtt', help="MQTT bandwidth per hour")
+    mqtt.add_argument('--cells', type=int, default=16)
+    mqtt.add_argument('--hours', type=float, default=1)
+    mqtt.add_argument('--sweep-seconds', type=float, default=2)
+    mqtt.add_argument('--interval', type=float, default=10,
+                      help="Seconds between batched publishes")
+    ring = sub.add_parser('ring', help="Shared memory snapshot hand-off")
+    ring.add_argument('--cells', default="4,16,64,256",
+                      help="Comma separated cell counts")
+    ring.add_argument('--repeat', type=int, default=2000)
+    history = sub.add_parser('history', help="History query cost")
+    history.add_argument('--cells', type=int, default=16)
+    history.add_argument('--days', type=int, default=7)
+    history.add_argument('--interval', type=float, default=30,
+                         help="Seconds between recorded sweeps")
+    complete = sub.add_parser('complete', help="Completeness check cost")
+    complete.add_argument('--cells', default="4,16,64,256",
+                          help="Comma separated cell counts")
+    complete.add_argument('--sweeps', type=int, default=50)
+    reconnect = sub.add_parser('reconnect', help="Downtime after BLE drops")
+    reconnect.add_argument('--cells', type=int, default=16)
+    reconnect.add_argument('--drops', type=int, default=3)
+    reconnect.add_argument('--latency', type=float, default=0.03,
+                           help="Simulated radio latency per round-trip")
+    reconnect.add_argument('--connect-latency', type=float, default=0.3,
+                           help="Simulated connection setup time")
+    reconnect.add_argument('--timeout', type=float, default=5)
+    reconnect.add_argument('--stale-after', type=float, default=1.0)
+    args = parser.parse_args()
+
+    if args.bench == 'startup':
+        bench_startup(args.cells, args.latency, args.connect_latency,
+                      args.repeat)
+    elif args.bench == 'sweeps':
+        bench_sweeps(args.cells, args.sweep_seconds, args.min_interval,
+                     args.max_interval)
+    elif args.bench == 'trace':
+        bench_trace(args.cells, args.sweeps, args.repeat)
+    elif args.bench == 'mqtt':
+        bench_mqtt(args.cells, args.hours, args.sweep_seconds, args.interval)
+    elif args.bench == 'ring':
+        bench_ring([int(c) for c in args.cells.split(',')], args.repeat)
+    elif args.bench == 'history':
+        bench_history(args.cells, args.days, args.interval)
+    elif args.bench == 'complete':
+        bench_completeness([int(c) for c in args.cells.split(',')],
+                           args.sweeps)
+    elif args.bench == 'reconnect':
+        bench_reconnect(args.cells, args.drops, args.latency,
+                        args.connect_latency, args.timeout, args.stale_after)
+    elif args.bench == 'alerts':
+        bench_alerts([int(c) for c in args.rules.split(',')], args.sweeps)
+    elif args.bench == 'suite':
+        bench_suite(args.capture, args.cells, args.sweeps, args.realtime)
+    elif args.bench == 'flush':
+        bench_flush(args.cells, args.sweeps, args.latency,
+                    [int(p) for p in args.pipelines.split(',')])
+    elif args.bench == 'decode':
+        bench_decode(args.cells, args.repeat)
+    elif args.bench == 'packs':
+        bench_packs([int(c) for c in args.counts.split(',')],
+                    args.rounds, args.latency)
+
+if __name__ == "__main__":
+    main()
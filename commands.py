@@ -0,0 +1,234 @@
+import logging
+import re
+import time
+
+from compact import plan_report
+
+LOG = logging.getLogger("Commands")
+LOG.setLevel(logging.INFO)
+
+OVERVIEW_FIELDS = ('pack_voltage', 'input_amps', 'input_watts',
+                   'output_amps', 'output_watts', 'pack_soc')
+CELLS_FIELDS = ('min_volt_cell', 'max_volt_cell', 'cells')
+TEMPERATURE_FIELDS = ('min_temp_cell', 'max_temp_cell', 'cells')
+
+HISTORY_UNITS = {'m': 60, 'h': 3600, 'd': 86400}
+# history replies read rollups at the coarsest tier giving this many rows
+HISTORY_ROWS = 48
+# (unit, seconds) for ages, largest first
+AGE_UNITS = (('d', 86400), ('h', 3600), ('m', 60), ('s', 1))
+
+def format_overview(info):
+    f_str = "{:.1f}V, Input: {:.1f}A/{:d}W, Output: {:.1f}A/{:d}W ({:d}%)"
+    return f_str.format(info['pack_voltage'],
+                        info['input_amps'], info['input_watts'],
+                        info['output_amps'], info['output_watts'],
+                        info['pack_soc'])
+
+def format_cells(info):
+    cells = info['cells']
+    head = "Cell Volts: ({:.3f}V - {:.3f}V)".format(
+        info['min_volt_cell']['volts'], info['max_volt_cell']['volts'])
+    return " ".join([head] + ["{:.3f}".format(cells[ind]['volts'])
+                              for ind in sorted(cells)])
+
+def format_temperature(info):
+    cells = info['cells']
+    head = "Temp. Celcius: ({:.1f}C - {:.1f}C)".format(
+        info['min_temp_cell']['temp'], info['max_temp_cell']['temp'])
+    return " ".join([head] + ["{:.1f}".format(cells[ind]['temp'])
+                              for ind in sorted(cells)])
+
+def format_cell(info, index):
+    cell = info['cells'].get(index)
+    if cell is None:
+        cell = info['cells'].get(str(index))
+    if cell is None:
+        return "No cell {:d}, pack has {:d} cells".format(
+            index, info.get('total_cells', len(info['cells'])))
+    return "Cell {:d}: {:.3f}V {:.1f}C".format(index, cell['volts'],
+                                              cell['temp'])
+
+def format_balance(summary):
+    if summary is None:
+        return "No cell history yet"
+    out = "Balance ({:d} sweeps): spread {:.3f}V, max {:.3f}V".format(
+        summary['samples'], summary['spread_volts'],
+        summary['max_spread_volts'])
+    if summary['drifting_cells']:
+        out += ", drifting:"
+        for cell, deviation in sorted(summary['drifting_cells'].items()):
+            out += " {:d} ({:+.3f}V)".format(cell, deviation)
+    resistance = [(r, i + 1) for i, r in
+                  enumerate(summary['resistance_ohms']) if r == r]
+    if resistance:
+        out += ", max IR {:.1f}mOhm (cell {:d})".format(
+            max(resistance)[0] * 1000, max(resistance)[1])
+    return out
+
+def format_alerts(active):
+    if not active:
+        return "No active alerts"
+    names = []
+    for rule, cell in active:
+        names.append(rule.name if cell is None else
+                     "{} (cell {:d})".format(rule.name, cell))
+    return "Alerts: " + ", ".join(names)
+
+def format_rollup_history(rollups, seconds, label):
+    end = time.time()
+    resolution = seconds / HISTORY_ROWS
+    overview = rollups.query('overview', end - seconds, end, resolution)
+    if overview is None:
+        return None
+    rows = overview[1]
+    if not rows:
+        return "No history for the last " + label
+    out = "History {}: {:.1f}-{:.1f}V, {:.1f}-{:.1f}A".format(
+        label, min(r.pack_voltage_min for t, r in rows),
+        max(r.pack_voltage_max for t, r in rows),
+        min(r.pack_amps_min for t, r in rows),
+        max(r.pack_amps_max for t, r in rows))
+    energy = rollups.query('energy', end - seconds, end, resolution)[1]
+    if energy:
+        out += ", SOC {:d}-{:d}%".format(
+            int(min(r.pack_soc_min for t, r in energy)),
+            int(max(r.pack_soc_max for t, r in energy)))
+    return out + " ({:d} samples)".format(sum(r.count for t, r in rows))
+
+def format_history(recorder, seconds, label, rollups=None):
+    if rollups is not None:
+        reply = format_rollup_history(rollups, seconds, label)
+        # windows too short for the finest tier read raw records
+        if reply is not None:
+            return reply
+    end = time.time()
+    rows = recorder.query('overview', end - seconds, end)
+    if not rows:
+        return "No history for the last " + label
+    volts = [r.pack_voltage for t, r in rows]
+    amps = [r.pack_amps for t, r in rows]
+    out = "History {}: {:.1f}-{:.1f}V, {:.1f}-{:.1f}A".format(
+        label, min(volts), max(volts), min(amps), max(amps))
+    socs = [r.pack_soc for t, r in
+            recorder.query('energy', end - seconds, end)]
+    if socs:
+        out += ", SOC {:d}-{:d}%".format(min(socs), max(socs))
+    return out + " ({:d} samples)".format(len(rows))
+
+def format_age(seconds):
+    # the largest whole unit, e.g. 95 -> '1m'
+    for unit, size in AGE_UNITS:
+        if seconds >= size or unit == 's':
+            return "{:d}{}".format(int(max(seconds, 0) // size), unit)
+
+class Command(object):
+    """Command
+    An SMS command. render(info, *args) builds the reply from the regex
+    groups of pattern. fields lists the battery_info keys the reply
+    depends on; replies are cached until one of them changes. Commands
+    with fields None depend on other state and are never cached
+    """
+    def __init__(self, name, render, fields=None, pattern=None,
+                 convert=None):
+        self.name = name
+        self.render = render
+        self.fields = fields
+        self.pattern = re.compile(pattern or '^' + re.escape(name) + '$')
+        self.convert = convert
+
+class CommandRegistry(object):
+    def __init__(self, default=None):
+        self.commands = []
+        self.default = default
+        # (command name, args) -> (fields version, reply)
+        self.cache = {}
+        self.hits = 0
+        self.misses = 0
+
+    def register(self, command):
+        self.commands.append(command)
+        return command
+
+    def names(self):
+        return [c.name for c in self.commands]
+
+    def match(self, text):
+        text = text.strip().lower()
+        for command in self.commands:
+            match = command.pattern.match(text)
+            if match:
+                args = match.groups()
+                if command.convert is not None:
+                    args = command.convert(*args)
+                return command, tuple(args)
+        return None, ()
+
+    def render(self, command, args, snapshot):
+        if command.fields is None:
+            return command.render(snapshot.info, *args)
+        version = snapshot.version_of(command.fields)
+        key = (command.name, args)
+        cached = self.cache.get(key)
+        if cached is not None and cached[0] == version:
+            self.hits += 1
+            reply = cached[1]
+        else:
+            self.misses += 1
+            reply = command.render(snapshot.info, *args)
+            self.cache[key] = (version, reply)
+        if snapshot.restored:
+            # values from a checkpoint, not yet confirmed by the BMS
+            reply += " (saved {} ago)".format(format_age(snapshot.age()))
+        return reply
+
+    def reply(self, text, snapshot):
+        """reply
+        Render the reply to a message, unknown messages get the default
+        command with the list of commands appended
+        """
+        command, args = self.match(text)
+        if command is not None:
+            return self.render(command, args, snapshot)
+        LOG.info('Got message "%s", replying with %s', text, self.default)
+        command, args = self.match(self.default)
+        return self.render(command, args, snapshot) + \
+            ". Commands: " + ", ".join(self.names())
+
+def fit_report(render, kind, max_segments):
+    """fit_report
+    Wrap a cells or temperature formatter to fall back to a compact or
+    summary report when its reply would take more than max_segments SMS
+    """
+    def fitted(info):
+        return plan_report(render(info), info, kind, max_segments)
+    return fitted
+
+def default_registry(analytics=None, alerts=None, recorder=None,
+                     rollups=None, max_segments=None):
+    registry = CommandRegistry(default="overview")
+    cells, temperature = format_cells, format_temperature
+    if max_segments:
+        cells = fit_report(format_cells, 'volts', max_segments)
+        temperature = fit_report(format_temperature, 'temp', max_segments)
+    registry.register(Command("overview", format_overview, OVERVIEW_FIELDS))
+    registry.register(Command("cells", cells, CELLS_FIELDS))
+    registry.register(Command("temperature", temperature,
+                              TEMPERATURE_FIELDS))
+    registry.register(Command(
+        "cell N", format_cell, ('cells', 'total_cells'),
+        pattern=r'^cell (\d+)$', convert=lambda index: (int(index),)))
+    if analytics is not None:
+        registry.register(Command(
+            "balance", lambda info: format_balance(analytics.summary())))
+    if alerts is not None:
+        registry.register(Command(
+            "alerts", lambda info: format_alerts(alerts.active())))
+    if recorder is not None:
+        registry.register(Command(
+            "history 1h", lambda info, seconds, label:
+                format_history(recorder, seconds, label, rollups),
+            pattern=r'^history (\d+)([mhd])$',
+            convert=lambda count, unit: (
+                int(count) * HISTORY_UNITS[unit], count + unit)))
+    return registry
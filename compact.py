@@ -0,0 +1,186 @@
+import collections
+import re
+import string
+
+from SMS import SMS_LENGTH, split_message
+
+# every character is in the GSM 7-bit default alphabet, so each costs one
+# of the 160 characters in a segment
+ALPHABET = string.digits + string.ascii_uppercase + string.ascii_lowercase + \
+    '#%'
+DIGITS = {char: value for value, char in enumerate(ALPHABET)}
+# a delta too large for one character is '.' and two characters
+ESCAPE = '.'
+# a value followed by '*' and a count repeats that many more times
+REPEAT = '*'
+MAX_DELTA = len(ALPHABET) ** 2 - 1
+
+# kind -> (cell key, header letter, units per step, decimals, reply head,
+#          unit suffix, summary outlier threshold)
+KINDS = {
+    'volts': ('volts', 'V', 1000, 3, "Cell Volts", "V", 0.010),
+    'temp': ('temp', 'T', 10, 1, "Temp. Celcius", "C", 2.0),
+}
+LETTERS = {kind[1]: name for name, kind in KINDS.items()}
+
+CellReport = collections.namedtuple('CellReport', 'kind format cells complete')
+
+PART_PREFIX = re.compile(r'^\(\d+/\d+\) ')
+COMPACT = re.compile(r'^([VT])(-?\d+(?:\.\d+)?):(.*)$')
+PLAIN = re.compile(r'^(Cell Volts|Temp\. Celcius): \(.*?\)((?: -?\d+\.\d+)*)$')
+SUMMARY = re.compile(r'^(Cell Volts|Temp\. Celcius) (\d+): .*?, out((?: '
+                     r'\d+:-?\d+\.\d+)*)')
+# added to replies made from a checkpoint, see CommandRegistry.render
+AGE_SUFFIX = re.compile(r'\s*\(saved \d+[dhms] ago\)$')
+
+def _values(info, kind):
+    key = KINDS[kind][0]
+    cells = info['cells']
+    return [cells[index][key] for index in sorted(cells, key=int)]
+
+def _symbol(delta):
+    if delta < len(ALPHABET):
+        return ALPHABET[delta]
+    delta = min(delta, MAX_DELTA)
+    return ESCAPE + ALPHABET[delta // len(ALPHABET)] + \
+        ALPHABET[delta % len(ALPHABET)]
+
+def encode_cells(info, kind='volts'):
+    """encode_cells
+    Compact report of every cell: the lowest value, then each cell as its
+    difference from it in steps (1mV or 0.1C) written in ALPHABET, with
+    runs of equal cells collapsed
+    """
+    letter, scale, decimals = KINDS[kind][1:4]
+    steps = [int(round(value * scale)) for value in _values(info, kind)]
+    if not steps:
+        return letter + "0:"
+    base = min(steps)
+    out = [letter, "{:.{}f}".format(base / scale, decimals), ':']
+    index = 0
+    while index < len(steps):
+        run = 1
+        while index + run < len(steps) and steps[index + run] == steps[index]:
+            run += 1
+        symbol = _symbol(steps[index] - base)
+        out.append(symbol)
+        repeats = run - 1
+        # a repeat marker costs two characters
+        while repeats * len(symbol) > 2:
+            count = min(repeats, len(ALPHABET) - 1)
+            out.append(REPEAT + ALPHABET[count])
+            repeats -= count
+        out.append(symbol * repeats)
+        index += run
+    return ''.join(out)
+
+def summarize_cells(info, kind='volts', limit=SMS_LENGTH):
+    """summarize_cells
+    Range and median of the pack and only the cells furthest from the
+    median, as many as fit in limit characters
+    """
+    decimals, head, unit, threshold = KINDS[kind][3:]
+    values = _values(info, kind)
+    if not values:
+        return "{} 0: no cells".format(head)
+    ordered = sorted(values)
+    median = ordered[len(ordered) // 2]
+    out = "{} {:d}: {:.{d}f}-{:.{d}f}{u} med {:.{d}f}{u}, out".format(
+        head, len(values), ordered[0], ordered[-1], median,
+        d=decimals, u=unit)
+    outliers = sorted(((abs(value - median), index + 1, value)
+                       for index, value in enumerate(values)
+                       if abs(value - median) >= threshold), reverse=True)
+    for shown, (deviation, index, value) in enumerate(outliers):
+        part = " {:d}:{:.{}f}".format(index, value, decimals)
+        more = len(outliers) - shown - 1
+        # keep room to say how many were left out
+        tail = " (+{:d})".format(more) if more else ""
+        if len(out) + len(part) + len(tail) > limit:
+            return out + " (+{:d})".format(more + 1)
+        out += part
+    return out if outliers else out + " none"
+
+def segments(body, limit=SMS_LENGTH):
+    return len(split_message(body, limit))
+
+def plan_report(plain, info, kind='volts', max_segments=1, limit=SMS_LENGTH):
+    """plan_report
+    The most detailed of the plain text reply, a compact report and a
+    summary that still fits in max_segments SMS. The summary drops
+    outliers to fit
+    """
+    if segments(plain, limit) <= max_segments:
+        return plain
+    compact = encode_cells(info, kind)
+    if segments(compact, limit) <= max_segments:
+        return compact
+    budget = limit if max_segments == 1 else \
+        max_segments * (limit - len("(99/99) "))
+    summary = summarize_cells(info, kind, budget)
+    # split_message breaks on spaces, so the parts hold less than the
+    # budget. Drop outliers until it fits
+    while segments(summary, limit) > max_segments and budget > limit:
+        budget = max(limit, budget - len(" 000:0.000"))
+        summary = summarize_cells(info, kind, budget)
+    return summary
+
+def _number(text):
+    value = 0
+    for char in text:
+        value = value * len(ALPHABET) + DIGITS[char]
+    return value
+
+def decode_compact(payload):
+    """decode_compact
+    Steps above the base for each cell of an encode_cells payload
+    """
+    steps = []
+    index = 0
+    while index < len(payload):
+        char = payload[index]
+        if char == ESCAPE:
+            steps.append(_number(payload[index + 1:index + 3]))
+            index += 3
+        elif char == REPEAT:
+            steps.extend([steps[-1]] * DIGITS[payload[index + 1]])
+            index += 2
+        else:
+            steps.append(DIGITS[char])
+            index += 1
+    return steps
+
+def decode_report(text):
+    """decode_report
+    Parse a cells or temperature reply, in any of the report formats and
+    either whole or as the list of its "(i/n) " parts, into a CellReport.
+    Summaries only carry their outliers, so they are not complete
+    """
+    if not isinstance(text, str):
+        text = " ".join(PART_PREFIX.sub('', part) for part in text)
+    text = AGE_SUFFIX.sub('', text.strip())
+    match = COMPACT.match(text)
+    if match:
+        kind = LETTERS[match.group(1)]
+        scale, decimals = KINDS[kind][2:4]
+        base = int(round(float(match.group(2)) * scale))
+        # split_message may have broken the payload anywhere
+        steps = decode_compact(re.sub(r'\s', '', match.group(3)))
+        cells = {index + 1: round((base + step) / scale, decimals)
+                 for index, step in enumerate(steps)}
+        return CellReport(kind, 'compact', cells, True)
+    kinds = {KINDS[name][4]: name for name in KINDS}
+    match = PLAIN.match(text)
+    if match:
+        cells = {index + 1: float(value)
+                 for index, value in enumerate(match.group(2).split())}
+        return CellReport(kinds[match.group(1)], 'plain', cells, True)
+    match = SUMMARY.match(text)
+    if match:
+        cells = {}
+        for item in match.group(3).split():
+            index, value = item.split(':')
+            cells[int(index)] = float(value)
+        return CellReport(kinds[match.group(1)], 'summary', cells,
+                          len(cells) == int(match.group(2)))
+    raise ValueError("Not a cell report: " + text[:40])
@@ -0,0 +1,15 @@
+import pytest
+
+import BMS
+from state import LiveState
+from transport import sample_frames
+
+@pytest.fixture
+def live_state():
+    # LiveStates fed one full sweep of a pack of `cells` cells
+    def make(cells=4):
+        state = LiveState()
+        for frame in sample_frames(cells):
+            state.update(BMS.decode_packet(frame))
+        return state
+    return make
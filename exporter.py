@@ -0,0 +1,363 @@
+import json
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from tracing import TRACER
+
+LOG = logging.getLogger("Exporter")
+LOG.setLevel(logging.INFO)
+
+# battery_info field -> (metric name, help)
+PACK_METRICS = [
+    ('pack_voltage', 'bms_pack_voltage_volts', "Pack voltage"),
+    ('pack_amps', 'bms_pack_amps', "Pack current"),
+    ('input_amps', 'bms_input_amps', "Charge current"),
+    ('output_amps', 'bms_output_amps', "Load current"),
+    ('input_watts', 'bms_input_watts', "Charge power"),
+    ('output_watts', 'bms_output_watts', "Load power"),
+    ('input_kwh', 'bms_input_kwh', "Charged energy counter"),
+    ('pack_kwh', 'bms_pack_kwh', "Pack energy counter"),
+    ('output_kwh', 'bms_output_kwh', "Load energy counter"),
+    ('pack_soc', 'bms_pack_soc_percent', "State of charge"),
+    ('balance_volts', 'bms_balance_volts', "Balancing voltage"),
+    ('total_cells', 'bms_cells', "Number of cells"),
+]
+# battery_info field -> (metric name, help, value key)
+MIN_MAX_METRICS = [
+    ('min_volt_cell', 'bms_min_cell_volts', "Lowest cell voltage", 'volts'),
+    ('max_volt_cell', 'bms_max_cell_volts', "Highest cell voltage", 'volts'),
+    ('min_temp_cell', 'bms_min_cell_temp_celsius', "Lowest cell temperature",
+     'temp'),
+    ('max_temp_cell', 'bms_max_cell_temp_celsius',
+     "Highest cell temperature", 'temp'),
+]
+# cell key -> (metric name, help)
+CELL_METRICS = [
+    ('volts', 'bms_cell_volts', "Cell voltage"),
+    ('temp', 'bms_cell_temp_celsius', "Cell temperature"),
+]
+
+def _family(name, help_text, metric_type='gauge'):
+    return "# HELP {0} {1}\n# TYPE {0} {2}\n".format(name, help_text,
+                                                     metric_type)
+
+def _cell_key(index):
+    # cells loaded from JSON have string keys
+    return int(index)
+
+class SnapshotRenderer(object):
+    """SnapshotRenderer
+    Renders snapshots as Prometheus text and JSON. Every field (and every
+    cell) is serialized once per version it changed at, so a scrape only
+    formats what changed since the last one
+    """
+    def __init__(self):
+        # (format, field) -> (field version, text)
+        self.cache = {}
+
+    def _cached(self, key, version, build):
+        cached = self.cache.get(key)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        text = build()
+        self.cache[key] = (version, text)
+        return text
+
+    def metrics(self, snapshot):
+        info = snapshot.info
+        versions = snapshot.field_versions
+        parts = []
+        for field, name, help_text in PACK_METRICS:
+            if field in info:
+                parts.append(self._cached(
+                    ('prom', field), versions.get(field, 0),
+                    lambda: _family(name, help_text) +
+                    "{} {}\n".format(name, info[field])))
+        for field, name, help_text, key in MIN_MAX_METRICS:
+            if field in info:
+                parts.append(self._cached(
+                    ('prom', field), versions.get(field, 0),
+                    lambda: _family(name, help_text) +
+                    '{}{{cell="{}"}} {}\n'.format(
+                        name, info[field]['index'], info[field][key])))
+        cells = sorted(info['cells'], key=_cell_key)
+        for key, name, help_text in CELL_METRICS:
+            parts.append(_family(name, help_text))
+            for index in cells:
+                parts.append(self._cached(
+                    ('prom', key, index), versions.get(('cells', index), 0),
+                    lambda: '{}{{cell="{}"}} {}\n'.format(
+                        name, index, info['cells'][index][key])))
+        parts.append(_family('bms_snapshot_version', "Live state version",
+                             'counter'))
+        parts.append("bms_snapshot_version {}\n".format(snapshot.version))
+        parts.append(_family('bms_snapshot_age_seconds',
+                             "Age of the live state"))
+        parts.append("bms_snapshot_age_seconds {:.3f}\n".format(
+            snapshot.age()))
+        return ''.join(parts)
+
+    def json(self, snapshot):
+        info = snapshot.info
+        versions = snapshot.field_versions
+        fields = []
+        for field in sorted(info):
+            if field == 'cells':
+                continue
+            fields.append(self._cached(
+                ('json', field), versions.get(field, 0),
+                lambda: json.dumps(field) + ": " + json.dumps(info[field])))
+        cells = []
+        for index in sorted(info['cells'], key=_cell_key):
+            cells.append(self._cached(
+                ('json', 'cells', index), versions.get(('cells', index), 0),
+                lambda: '"{}": {}'.format(index,
+                                          json.dumps(info['cells'][index]))))
+        fields.append('"cells": {' + ', '.join(cells) + '}')
+        return '{"version": %d, "age": %.3f, "complete": %s, "restored": %s, ' \
+            '"info": {%s}}' % (
+                snapshot.version, snapshot.age(),
+                'true' if snapshot.complete else 'false',
+                'true' if snapshot.restored else 'false', ', '.join(fields))
+
+def internal_metrics(bms=None, outbox=None, supervisor=None, workers=None,
+                     publisher=None, scheduler=None, startup=None):
+    """internal_metrics
+    Prometheus text for the BLE link, SMS queue and MQTT counters, and
+    the startup times
+    """
+    parts = []
+    if bms is not None:
+        stats = bms.recv_buffer.stats()
+        parts.append(_family('bms_frames_total', "BLE frames received",
+                             'counter'))
+        parts.append("bms_frames_total {}\n".format(stats['frames_received']))
+        parts.append(_family('bms_frame_queue_depth',
+                             "Frames waiting to be read"))
+        parts.append("bms_frame_queue_depth {}\n".format(stats['queue_depth']))
+        parts.append(_family('bms_connects_total', "BMS connections made",
+                             'counter'))
+        parts.append("bms_connects_total {}\n".format(bms.connects))
+        parts.append(_family('bms_parse_seconds', "Packet decode time",
+                             'histogram'))
+        parts.append(histogram_lines('bms_parse_seconds', bms.parse_latency))
+    if supervisor is not None:
+        parts.append(_family('bms_reconnects_total',
+                             "Reconnects after a dropped link", 'counter'))
+        parts.append("bms_reconnects_total {}\n".format(supervisor.reconnects))
+        parts.append(_family('bms_resubscribes_total',
+                             "Stale subscriptions renewed", 'counter'))
+        parts.append("bms_resubscribes_total {}\n".format(
+            supervisor.resubscribes))
+        parts.append(_family('bms_reconnect_seconds',
+                             "Time from a dropped stream to the next packet",
+                             'histogram'))
+        parts.append(histogram_lines('bms_reconnect_seconds',
+                                     supervisor.reconnect_latency))
+    if workers is not None:
+        stats = workers()
+        families = [
+            ('bms_worker_up', "Worker process alive", 'gauge',
+             lambda w: int(w['alive'])),
+            ('bms_worker_restarts_total', "Worker restarts", 'counter',
+             lambda w: w['restarts']),
+            ('bms_worker_heartbeat_age_seconds',
+             "Time since the worker last made progress", 'gauge',
+             lambda w: round(w['heartbeat_age'], 3)),
+            ('bms_worker_items_total', "Work items done by the worker",
+             'counter', lambda w: w['items']),
+            ('bms_worker_ipc_latency_seconds',
+             "Mean time from send to receipt of worker messages", 'gauge',
+             lambda w: w['mean_latency']),
+            ('bms_worker_ipc_latency_max_seconds',
+             "Max time from send to receipt of worker messages", 'gauge',
+             lambda w: w['max_latency']),
+        ]
+        for name, help_text, metric_type, value in families:
+            parts.append(_family(name, help_text, metric_type))
+            for worker in stats:
+                if value(worker) is not None:
+                    parts.append('{}{{worker="{}"}} {}\n'.format(
+                        name, worker['name'], value(worker)))
+    if outbox is not None:
+        stats = outbox.stats()
+        parts.append(_family('sms_outbox_depth', "Queued outgoing SMS"))
+        parts.append("sms_outbox_depth {}\n".format(stats['queue_depth']))
+        for key in ('sent', 'failed', 'dropped', 'deduplicated'):
+            name = 'sms_{}_total'.format(key)
+            parts.append(_family(name, "Outgoing SMS " + key, 'counter'))
+            parts.append("{} {}\n".format(name, stats[key]))
+        if stats['mean_latency'] is not None:
+            parts.append(_family('sms_send_latency_seconds',
+                                 "Mean time from queueing to sent"))
+            parts.append("sms_send_latency_seconds {:.3f}\n".format(
+                stats['mean_latency']))
+    if scheduler is not None:
+        stats = scheduler.stats()
+        parts.append(_family('bms_sweep_interval_seconds',
+                             "Time between cell sweep starts"))
+        parts.append("bms_sweep_interval_seconds {:.3f}\n".format(
+            stats['interval']))
+        parts.append(_family('bms_sweep_rate_hz', "Cell sweeps per second"))
+        parts.append("bms_sweep_rate_hz {:.4f}\n".format(scheduler.rate()))
+        parts.append(_family('bms_sweep_pause_seconds_total',
+                             "Time spent waiting between sweeps", 'counter'))
+        parts.append("bms_sweep_pause_seconds_total {:.3f}\n".format(
+            stats['paused']))
+    if publisher is not None:
+        stats = publisher.stats()
+        for key, name, help_text, metric_type in (
+                ('connected', 'mqtt_connected', "Connected to the broker",
+                 'gauge'),
+                ('messages', 'mqtt_messages_total', "MQTT messages published",
+                 'counter'),
+                ('bytes', 'mqtt_bytes_total',
+                 "Topic and payload bytes published", 'counter'),
+                ('buffered', 'mqtt_buffered_messages',
+                 "Messages buffered while offline", 'gauge'),
+                ('dropped', 'mqtt_dropped_total',
+                 "Messages dropped while offline", 'counter')):
+            parts.append(_family(name, help_text, metric_type))
+            parts.append("{} {}\n".format(name, int(stats[key])))
+    if startup is not None:
+        parts.append(_family('bms_startup_seconds',
+                             "Time from start to the checkpoint restored, the "
+                             "first snapshot and the first reply"))
+        for stage, seconds in sorted(startup.items()):
+            if seconds is not None:
+                parts.append('bms_startup_seconds{{stage="{}"}} {:.3f}\n'
+                             .format(stage, seconds))
+    return ''.join(parts)
+
+def histogram_lines(name, histogram, labels=''):
+    # labels, if any, as 'key="value"'
+    counts, count, total = histogram.snapshot()
+    prefix = labels + ',' if labels else ''
+    suffix = '{' + labels + '}' if labels else ''
+    lines = []
+    cumulative = 0
+    for bound, bucket_count in zip(histogram.buckets, counts):
+        cumulative += bucket_count
+        lines.append('{}_bucket{{{}le="{}"}} {}\n'.format(name, prefix, bound,
+                                                          cumulative))
+    lines.append('{}_bucket{{{}le="+Inf"}} {}\n'.format(name, prefix, count))
+    lines.append('{}_sum{} {}\n'.format(name, suffix, total))
+    lines.append('{}_count{} {}\n'.format(name, suffix, count))
+    return ''.join(lines)
+
+def trace_metrics(tracer):
+    """trace_metrics
+    Span latency histograms per operation, while tracing has recorded any
+    """
+    histograms = sorted(tracer.histograms.items())
+    if not histograms:
+        return ''
+    parts = [_family('bms_span_seconds', "Traced call latency", 'histogram')]
+    for operation, histogram in histograms:
+        parts.append(histogram_lines('bms_span_seconds', histogram,
+                                     'op="{}"'.format(operation)))
+    return ''.join(parts)
+
+def history_json(rollups, packet_type='overview', seconds=86400, rows=48):
+    """history_json
+    Rollup rows of the last `seconds` from the coarsest tier that still
+    gives about `rows` rows
+    """
+    end = time.time()
+    result = rollups.query(packet_type, end - seconds, end, seconds / rows)
+    if result is None:
+        result = rollups.query(packet_type, end - seconds, end,
+                               rollups.tiers[0][1])
+    return json.dumps({
+        'resolution': result[0],
+        'rows': [dict(row._asdict(), time=timestamp)
+                 for timestamp, row in result[1]]
+    })
+
+class MetricsServer(object):
+    """MetricsServer
+    Serves /metrics and /snapshot.json from a BatteryMonitor's live state
+    on a background thread, and /history.json?type=&seconds=&rows= from
+    its rollups
+    """
+    def __init__(self, monitor, port=9100, host=''):
+        self.monitor = monitor
+        self.renderer = SnapshotRenderer()
+        self.lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.handle(self)
+
+            def log_message(self, fmt, *args):
+                LOG.debug(fmt, *args)
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.thread = None
+
+    @property
+    def port(self):
+        return self.httpd.server_address[1]
+
+    def handle(self, request):
+        url = urlsplit(request.path)
+        if url.path == '/history.json':
+            return self.handle_history(request, parse_qs(url.query))
+        snapshot = self.monitor.live_state.snapshot()
+        # the renderer cache is shared between request threads
+        with self.lock:
+            if request.path == '/metrics':
+                body = self.renderer.metrics(snapshot) + internal_metrics(
+                    getattr(self.monitor, 'bms', None),
+                    getattr(self.monitor, 'outbox', None),
+                    getattr(self.monitor, 'supervisor', None),
+                    getattr(self.monitor, 'worker_stats', None),
+                    getattr(self.monitor, 'publisher', None),
+                    getattr(self.monitor, 'scheduler', None),
+                    getattr(self.monitor, 'startup', None)) + \
+                    trace_metrics(TRACER)
+                content_type = 'text/plain; version=0.0.4'
+            elif request.path == '/snapshot.json':
+                body = self.renderer.json(snapshot)
+                content_type = 'application/json'
+            else:
+                request.send_error(404)
+                return
+        self.respond(request, body, content_type)
+
+    def handle_history(self, request, query):
+        rollups = getattr(self.monitor, 'rollups', None)
+        if rollups is None:
+            request.send_error(404)
+            return
+        try:
+            body = history_json(rollups,
+                                query.get('type', ['overview'])[0],
+                                float(query.get('seconds', [86400])[0]),
+                                int(query.get('rows', [48])[0]))
+        except (KeyError, ValueError, ZeroDivisionError):
+            request.send_error(400)
+            return
+        self.respond(request, body, 'application/json')
+
+    def respond(self, request, body, content_type):
+        data = body.encode()
+        request.send_response(200)
+        request.send_header('Content-Type', content_type)
+        request.send_header('Content-Length', str(len(data)))
+        request.end_headers()
+        request.wfile.write(data)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever,
+                                       daemon=True)
+        self.thread.start()
+        LOG.info("Serving metrics on port %d", self.port)
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,21 @@
+import importlib.util
+import sys
+
+def lazy_import(name):
+    """lazy_import
+    Return a module that is only loaded when one of its attributes is
+    first used, so slow imports (pygatt, serial, asyncio) stay off the
+    startup path. A module that is already loaded is returned as is
+    """
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError("No module named %r" % name, name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
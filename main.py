@@ -1,22 +1,83 @@
 import argparse
 import json
 import logging
+import os
 import queue
 import sys
 import threading
 import time
 
-from BMS import SmartBMS
-from SMS import SixFabSMS
+import BMS
+from BMS import ConnectionSupervisor, SmartBMS
+from SMS import OutboundQueue, PRIORITY_HIGH, SixFabSMS
+import commands
+import tracing
+from alerts import AlertEngine, load_rules
+from commands import default_registry
+from recorder import Recorder, Rollups
+from scheduler import AdaptiveScheduler
+from state import Checkpoint, LiveState, Snapshot, versions_at
 
 LOG = logging.getLogger("BatteryMonitor")
 LOG.setLevel(logging.INFO)
 
+# seconds between message list polls, doubling while idle
+POLL_INTERVAL_MIN = 1.0
+POLL_INTERVAL_MAX = 60.0
+# seconds between full message sweeps in push mode
+RECONCILE_INTERVAL = 300.0
+# startup is timed from here, the imports above are cheap as the BLE and
+# serial modules are loaded on first use
+STARTED = time.monotonic()
+
 class BatteryMonitor(object):
-    def __init__(self, disable_sms, test_request, phone_filter_list):
+    def __init__(self, disable_sms, test_request, phone_filter_list,
+                 continuous=False, recorder=None, analytics=None,
+                 sms_push=False, outbox_path=None, alert_rules=None,
+                 rollups=None, live_state=None, alerts=None,
+                 max_segments=None, sweep_interval=None, checkpoint=None,
+                 pipeline=0):
         self.sms = SixFabSMS(whitelist=phone_filter_list,
                              disable_sending=disable_sms)
         self.info_queue = queue.Queue()
+        self.continuous = continuous
+        # a RingState when the BMS runs in another process
+        self.live_state = live_state if live_state is not None else \
+            LiveState()
+        self.bms = None
+        # packet requests kept in flight, see SmartBMS
+        self.pipeline = pipeline
+        self.supervisor = None
+        self.publisher = None
+        self.recorder = recorder
+        self.rollups = rollups
+        self.analytics = analytics
+        self.sms_push = sms_push
+        self.outbox = OutboundQueue(self.sms, path=outbox_path)
+        self.alerts = alerts
+        if alert_rules:
+            self.alerts = AlertEngine(alert_rules, self.send_alert)
+        # (min, max) seconds between sweeps, paced by pack activity
+        self.scheduler = None
+        if sweep_interval:
+            self.scheduler = AdaptiveScheduler(*sweep_interval,
+                                               alerts=self.alerts)
+        self.commands = default_registry(analytics=analytics,
+                                         alerts=self.alerts,
+                                         recorder=recorder,
+                                         rollups=rollups,
+                                         max_segments=max_segments)
+
+        # seconds from start to the checkpoint being restored, the first
+        # snapshot from the BMS and the first reply, for the exporter
+        self.startup = {'restored': None, 'snapshot': None, 'reply': None}
+        self.checkpoint = checkpoint
+        # replies are made from the checkpoint until the BMS answers
+        self.restored = checkpoint.load() if checkpoint is not None else None
+        if self.restored is not None:
+            self._started('restored')
+            if continuous:
+                self.live_state.restore(self.restored)
 
         if test_request:
             self.sms.add_test_message(test_request)
@@ -29,26 +90,21 @@ class BatteryMonitor(object):
         bms_thread.join()
         sms_thread.join()
 
+    def _started(self, stage):
+        if self.startup[stage] is None:
+            self.startup[stage] = time.monotonic() - STARTED
+            LOG.info("First %s %.3fs after start", stage, self.startup[stage])
+
     @staticmethod
     def has_all_battery_info(battery_info):
-        required_keys = [
-            'pack_voltage', 'total_cells', 'time_hours', 'time_minutes',
-            'input_amps', 'input_watts', 'output_amps', 'output_watts',
-            'pack_soc']
-        for req in required_keys:
-            if req not in battery_info:
-                return False
-        for ind in range(1, battery_info['total_cells']):
-            if ind not in battery_info['cells']:
-                LOG.info("Missing cell %i", ind)
-                return False
-        return True
+        return BMS.has_all_battery_info(battery_info)
 
     def task_get_battery_info(self):
-        bms = SmartBMS()
-        battery_info = {
-            'cells': {}
-        }
+        if self.continuous:
+            return self.task_stream_battery_info()
+        bms = SmartBMS(pipeline=self.pipeline)
+        assembler = BMS.SnapshotAssembler()
+        battery_info = assembler.info
         running = True
 
         while running:
@@ -61,19 +117,8 @@ class BatteryMonitor(object):
             # try to get info on cells
             LOG.info("Getting info from BMS")
             for packet in bms.get_battery_info(timeout=20):
-                if packet['type'] != 'invalid':
-                    if packet['type'] == 'cell_info':
-                        idx = packet['contents']['cell_index']
-                        battery_info['cells'][idx] = {
-                            'temp': packet['contents']['cell_temp'],
-                            'volts': packet['contents']['cell_volts']
-                        }
-                        battery_info['total_cells'] = \
-                            packet['contents']['total_cells']
-                    else:
-                        for key, val in packet['contents'].items():
-                            battery_info[key] = val
-                if self.has_all_battery_info(battery_info):
+                assembler.add(packet)
+                if assembler.complete:
                     LOG.info("Got all info from battery")
                     LOG.info(self.format_overview_request(battery_info))
                     LOG.info(self.format_cells_request(battery_info))
@@ -81,11 +126,89 @@ class BatteryMonitor(object):
                     running = False
                     break
 
+        bms.close()
+        self._started('snapshot')
+        # only a full sweep may be served as a reply after a restart
+        if self.checkpoint is not None and \
+                self.has_all_battery_info(battery_info):
+            self.checkpoint.save(self.one_shot_snapshot(battery_info))
         self.info_queue.put(battery_info)
 
+    def task_stream_battery_info(self):
+        logged = False
+
+        with ConnectionSupervisor(
+                SmartBMS(pipeline=self.pipeline)) as supervisor:
+            self.bms = supervisor.bms
+            self.supervisor = supervisor
+            LOG.info("Streaming info from BMS")
+            for packet in supervisor.stream(timeout=10,
+                                            scheduler=self.scheduler):
+                self.live_state.update(packet)
+                if self.checkpoint is not None:
+                    self.checkpoint.save(self.live_state.snapshot())
+                if self.recorder is not None:
+                    self.recorder.record(packet)
+                if self.rollups is not None:
+                    self.rollups.add(packet)
+                if self.alerts is not None:
+                    self.alerts.evaluate(packet)
+                # one analytics sample per completed cell sweep
+                snapshot = self.live_state.snapshot()
+                if self.analytics is not None and snapshot.complete and \
+                        not snapshot.restored and self.live_state.sweep_ended:
+                    self.analytics.add_sample(snapshot.info,
+                                              snapshot.received)
+                if not logged and snapshot.complete and \
+                        not snapshot.restored:
+                    self._started('snapshot')
+                    LOG.info("Got all info from battery")
+                    LOG.info(self.format_overview_request(
+                        self.live_state.snapshot().info))
+                    logged = True
+
+    def send_alert(self, alert):
+        for number in self.sms.whitelist:
+            self.outbox.enqueue(number, alert.message(),
+                                priority=PRIORITY_HIGH)
+
+    def current_snapshot(self, snapshot):
+        # wait for BMS info
+        if self.continuous:
+            snapshot = self.live_state.wait_ready()
+            LOG.info("Battery info version %d, %.1fs old",
+                     snapshot.version, snapshot.age())
+            return snapshot
+        if snapshot is None or snapshot.restored:
+            try:
+                info = self.info_queue.get(block=self.restored is None)
+            except queue.Empty:
+                LOG.info("Replying from the checkpoint, %.0fs old",
+                         self.restored.age())
+                return self.restored
+            return self.one_shot_snapshot(info)
+        return snapshot
+
+    def one_shot_snapshot(self, info):
+        # the one-shot info never changes, so it is a single version, after
+        # the restored one so its cached replies are not reused
+        version = self.restored.version + 1 if self.restored else 1
+        return Snapshot(version, time.time(), info,
+                        versions_at(info, version),
+                        self.has_all_battery_info(info))
+
+    def reply_to_messages(self, sms_requests, snapshot):
+        for message in sms_requests:
+            LOG.info("Replying to %s", message['number'])
+            reply = self.commands.reply(message['message'], snapshot)
+            self.outbox.enqueue(message['number'], reply)
+            self._started('reply')
+            if not self.sms.delete_message(message['index']):
+                return False
+        return True
+
     def task_respond_to_sms(self):
-        battery_info = None
-        wait_time = 1.0
+        snapshot = None
         while True:
             LOG.info("Initializing SMS")
             while not self.sms.initialize():
@@ -95,67 +218,142 @@ class BatteryMonitor(object):
             if rssi:
                 LOG.info("SMS signal %ddBm", rssi)
 
+            push = self.sms_push
+            if push and not self.sms.enable_new_message_indications():
+                LOG.error("Could not enable new message indications, "
+                          "polling instead")
+                push = False
+
             no_error = True
+            wait_time = POLL_INTERVAL_MIN
+            last_sweep = None
             while no_error:
-                LOG.info("Getting messages from SMS")
-                sms_requests = self.sms.get_messages()
-                if sms_requests is None:
-                    time.sleep(10.0)
-                    continue
-
-                # wait for BMS info
-                if battery_info is None:
-                    battery_info = self.info_queue.get()
-
-                for message in sms_requests:
-                    LOG.info("Replying to %s", message['number'])
-                    message['message'] = message['message'].lower()
-
-                    if message['message'] == "overview":
-                        reply = self.format_overview_request(battery_info)
-                    elif message['message'] == "cells":
-                        reply = self.format_cells_request(battery_info)
-                    elif message['message'] == "temperature":
-                        reply = self.format_temperature_request(battery_info)
-                    else:
-                        LOG.info('Got message "%s", replying with overview',
-                                 message['message'])
-                        reply = self.format_overview_request(battery_info)
-                        reply += ". Commands: overview, cells, temperature"
-
-                    if not self.sms.send_message(message['number'], reply):
-                        no_error = False
-                        break
-                    if not self.sms.delete_message(message['index']):
-                        no_error = False
-                        break
-
-                time.sleep(wait_time)
-                wait_time *= 2
+                self.outbox.process()
+                if self.outbox.depth() > 0:
+                    LOG.info("Outbox: %s", self.outbox.stats())
+                due = self.outbox.seconds_until_due()
+                if push:
+                    sms_requests = []
+                    # fallback sweep for indications that were missed, the
+                    # first one picks up messages stored before indications
+                    # were enabled
+                    if last_sweep is None or time.monotonic() - \
+                            last_sweep >= RECONCILE_INTERVAL:
+                        LOG.info("Reconciling stored messages")
+                        sms_requests = self.sms.get_messages() or []
+                        last_sweep = time.monotonic()
+                    if not sms_requests:
+                        timeout = RECONCILE_INTERVAL - \
+                            (time.monotonic() - last_sweep)
+                        if due is not None:
+                            timeout = min(timeout, due)
+                        sms_requests = self.sms.wait_for_messages(
+                            timeout=max(timeout, 0.1), wake=self.outbox.added)
+                else:
+                    LOG.info("Getting messages from SMS")
+                    sms_requests = self.sms.get_messages()
+                    if sms_requests is None:
+                        time.sleep(10.0)
+                        continue
+
+                if sms_requests:
+                    snapshot = self.current_snapshot(snapshot)
+                    no_error = self.reply_to_messages(sms_requests, snapshot)
+                    wait_time = POLL_INTERVAL_MIN
+                elif not push:
+                    delay = wait_time
+                    if due is not None:
+                        delay = min(delay, max(due, 0.1))
+                    self.outbox.added.wait(delay)
+                    wait_time = min(wait_time * 2, POLL_INTERVAL_MAX)
 
     @staticmethod
     def format_overview_request(info):
-        f_str = "{:.1f}V, Input: {:.1f}A/{:d}W, Output: {:.1f}A/{:d}W ({:d}%)"
-        return f_str.format(info['pack_voltage'],
-                            info['input_amps'], info['input_watts'],
-                            info['output_amps'], info['output_watts'],
-                            info['pack_soc'])
+        return commands.format_overview(info)
 
     @staticmethod
     def format_cells_request(info):
-        out = "Cell Volts: ({:.3f}V - {:.3f}V)".format(
-            info['min_volt_cell']['volts'], info['max_volt_cell']['volts'])
-        for ind in sorted(info['cells'].keys()):
-            out += " {:.3f}".format(info['cells'][ind]['volts'], ind)
-        return out
+        return commands.format_cells(info)
 
     @staticmethod
     def format_temperature_request(info):
-        out = "Temp. Celcius: ({:.1f}C - {:.1f}C)".format(
-            info['min_temp_cell']['temp'], info['max_temp_cell']['temp'])
-        for ind in sorted(info['cells'].keys()):
-            out += " {:.1f}".format(info['cells'][ind]['temp'])
-        return out
+        return commands.format_temperature(info)
+
+    @staticmethod
+    def format_balance_request(summary):
+        return commands.format_balance(summary)
+
+def setup_logging():
+    logFormatter = logging.Formatter(
+        "%(asctime)s [%(name)-14.14s] [%(levelname)-5.5s]  %(message)s")
+    consoleHandler = logging.StreamHandler(sys.stdout)
+    consoleHandler.setFormatter(logFormatter)
+    logging.getLogger().addHandler(consoleHandler)
+
+def start_publisher(args, owner):
+    """start_publisher
+    Publish owner's live state to the --mqtt broker, owner.publisher is
+    picked up by the metrics server
+    """
+    from publisher import MqttPublisher
+
+    host, _, port = args.mqtt.partition(':')
+    owner.publisher = MqttPublisher(owner.live_state, host,
+                                    int(port or 1883), prefix=args.mqtt_topic,
+                                    interval=args.mqtt_interval,
+                                    buffer_path=args.mqtt_buffer)
+    owner.publisher.start()
+
+def run_workers(args):
+    from workers import (Worker, WorkerSupervisor, analytics_worker,
+                         bms_worker, sms_worker)
+    from multiprocessing import get_context
+
+    config = {
+        'inbox': get_context('spawn').Queue(),
+        'disable_sms': args.no_sms_send,
+        'request': args.request,
+        'phone_list': args.phone_list,
+        'sms_push': args.sms_push,
+        'outbox': args.outbox,
+        'alerts': args.alerts,
+        'analytics': args.analytics,
+        'record': args.record,
+        'keep_raw_days': args.keep_raw_days,
+        'max_segments': args.max_segments,
+        'sweep_interval': args.sweep_interval,
+        'trace': args.trace,
+        'trace_path': args.trace_path,
+        'checkpoint': args.checkpoint,
+        'pipeline': args.pipeline,
+        'rollups': os.path.join(args.record, 'rollups')
+        if args.record else None
+    }
+    # the BMS worker is quiet while a paced sweep waits
+    bms_stall = 120.0
+    if args.sweep_interval:
+        bms_stall = max(bms_stall, args.sweep_interval[1] + 60.0)
+    workers = [
+        Worker('bms', bms_worker, (config,), stall_timeout=bms_stall),
+        # the push mode loop may idle for a whole reconcile interval
+        Worker('sms', sms_worker, (config,),
+               stall_timeout=2 * RECONCILE_INTERVAL + 60.0)
+    ]
+    if args.analytics:
+        workers.append(Worker('analytics', analytics_worker, (config,),
+                              stall_timeout=30.0))
+    with WorkerSupervisor(workers) as supervisor:
+        if args.checkpoint:
+            # served until the BMS worker's first sweep replaces it
+            restored = Checkpoint(args.checkpoint).load()
+            if restored is not None:
+                supervisor.ring.write(restored)
+        if args.mqtt:
+            start_publisher(args, supervisor)
+        if args.metrics_port:
+            from exporter import MetricsServer
+            MetricsServer(supervisor, port=args.metrics_port).start()
+        supervisor.run()
 
 def main():
     parser = argparse.ArgumentParser(description='Run SMS Battery Monitor')
@@ -165,16 +363,102 @@ def main():
                         help="A request to process as if it were an SMS")
     parser.add_argument('--phone-list', required=True,
                         help="Path to a list of allowed phone numbers")
+    parser.add_argument('--continuous', action='store_true', default=False,
+                        help="Keep streaming from the BMS instead of "
+                             "replying with the first snapshot")
+    parser.add_argument('--record',
+                        help="Directory to record packet history in "
+                             "(continuous mode only)")
+    parser.add_argument('--keep-raw-days', type=int, default=7,
+                        help="Days of raw packet history to keep, 0 keeps "
+                             "everything. Rollups have their own retention")
+    parser.add_argument('--analytics', action='store_true', default=False,
+                        help="Keep cell history for the 'balance' command "
+                             "(continuous mode only, needs numpy)")
+    parser.add_argument('--sms-push', action='store_true', default=False,
+                        help="React to new message indications (+CMTI) "
+                             "instead of polling the message list")
+    parser.add_argument('--outbox',
+                        help="File to keep unsent replies in across restarts")
+    parser.add_argument('--alerts',
+                        help="JSON file of alert rules to evaluate on every "
+                             "packet (continuous mode only)")
+    parser.add_argument('--max-segments', type=int,
+                        help="Send cells and temperature replies that would "
+                             "take more SMS than this as compact or summary "
+                             "reports (see compact.decode_report)")
+    parser.add_argument('--multiprocess', action='store_true', default=False,
+                        help="Run the BMS, SMS and analytics in supervised "
+                             "processes of their own (implies --continuous)")
+    parser.add_argument('--metrics-port', type=int,
+                        help="Serve /metrics and /snapshot.json on this port "
+                             "(continuous mode only)")
+    parser.add_argument('--mqtt', metavar='HOST[:PORT]',
+                        help="Publish battery info to this MQTT broker "
+                             "(continuous mode only, needs paho-mqtt)")
+    parser.add_argument('--mqtt-topic', default='bms/pack',
+                        help="Topic prefix, changes go to <prefix>/delta and "
+                             "the full state to <prefix>/state")
+    parser.add_argument('--mqtt-interval', type=float, default=10.0,
+                        help="Seconds between batched publishes")
+    parser.add_argument('--mqtt-buffer',
+                        help="File to buffer messages in while the broker "
+                             "is unreachable")
+    parser.add_argument('--sweep-interval', metavar='MIN:MAX',
+                        type=lambda text: tuple(
+                            float(value) for value in text.split(':')),
+                        help="Pace cell sweeps from MIN seconds apart while "
+                             "the pack is active to MAX while it is idle "
+                             "(continuous mode only)")
+    parser.add_argument('--pipeline', type=int, default=0,
+                        help="Packet requests to keep in flight while "
+                             "streaming instead of waiting for a write "
+                             "response per packet (0 waits)")
+    parser.add_argument('--checkpoint',
+                        help="File to save the latest snapshot in, replies "
+                             "are made from it at startup until the BMS "
+                             "answers")
+    parser.add_argument('--trace', action='store_true', default=False,
+                        help="Record timed spans of the BLE and modem calls "
+                             "from the start. SIGUSR1 toggles tracing, and "
+                             "turning it off writes a Chrome trace")
+    parser.add_argument('--trace-path', default='trace.json',
+                        help="Chrome trace file, workers add their name")
     args = parser.parse_args()
 
-    logFormatter = logging.Formatter(
-        "%(asctime)s [%(name)-14.14s] [%(levelname)-5.5s]  %(message)s")
-    consoleHandler = logging.StreamHandler(sys.stdout)
-    consoleHandler.setFormatter(logFormatter)
-    logging.getLogger().addHandler(consoleHandler)
+    setup_logging()
+    tracing.install(args.trace_path, args.trace)
 
     LOG.info("### Starting Battery Monitor ###")
-    monitor = BatteryMonitor(args.no_sms_send, args.request, args.phone_list)
+    if args.multiprocess:
+        return run_workers(args)
+    recorder = None
+    rollups = None
+    if args.record:
+        # raw segments hold one day each
+        recorder = Recorder(args.record,
+                            max_segments=args.keep_raw_days or None)
+        rollups = Rollups(os.path.join(args.record, 'rollups'))
+    analytics = None
+    if args.analytics:
+        from analytics import CellHistory
+        analytics = CellHistory()
+    monitor = BatteryMonitor(args.no_sms_send, args.request, args.phone_list,
+                             continuous=args.continuous, recorder=recorder,
+                             analytics=analytics, sms_push=args.sms_push,
+                             outbox_path=args.outbox,
+                             alert_rules=load_rules(args.alerts)
+                             if args.alerts else None,
+                             rollups=rollups, max_segments=args.max_segments,
+                             sweep_interval=args.sweep_interval,
+                             checkpoint=Checkpoint(args.checkpoint)
+                             if args.checkpoint else None,
+                             pipeline=args.pipeline)
+    if args.mqtt:
+        start_publisher(args, monitor)
+    if args.metrics_port:
+        from exporter import MetricsServer
+        MetricsServer(monitor, port=args.metrics_port).start()
     monitor.start()
 
 if __name__ == "__main__":
@@ -0,0 +1,47 @@
+import bisect
+import threading
+
+# seconds, from 10us to 10s
+LATENCY_BUCKETS = (1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3,
+                   5e-3, 1e-2, 2.5e-2, 5e-2, 0.1, 0.25, 0.5, 1.0, 2.5,
+                   5.0, 10.0)
+
+class Histogram(object):
+    """Histogram
+    Fixed bucket latency histogram, counts are per bucket (not
+    cumulative) and the last count is for values over the last bound
+    """
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total += value
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.counts), self.count, self.total
+
+    def quantile(self, q):
+        """quantile
+        Upper bound of the bucket holding the q quantile
+        """
+        counts, count, total = self.snapshot()
+        if count == 0:
+            return None
+        target = q * count
+        seen = 0
+        for index, bucket_count in enumerate(counts):
+            seen += bucket_count
+            if seen >= target:
+                if index < len(self.buckets):
+                    return self.buckets[index]
+                return float('inf')
+        return float('inf')
@@ -0,0 +1,200 @@
+import argparse
+import asyncio
+import logging
+import random
+import sys
+import time
+
+import BMS
+from BMS import AsyncSmartBMS
+
+LOG = logging.getLogger("PackMonitor")
+LOG.setLevel(logging.INFO)
+
+def load_packs(path):
+    """load_packs
+    Read a pack list, one "<address> [name]" per line. Packs without a
+    name are named after their address
+    """
+    packs = []
+    with open(path) as myfile:
+        for line in myfile.read().split('\n'):
+            line = line.split('#')[0].strip()
+            if len(line) == 0:
+                continue
+            fields = line.split()
+            name = fields[1] if len(fields) > 1 else fields[0]
+            packs.append((name, fields[0]))
+    return packs
+
+class PackState(object):
+    def __init__(self, name, address):
+        self.name = name
+        self.address = address
+        self.bms = None
+        self.info = None
+        self.updated = None
+        self.failures = 0
+        self.backoff_until = 0.0
+        self.sweeps = 0
+        self.packets = 0
+
+    def age(self):
+        if self.updated is None:
+            return None
+        return time.monotonic() - self.updated
+
+    def is_stale(self, max_age):
+        age = self.age()
+        return age is None or age > max_age
+
+    def is_due(self):
+        return time.monotonic() >= self.backoff_until
+
+class PackMonitor(object):
+    """PackMonitor
+    Polls many SmartBMS devices from one event loop over a shared adapter.
+    At most `concurrency` packs are connected at once; when there are more
+    packs than that, each pack is disconnected after its sweep so the
+    adapter is handed round-robin to the next one
+    """
+    def __init__(self, packs, adapter, concurrency=1, timeout=10,
+                 max_age=120, backoff_base=2.0, backoff_max=300.0):
+        self.adapter = adapter
+        self.states = [PackState(name, address) for name, address in packs]
+        self.concurrency = max(1, concurrency)
+        self.timeout = timeout
+        self.max_age = max_age
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.semaphore = None
+
+    def _keep_connected(self):
+        return self.concurrency >= len(self.states)
+
+    def _backoff(self, state):
+        state.failures += 1
+        delay = min(self.backoff_max,
+                    self.backoff_base * 2 ** (state.failures - 1))
+        delay *= random.uniform(0.5, 1.0)
+        state.backoff_until = time.monotonic() + delay
+        LOG.info("Pack %s failed %d times, retrying in %.1fs",
+                 state.name, state.failures, delay)
+
+    async def _disconnect(self, state):
+        if state.bms is not None:
+            await state.bms.close()
+            state.bms = None
+
+    async def _sweep(self, state):
+        if state.bms is None:
+            state.bms = AsyncSmartBMS(state.address, adapter=self.adapter)
+            if await state.bms.connect(self.timeout, attempts=1) is None:
+                return None
+        assembler = BMS.SnapshotAssembler()
+        stream = state.bms.stream(timeout=self.timeout)
+        try:
+            async for packet in stream:
+                state.packets += 1
+                assembler.add(packet)
+                if assembler.complete:
+                    return assembler.info
+        finally:
+            await stream.aclose()
+        return None
+
+    async def poll_pack(self, state):
+        async with self.semaphore:
+            try:
+                info = await self._sweep(state)
+            except Exception as ex:
+                LOG.error("Error polling pack %s: %s", state.name, ex)
+                info = None
+            if info is None or not self._keep_connected():
+                await self._disconnect(state)
+        if info is None:
+            self._backoff(state)
+            return False
+        state.info = info
+        state.updated = time.monotonic()
+        state.failures = 0
+        state.sweeps += 1
+        return True
+
+    async def poll_once(self):
+        """poll_once
+        Sweep every pack that is not backing off, returns the number of
+        successful sweeps
+        """
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+        due = [s for s in self.states if s.is_due()]
+        results = await asyncio.gather(*[self.poll_pack(s) for s in due])
+        return sum(1 for r in results if r)
+
+    async def run(self, interval=0, on_round=None):
+        """run
+        Poll every interval seconds until cancelled. on_round, if given, is
+        called with the monitor after each round
+        """
+        while True:
+            await self.poll_once()
+            if on_round is not None:
+                on_round(self)
+            await asyncio.sleep(interval)
+
+    async def close(self):
+        for state in self.states:
+            await self._disconnect(state)
+
+    def snapshot(self):
+        """snapshot
+        Return the latest info of every pack keyed by pack name
+        """
+        out = {}
+        for state in self.states:
+            out[state.name] = {
+                'address': state.address,
+                'info': state.info,
+                'age': state.age(),
+                'stale': state.is_stale(self.max_age),
+                'failures': state.failures,
+                'sweeps': state.sweeps
+            }
+        return out
+
+def log_packs(monitor):
+    from main import BatteryMonitor
+    for name, pack in monitor.snapshot().items():
+        if pack['info'] is not None:
+            LOG.info("%s: %s%s", name,
+                     BatteryMonitor.format_overview_request(pack['info']),
+                     " (stale)" if pack['stale'] else "")
+
+async def monitor_packs(monitor, interval):
+    await monitor.run(interval, on_round=log_packs)
+
+def main():
+    parser = argparse.ArgumentParser(description='Monitor several SmartBMS packs')
+    parser.add_argument('--packs', required=True,
+                        help="Path to a list of BMS addresses and names")
+    parser.add_argument('--concurrency', type=int, default=1,
+                        help="Packs connected at once (1 for gatttool)")
+    parser.add_argument('--interval', type=float, default=10.0,
+                        help="Seconds between polling rounds")
+    args = parser.parse_args()
+
+    logging.getLogger().addHandler(logging.StreamHandler(sys.stdout))
+
+    import pygatt
+    adapter = pygatt.GATTToolBackend()
+    adapter.start()
+    monitor = PackMonitor(load_packs(args.packs), adapter,
+                          concurrency=args.concurrency)
+    try:
+        asyncio.run(monitor_packs(monitor, args.interval))
+    finally:
+        adapter.stop()
+
+if __name__ == "__main__":
+    main()
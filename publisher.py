@@ -0,0 +1,350 @@
+import collections
+import json
+import logging
+import os
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+LOG = logging.getLogger("MqttPublisher")
+LOG.setLevel(logging.INFO)
+
+# battery_info field -> smallest change worth publishing, fields not
+# listed are published on any change
+DEADBANDS = {
+    'pack_voltage': 0.05,
+    'input_amps': 0.1,
+    'pack_amps': 0.1,
+    'output_amps': 0.1,
+    'input_watts': 5,
+    'output_watts': 5,
+    'input_kwh': 0.01,
+    'pack_kwh': 0.01,
+    'output_kwh': 0.01,
+    'balance_volts': 0.005,
+    'volts': 0.002,
+    'temp': 0.5,
+}
+# seconds to wait for the broker to acknowledge a replayed message when
+# the client queue is full
+REPLAY_TIMEOUT = 10.0
+# retained full state and batched changes, under the topic prefix
+STATE_TOPIC = 'state'
+DELTA_TOPIC = 'delta'
+
+def _round(value):
+    if isinstance(value, float):
+        return round(value, 3)
+    if isinstance(value, dict):
+        return {key: _round(val) for key, val in value.items()}
+    return value
+
+def _encode(payload):
+    return json.dumps(payload, separators=(',', ':'))
+
+class DeltaEncoder(object):
+    """DeltaEncoder
+    Turns snapshots into the fields that moved past their deadband since
+    they were last published. Cells are published as [volts, temp]
+    """
+    def __init__(self, deadbands=DEADBANDS):
+        self.deadbands = deadbands
+        # field or ('cells', index) -> value last published
+        self.published = {}
+        # snapshot version last looked at
+        self.version = 0
+
+    def _moved(self, key, old, new):
+        if old is None:
+            return True
+        if isinstance(new, dict):
+            # min/max cells, {'index': i, 'volts' or 'temp': value}
+            return any(self._moved(field, old.get(field), value)
+                       for field, value in new.items())
+        band = self.deadbands.get(key)
+        if not band:
+            return new != old
+        # readings are quantized, so compare without float noise
+        return round(abs(new - old), 6) >= band
+
+    def _cell(self, index, cell):
+        old = self.published.get(('cells', index))
+        if old is not None and not self._moved('volts', old[0],
+                                               cell['volts']) and \
+                not self._moved('temp', old[1], cell['temp']):
+            return None
+        value = [_round(cell['volts']), _round(cell['temp'])]
+        self.published[('cells', index)] = value
+        return value
+
+    def delta(self, snapshot):
+        """delta
+        Changed fields in the battery_info shape, empty if nothing moved
+        """
+        changes = snapshot.changes_since(self.version)
+        self.version = snapshot.version
+        out = {}
+        for field, value in changes.items():
+            if field == 'cells':
+                continue
+            if self._moved(field, self.published.get(field), value):
+                out[field] = self.published[field] = _round(value)
+        cells = {}
+        for index, cell in changes.get('cells', {}).items():
+            value = self._cell(index, cell)
+            if value is not None:
+                cells[str(index)] = value
+        if cells:
+            out['cells'] = cells
+        return out
+
+    def full(self, snapshot):
+        """full
+        Every field of the snapshot, which becomes the new baseline
+        """
+        self.published = {}
+        self.version = snapshot.version
+        out = {}
+        for field, value in snapshot.info.items():
+            if field != 'cells':
+                out[field] = self.published[field] = _round(value)
+        out['cells'] = {}
+        for index, cell in snapshot.info['cells'].items():
+            out['cells'][str(index)] = self._cell(index, cell)
+        return out
+
+class DiskBuffer(object):
+    """DiskBuffer
+    Messages held in a file, one JSON line each, while the broker is
+    unreachable. Only the file size is kept in memory. Past max_bytes
+    the oldest half is dropped
+    """
+    def __init__(self, path, max_bytes=1 << 20):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.size = os.path.getsize(path) if os.path.exists(path) else 0
+        self.count = len(self._lines())
+        self.dropped = 0
+
+    def _lines(self):
+        if self.size == 0:
+            return []
+        with open(self.path) as myfile:
+            return myfile.readlines()
+
+    def _write(self, lines):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as myfile:
+            myfile.writelines(lines)
+        os.replace(tmp_path, self.path)
+        self.size = sum(len(line) for line in lines)
+        self.count = len(lines)
+
+    def append(self, topic, payload, retain=False):
+        line = _encode([topic, payload, retain]) + '\n'
+        if self.size + len(line) > self.max_bytes:
+            lines = self._lines()
+            keep = len(lines)
+            size = len(line)
+            for offset, old in enumerate(reversed(lines)):
+                size += len(old)
+                if size > self.max_bytes // 2:
+                    keep = offset
+                    break
+            self.dropped += len(lines) - keep
+            LOG.info("Buffer full, dropped %d messages", len(lines) - keep)
+            self._write(lines[len(lines) - keep:])
+        with open(self.path, 'a') as myfile:
+            myfile.write(line)
+        self.size += len(line)
+        self.count += 1
+
+    def pending(self):
+        return [tuple(json.loads(line)) for line in self._lines()]
+
+    def keep(self, messages):
+        """keep
+        Replace the buffer with the messages still to send
+        """
+        self._write([_encode(list(message)) + '\n' for message in messages])
+
+class MqttPublisher(object):
+    """MqttPublisher
+    Publishes a live state to an MQTT broker every interval seconds: the
+    fields that moved past their deadband as one batched message on
+    <prefix>/delta, and every keyframe_interval (and after each reconnect)
+    the full state retained on <prefix>/state. While the broker is
+    unreachable messages go to a DiskBuffer (if buffer_path is given) and
+    are replayed in order on reconnect
+    """
+    def __init__(self, live_state, host, port=1883, prefix='bms/pack',
+                 interval=10.0, keyframe_interval=900.0, buffer_path=None,
+                 buffer_bytes=1 << 20, client_id=None, reconnect_max=60):
+        self.live_state = live_state
+        self.host = host
+        self.port = port
+        self.prefix = prefix.rstrip('/')
+        self.interval = interval
+        self.keyframe_interval = keyframe_interval
+        self.encoder = DeltaEncoder()
+        self.buffer = None
+        if buffer_path is not None:
+            self.buffer = DiskBuffer(buffer_path, buffer_bytes)
+        self.connected = threading.Event()
+        # set on every (re)connect and while messages are buffered, cleared
+        # once the buffer is replayed and a keyframe can follow
+        self.resync = False
+        self.next_keyframe = 0.0
+        self.messages = 0
+        self.bytes = 0
+        self.dropped = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+        if hasattr(mqtt, 'CallbackAPIVersion'):
+            self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2,
+                                      client_id=client_id or '')
+        else:
+            self.client = mqtt.Client(client_id=client_id or '')
+        self.client.on_connect = self._on_connect
+        self.client.on_disconnect = self._on_disconnect
+        self.client.reconnect_delay_set(1, reconnect_max)
+        # queued QoS 1 messages stay bounded, the rest go to the buffer
+        self.client.max_queued_messages_set(64)
+
+    def _on_connect(self, client, userdata, flags, rc, *args):
+        if rc == 0:
+            LOG.info("Connected to %s:%d", self.host, self.port)
+            self.resync = True
+            self.connected.set()
+
+    def _on_disconnect(self, client, userdata, *args):
+        if self.connected.is_set():
+            LOG.info("Disconnected from %s:%d", self.host, self.port)
+        self.connected.clear()
+
+    def _send(self, topic, payload, retain=False):
+        # nothing overtakes buffered messages
+        backlog = self.buffer is not None and self.buffer.count > 0
+        if self.connected.is_set() and not backlog:
+            info = self.client.publish(topic, payload, qos=1, retain=retain)
+            if info.rc == mqtt.MQTT_ERR_SUCCESS:
+                self.messages += 1
+                self.bytes += len(topic) + len(payload)
+                return True
+            # the client queue is full, replay the buffer before anything
+            # else goes out
+            self.resync = True
+        if self.buffer is not None:
+            self.buffer.append(topic, payload, retain)
+        else:
+            self.dropped += 1
+        return False
+
+    def _replay(self):
+        messages = self.buffer.pending()
+        if messages:
+            LOG.info("Replaying %d buffered messages", len(messages))
+        # replayed messages the broker has not acknowledged yet
+        unacked = collections.deque()
+        for sent, message in enumerate(messages):
+            while True:
+                info = None
+                if self.connected.is_set():
+                    info = self.client.publish(message[0], message[1], qos=1,
+                                               retain=message[2])
+                if info is not None and info.rc == mqtt.MQTT_ERR_SUCCESS:
+                    break
+                # a full client queue drains as the broker acknowledges
+                if info is None or info.rc != mqtt.MQTT_ERR_QUEUE_SIZE or \
+                        not unacked:
+                    self.buffer.keep(messages[sent:])
+                    return False
+                try:
+                    unacked.popleft().wait_for_publish(REPLAY_TIMEOUT)
+                except (RuntimeError, ValueError):
+                    self.buffer.keep(messages[sent:])
+                    return False
+            unacked.append(info)
+            self.messages += 1
+            self.bytes += len(message[0]) + len(message[1])
+        self.buffer.keep([])
+        # the keyframe that follows needs room in the client queue
+        for info in unacked:
+            try:
+                info.wait_for_publish(REPLAY_TIMEOUT)
+            except (RuntimeError, ValueError):
+                return False
+        return True
+
+    def publish_once(self):
+        """publish_once
+        Publish what changed since the last call, returns the number of
+        messages sent or buffered
+        """
+        snapshot = self.live_state.snapshot()
+        if snapshot.version == 0:
+            return 0
+        count = 0
+        if self.connected.is_set() and self.resync:
+            # live changes wait until the backlog is out, the keyframe
+            # after it carries them
+            if self.buffer is not None and not self._replay():
+                return 0
+            self.resync = False
+            # receivers may have missed deltas while we were offline
+            self.next_keyframe = 0.0
+        now = time.monotonic()
+        if now >= self.next_keyframe and self.connected.is_set():
+            self.next_keyframe = now + self.keyframe_interval
+            info = self.encoder.full(snapshot)
+            self._send(self.prefix + '/' + STATE_TOPIC, _encode(
+                {'ts': round(snapshot.timestamp, 1), 'info': info}), True)
+            count += 1
+        else:
+            info = self.encoder.delta(snapshot)
+            if info:
+                self._send(self.prefix + '/' + DELTA_TOPIC, _encode(
+                    {'ts': round(snapshot.timestamp, 1), 'info': info}))
+                count += 1
+        return count
+
+    def stats(self):
+        return {
+            'connected': self.connected.is_set(),
+            'messages': self.messages,
+            'bytes': self.bytes,
+            'buffered': self.buffer.count if self.buffer is not None else 0,
+            'dropped': self.dropped + (self.buffer.dropped
+                                       if self.buffer is not None else 0)
+        }
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.publish_once()
+            except Exception:
+                LOG.exception("MQTT publish failed")
+
+    def start(self):
+        self.client.connect_async(self.host, self.port)
+        self.client.loop_start()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        LOG.info("Publishing to %s:%d/%s every %.0fs", self.host, self.port,
+                 self.prefix, self.interval)
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.client.disconnect()
+        self.client.loop_stop()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
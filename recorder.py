@@ -0,0 +1,432 @@
+import collections
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+
+import BMS
+
+LOG = logging.getLogger("Recorder")
+LOG.setLevel(logging.INFO)
+
+# Fixed-width little-endian record per packet type: a float64 timestamp
+# followed by the record fields in namedtuple order
+RECORD_FORMATS = {
+    'overview': (BMS.Overview, struct.Struct('<dffff')),
+    'min_max_temp': (BMS.MinMaxTemp, struct.Struct('<dHfHf')),
+    'energy': (BMS.Energy, struct.Struct('<dfffH')),
+    'power': (BMS.Power, struct.Struct('<diiBB')),
+    'min_max_volts': (BMS.MinMaxVolts, struct.Struct('<dHfHff')),
+    'cell_info': (BMS.CellInfo, struct.Struct('<dHHff')),
+}
+
+SEGMENT_EXT = '.seg'
+
+class Segment(object):
+    """Segment
+    Memory-mapped, read-only view of one segment file. Records are in
+    time order so time ranges are found with a binary search
+    """
+    def __init__(self, path, packet_type, formats=RECORD_FORMATS):
+        self.path = path
+        self.record_type, self.fmt = formats[packet_type]
+        self.file = open(path, 'rb')
+        size = os.fstat(self.file.fileno()).st_size
+        # ignore a partially written trailing record
+        self.count = size // self.fmt.size
+        self.map = None
+        if self.count > 0:
+            self.map = mmap.mmap(self.file.fileno(), self.count * self.fmt.size,
+                                 access=mmap.ACCESS_READ)
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _timestamp(self, index):
+        return struct.unpack_from('<d', self.map, index * self.fmt.size)[0]
+
+    def _bisect(self, timestamp):
+        # first record at or after timestamp
+        low, high = 0, self.count
+        while low < high:
+            mid = (low + high) // 2
+            if self._timestamp(mid) < timestamp:
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+    def read(self, start, end):
+        """read
+        Yield (timestamp, record) for start <= timestamp < end
+        """
+        if self.map is None:
+            return
+        size = self.fmt.size
+        for index in range(self._bisect(start), self.count):
+            values = self.fmt.unpack_from(self.map, index * size)
+            if values[0] >= end:
+                break
+            yield values[0], self.record_type._make(values[1:])
+
+class Recorder(object):
+    """Recorder
+    Appends decoded packet records to one series of segment files per
+    packet type, under <path>/<packet type>/<start time>.seg. Segments
+    rotate every segment_seconds and only the newest max_segments of a
+    type are kept (all if None), always including the one being written.
+    Timestamps never go back within a type, a clock stepped back records
+    at the last timestamp until it catches up, so segments stay sorted.
+    Writes are buffered and flushed every flush_every records to limit SD
+    card writes. Records may be written from one thread while others query
+    """
+    def __init__(self, path, segment_seconds=86400, max_segments=None,
+                 flush_every=64, formats=RECORD_FORMATS):
+        self.path = path
+        self.formats = formats
+        self.segment_seconds = segment_seconds
+        self.max_segments = max_segments
+        self.flush_every = flush_every
+        # packet type -> [segment start, file, pending bytes, pending count,
+        # last timestamp]
+        self.writers = {}
+        self.records = 0
+        # guards the writers, query flushes them from the reader's thread
+        self.lock = threading.Lock()
+
+    def _segment_dir(self, packet_type):
+        return os.path.join(self.path, packet_type)
+
+    def segments(self, packet_type):
+        """segments
+        Return [(start time, path)] of a packet type, oldest first
+        """
+        seg_dir = self._segment_dir(packet_type)
+        if not os.path.isdir(seg_dir):
+            return []
+        out = []
+        for name in os.listdir(seg_dir):
+            if name.endswith(SEGMENT_EXT):
+                out.append((int(name[:-len(SEGMENT_EXT)]),
+                            os.path.join(seg_dir, name)))
+        return sorted(out)
+
+    def _open_segment(self, packet_type, timestamp):
+        seg_dir = self._segment_dir(packet_type)
+        os.makedirs(seg_dir, exist_ok=True)
+        start = int(timestamp // self.segment_seconds * self.segment_seconds)
+        path = os.path.join(seg_dir, "%d%s" % (start, SEGMENT_EXT))
+        myfile = open(path, 'ab')
+        size = myfile.tell()
+        record_size = self.formats[packet_type][1].size
+        # a crash mid write leaves a partial record, appending after it
+        # would misalign every later one
+        partial = size % record_size
+        if partial:
+            LOG.info("Dropping partial record at the end of %s", path)
+            size -= partial
+            myfile.truncate(size)
+        last = float('-inf')
+        if size > 0:
+            with open(path, 'rb') as segment:
+                segment.seek(size - record_size)
+                last = struct.unpack('<d', segment.read(8))[0]
+        writer = [start, myfile, bytearray(), 0, last]
+        self.writers[packet_type] = writer
+        self._apply_retention(packet_type)
+        return writer
+
+    def _apply_retention(self, packet_type):
+        if self.max_segments is None:
+            return
+        segments = self.segments(packet_type)
+        remove = max(0, len(segments) - max(self.max_segments, 1))
+        for start, path in segments[:remove]:
+            LOG.info("Removing old segment %s", path)
+            os.remove(path)
+
+    def _flush_writer(self, writer):
+        if writer[3] > 0:
+            writer[1].write(writer[2])
+            writer[1].flush()
+            writer[2] = bytearray()
+            writer[3] = 0
+
+    def record(self, packet, timestamp=None):
+        """record
+        Append a packet record, invalid packets are ignored
+        """
+        fmt = self.formats.get(packet.type)
+        if fmt is None:
+            return False
+        if timestamp is None:
+            timestamp = time.time()
+        with self.lock:
+            writer = self.writers.get(packet.type)
+            if writer is not None:
+                timestamp = max(timestamp, writer[4])
+            if writer is not None and \
+                    timestamp >= writer[0] + self.segment_seconds:
+                self._flush_writer(writer)
+                writer[1].close()
+                writer = None
+            if writer is None:
+                writer = self._open_segment(packet.type, timestamp)
+                timestamp = max(timestamp, writer[4])
+            writer[2] += fmt[1].pack(timestamp, *packet)
+            writer[4] = timestamp
+            writer[3] += 1
+            self.records += 1
+            if writer[3] >= self.flush_every:
+                self._flush_writer(writer)
+        return True
+
+    def flush(self):
+        with self.lock:
+            for writer in self.writers.values():
+                self._flush_writer(writer)
+
+    def close(self):
+        with self.lock:
+            for writer in self.writers.values():
+                self._flush_writer(writer)
+                writer[1].close()
+            self.writers = {}
+
+    def query(self, packet_type, start=0, end=float('inf'), cells=None):
+        """query
+        Return [(timestamp, record)] of a packet type in [start, end). For
+        cell_info, cells is an optional (first, last) inclusive index range.
+        Only the segments overlapping the range are mapped
+        """
+        self.flush()
+        out = []
+        for seg_start, path in self.segments(packet_type):
+            if seg_start >= end or seg_start + self.segment_seconds <= start:
+                continue
+            try:
+                segment = Segment(path, packet_type, self.formats)
+            except FileNotFoundError:
+                # removed by retention since it was listed
+                continue
+            with segment:
+                for timestamp, record in segment.read(start, end):
+                    if cells is not None and \
+                            not cells[0] <= record.cell_index <= cells[1]:
+                        continue
+                    out.append((timestamp, record))
+        return out
+
+# (name, bucket seconds, segment seconds, segments kept)
+ROLLUP_TIERS = [
+    ('1m', 60, 86400, 31),
+    ('15m', 900, 7 * 86400, 53),
+    ('1h', 3600, 28 * 86400, 66),
+]
+ROLLUP_STATS = ('min', 'max', 'mean', 'last')
+
+# packet type -> (key field or None, aggregated fields)
+ROLLUP_FIELDS = {
+    'overview': (None, BMS.Overview._fields),
+    'min_max_temp': (None, ('min_temp', 'max_temp')),
+    'energy': (None, BMS.Energy._fields),
+    'power': (None, ('input_watts', 'output_watts')),
+    'min_max_volts': (None, ('min_volts', 'max_volts', 'balance_volts')),
+    'cell_info': ('cell_index', ('cell_volts', 'cell_temp')),
+}
+
+def _rollup_format(packet_type, key, fields):
+    # row of one bucket: sample count, key and min/max/mean/last of every
+    # aggregated field, stored after the bucket start time
+    names = ['count'] + ([key] if key else []) + \
+        ['%s_%s' % (field, stat) for field in fields for stat in ROLLUP_STATS]
+    name = ''.join(w.title() for w in packet_type.split('_')) + 'Rollup'
+    base = collections.namedtuple(name, names)
+    record = type(name, (base,), {'__slots__': (), 'type': packet_type})
+    return record, struct.Struct('<dI' + ('H' if key else '') +
+                                 'f' * (len(ROLLUP_STATS) * len(fields)))
+
+ROLLUP_FORMATS = {packet_type: _rollup_format(packet_type, *spec)
+                  for packet_type, spec in ROLLUP_FIELDS.items()}
+
+# packet type -> (key position or None, aggregated field positions)
+_ROLLUP_POSITIONS = {}
+for _type, (_key, _fields) in ROLLUP_FIELDS.items():
+    _names = RECORD_FORMATS[_type][0]._fields
+    _ROLLUP_POSITIONS[_type] = (_names.index(_key) if _key else None,
+                                [_names.index(f) for f in _fields])
+
+class _Bucket(object):
+    __slots__ = ('start', 'key', 'count', 'mins', 'maxs', 'sums', 'lasts')
+
+    def __init__(self, start, key, size):
+        self.start = start
+        self.key = key
+        self.count = 0
+        self.mins = [float('inf')] * size
+        self.maxs = [float('-inf')] * size
+        self.sums = [0.0] * size
+        self.lasts = [0.0] * size
+
+    def add(self, values):
+        self.count += 1
+        self.mins = list(map(min, self.mins, values))
+        self.maxs = list(map(max, self.maxs, values))
+        self.sums = list(map(float.__add__, self.sums, map(float, values)))
+        self.lasts = values
+
+    def merge(self, other):
+        self.count += other.count
+        self.mins = list(map(min, self.mins, other.mins))
+        self.maxs = list(map(max, self.maxs, other.maxs))
+        self.sums = list(map(float.__add__, self.sums, other.sums))
+        self.lasts = other.lasts
+
+    def row(self, record):
+        fields = [self.count]
+        if self.key is not None:
+            fields.append(self.key)
+        for i in range(len(self.mins)):
+            fields += [self.mins[i], self.maxs[i], self.sums[i] / self.count,
+                       self.lasts[i]]
+        return record._make(fields)
+
+class Rollups(object):
+    """Rollups
+    Aggregates packet records into min/max/mean/last rows per time bucket
+    as they arrive, for each tier of ROLLUP_TIERS. Packets feed the first
+    tier and the closed buckets of a tier feed the next one, so a packet
+    costs one bucket update. Each tier is stored by its own Recorder
+    under <path>/<tier name> with its own retention
+    """
+    def __init__(self, path, tiers=ROLLUP_TIERS, flush_every=16):
+        self.tiers = tiers
+        self.recorders = [
+            Recorder(os.path.join(path, name), segment_seconds=segment,
+                     max_segments=keep, flush_every=flush_every,
+                     formats=ROLLUP_FORMATS)
+            for name, width, segment, keep in tiers]
+        # per tier: packet type -> [bucket start, {key: _Bucket}]
+        self.open = [{} for tier in tiers]
+        self.lock = threading.Lock()
+        self.rows = 0
+
+    def _bucket(self, tier, packet_type, key, timestamp):
+        width = self.tiers[tier][1]
+        start = timestamp // width * width
+        current = self.open[tier].get(packet_type)
+        if current is None:
+            current = [start, {}]
+            self.open[tier][packet_type] = current
+        elif start > current[0]:
+            # first packet of a new bucket closes the whole previous one,
+            # so rows are written in time order
+            self._close(tier, packet_type, current[1])
+            current[0] = start
+            current[1] = {}
+        bucket = current[1].get(key)
+        if bucket is None:
+            bucket = _Bucket(current[0], key,
+                             len(ROLLUP_FIELDS[packet_type][1]))
+            current[1][key] = bucket
+        return bucket
+
+    def _close(self, tier, packet_type, buckets):
+        record = ROLLUP_FORMATS[packet_type][0]
+        for key in sorted(buckets, key=lambda k: k or 0):
+            bucket = buckets[key]
+            self.recorders[tier].record(bucket.row(record), bucket.start)
+            self.rows += 1
+            if tier + 1 < len(self.tiers):
+                self._bucket(tier + 1, packet_type, key,
+                             bucket.start).merge(bucket)
+
+    def add(self, packet, timestamp=None):
+        """add
+        Aggregate a packet record, invalid packets are ignored
+        """
+        positions = _ROLLUP_POSITIONS.get(packet.type)
+        if positions is None:
+            return False
+        if timestamp is None:
+            timestamp = time.time()
+        key = packet[positions[0]] if positions[0] is not None else None
+        values = [packet[i] for i in positions[1]]
+        with self.lock:
+            self._bucket(0, packet.type, key, timestamp).add(values)
+        return True
+
+    def tier_for(self, resolution):
+        """tier_for
+        Index of the coarsest tier with buckets no wider than resolution
+        seconds, None if even the first tier is too coarse
+        """
+        best = None
+        for index, tier in enumerate(self.tiers):
+            if tier[1] <= resolution:
+                best = index
+        return best
+
+    def query(self, packet_type, start=0, end=float('inf'), resolution=0,
+              cells=None):
+        """query
+        Return (bucket seconds, [(bucket start, row)]) of the buckets of a
+        packet type overlapping [start, end) from the coarsest tier that
+        has the resolution, including the buckets still open. None if the
+        resolution is finer than every tier
+        """
+        tier = self.tier_for(resolution)
+        if tier is None:
+            return None
+        width = self.tiers[tier][1]
+        start = start // width * width
+        record = ROLLUP_FORMATS[packet_type][0]
+        with self.lock:
+            rows = self.recorders[tier].query(packet_type, start, end, cells)
+            # the open buckets of this tier and the finer ones have not
+            # reached this tier's files yet
+            pending = {}
+            for index in range(tier, -1, -1):
+                current = self.open[index].get(packet_type)
+                if current is None:
+                    continue
+                bucket_start = current[0] // width * width
+                for key, bucket in current[1].items():
+                    merged = pending.get((bucket_start, key or 0))
+                    if merged is None:
+                        merged = _Bucket(bucket_start, key, len(bucket.mins))
+                        pending[(bucket_start, key or 0)] = merged
+                    merged.merge(bucket)
+            for bucket_start, key in sorted(pending):
+                if not start <= bucket_start < end or (
+                        cells is not None and not cells[0] <= key <= cells[1]):
+                    continue
+                rows.append((bucket_start,
+                             pending[(bucket_start, key)].row(record)))
+        return width, rows
+
+    def flush(self):
+        with self.lock:
+            for recorder in self.recorders:
+                recorder.flush()
+
+    def close(self):
+        # open buckets are written as they are, a restart within the same
+        # bucket adds a second row for it
+        with self.lock:
+            for tier in range(len(self.tiers)):
+                for packet_type, current in list(self.open[tier].items()):
+                    self._close(tier, packet_type, current[1])
+                self.open[tier] = {}
+            for recorder in self.recorders:
+                recorder.close()
@@ -0,0 +1,95 @@
+import logging
+import time
+
+import BMS
+
+LOG = logging.getLogger("Scheduler")
+LOG.setLevel(logging.INFO)
+
+class AdaptiveScheduler(object):
+    """AdaptiveScheduler
+    Paces cell sweeps from how the pack is behaving. A sweep with pack
+    amps of at least active_amps, a cell that moved active_volts since the
+    previous sweep or an alert rule within alert_margin of firing brings
+    the interval between sweep starts down to min_interval at once; quiet
+    sweeps grow it by backoff up to max_interval
+    """
+    def __init__(self, min_interval=1.0, max_interval=60.0, active_amps=2.0,
+                 active_volts=0.005, alert_margin=0.05, backoff=2.0,
+                 alerts=None):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.active_amps = active_amps
+        self.active_volts = active_volts
+        self.alert_margin = alert_margin
+        self.backoff = backoff
+        self.alerts = alerts
+        self.assembler = BMS.SnapshotAssembler()
+        self.interval = min_interval
+        self.pack_amps = 0.0
+        # cell index -> volts this sweep and at the end of the last one
+        self.volts = {}
+        self.last_volts = {}
+        self.sweep_started = None
+        self.reason = None
+        self.sweeps = 0
+        self.paused = 0.0
+
+    def _activity(self):
+        if abs(self.pack_amps) >= self.active_amps:
+            return 'amps'
+        for index, volts in self.volts.items():
+            last = self.last_volts.get(index)
+            if last is not None and abs(volts - last) >= self.active_volts:
+                return 'cells'
+        if self.alerts is not None and self.alerts.near(self.alert_margin):
+            return 'alert'
+        return None
+
+    def observe(self, packet, now=None):
+        """observe
+        Track a packet record, returns the seconds to wait before
+        requesting the next packet (0 unless it ended a sweep)
+        """
+        if now is None:
+            now = time.monotonic()
+        if self.sweep_started is None:
+            self.sweep_started = now
+        if packet.type == 'overview':
+            self.pack_amps = packet.pack_amps
+        elif packet.type == 'cell_info':
+            self.volts[packet.cell_index] = packet.cell_volts
+        if not self.assembler.track(packet, now):
+            return 0.0
+        self.sweeps += 1
+        reason = self._activity()
+        if reason is not None:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.max_interval,
+                                self.interval * self.backoff)
+        if reason != self.reason:
+            LOG.info("Sweeping every %.1fs (%s)", self.interval,
+                     reason or 'idle')
+            self.reason = reason
+        self.last_volts = dict(self.volts)
+        delay = self.interval - (now - self.sweep_started)
+        self.sweep_started = now + max(0.0, delay)
+        return max(0.0, delay)
+
+    def pause(self, delay):
+        time.sleep(delay)
+        self.paused += delay
+
+    def rate(self):
+        # sweeps per second at the current interval, back to back sweeps
+        # are counted as 1000 per second
+        return 1.0 / max(self.interval, 0.001)
+
+    def stats(self):
+        return {
+            'interval': self.interval,
+            'sweeps': self.sweeps,
+            'paused': self.paused,
+            'reason': self.reason or 'idle'
+        }
@@ -0,0 +1,248 @@
+import json
+import logging
+import os
+import threading
+import time
+
+import BMS
+
+LOG = logging.getLogger("LiveState")
+LOG.setLevel(logging.INFO)
+
+class Snapshot(object):
+    """Snapshot
+    Immutable view of the battery state at one version. Cells are keyed
+    as ('cells', index) in field_versions, and 'cells' holds the version
+    of the latest change to any cell. A restored snapshot holds values
+    loaded from a checkpoint that no sweep has confirmed yet. timestamp
+    is when the values last changed; received, the time of the last
+    packet, is the one field still updated while the snapshot is current
+    """
+    __slots__ = ('version', 'timestamp', 'info', 'field_versions', 'complete',
+                 'restored', 'received')
+
+    def __init__(self, version, timestamp, info, field_versions, complete,
+                 restored=False, received=None):
+        self.version = version
+        self.timestamp = timestamp
+        self.info = info
+        self.field_versions = field_versions
+        self.complete = complete
+        self.restored = restored
+        self.received = timestamp if received is None else received
+
+    def age(self):
+        # a steady pack sends the same values, they are still fresh
+        return time.time() - self.received
+
+    def version_of(self, fields):
+        """version_of
+        Latest version at which any of the given fields changed
+        """
+        version = 0
+        for field in fields:
+            version = max(version, self.field_versions.get(field, 0))
+        return version
+
+    def changes_since(self, version):
+        """changes_since
+        Return the fields (and cells) that changed after the given version,
+        in the battery_info shape
+        """
+        changes = {}
+        for field, field_version in self.field_versions.items():
+            if field_version <= version or field == 'cells':
+                continue
+            if isinstance(field, tuple):
+                changes.setdefault('cells', {})[field[1]] = \
+                    self.info['cells'][field[1]]
+            else:
+                changes[field] = self.info[field]
+        return changes
+
+def versions_at(info, version):
+    """versions_at
+    field_versions with every field and cell of info at one version
+    """
+    versions = {field: version for field in info}
+    for index in info['cells']:
+        versions[('cells', index)] = version
+    return versions
+
+class LiveState(object):
+    """LiveState
+    Battery state updated incrementally per packet by a single producer.
+    Each update publishes a new Snapshot by swapping one reference, so
+    readers never lock or block the producer
+    """
+    def __init__(self):
+        self.version = 0
+        self.info = {'cells': {}}
+        self.field_versions = {}
+        self.current = Snapshot(0, time.time(), {'cells': {}}, {}, False)
+        self.ready = threading.Event()
+        self.assembler = BMS.SnapshotAssembler(self.info)
+        # whether the last update ended a cell sweep
+        self.sweep_ended = False
+        # the info came from a checkpoint and no sweep has ended since
+        self.restored = False
+
+    def restore(self, snapshot):
+        """restore
+        Start from a checkpointed snapshot. Its values are served, marked
+        restored, until the first full sweep from the BMS
+        """
+        # packets are merged here, the assembler only tracks which fields
+        # and cells the current sweep has seen, so it starts over and the
+        # first full sweep clears the restored mark
+        self.info.clear()
+        self.info.update(snapshot.info)
+        self.info['cells'] = dict(snapshot.info['cells'])
+        self.version = max(self.version, snapshot.version)
+        self.field_versions = versions_at(self.info, self.version)
+        self.restored = True
+        self.current = Snapshot(self.version, snapshot.timestamp,
+                                dict(self.info), dict(self.field_versions),
+                                snapshot.complete, True)
+        if snapshot.complete:
+            self.ready.set()
+
+    def _set(self, field, value, container):
+        key = field[1] if isinstance(field, tuple) else field
+        if key in container and container[key] == value:
+            return False
+        container[key] = value
+        self.field_versions[field] = self.version + 1
+        if key is not field:
+            self.field_versions['cells'] = self.version + 1
+        return True
+
+    def update(self, packet):
+        """update
+        Merge a parsed packet (dict or record) and publish a new snapshot
+        if anything changed. Returns the current version
+        """
+        if not isinstance(packet, dict):
+            packet = packet.to_dict()
+        if packet['type'] == 'invalid':
+            self.sweep_ended = False
+            return self.version
+        self.sweep_ended = self.assembler.track(packet)
+        contents = packet['contents']
+        changed = False
+        if packet['type'] == 'cell_info':
+            cell = {
+                'temp': contents['cell_temp'],
+                'volts': contents['cell_volts']
+            }
+            index = contents['cell_index']
+            if self.info['cells'].get(index) != cell:
+                # copy-on-write, published snapshots keep the old cells dict
+                cells = dict(self.info['cells'])
+                self._set(('cells', index), cell, cells)
+                self.info['cells'] = cells
+                changed = True
+            changed |= self._set(
+                'total_cells', contents['total_cells'], self.info)
+        else:
+            for key, val in contents.items():
+                changed |= self._set(key, val, self.info)
+        # the first full sweep clears the restored mark even if nothing
+        # changed since the checkpoint
+        if changed or (self.restored and self.assembler.complete):
+            self._publish()
+        else:
+            self.current.received = time.time()
+        return self.version
+
+    def _publish(self):
+        self.version += 1
+        complete = self.current.complete or self.assembler.complete
+        if self.assembler.complete:
+            self.restored = False
+        self.current = Snapshot(self.version, time.time(), dict(self.info),
+                                dict(self.field_versions), complete,
+                                self.restored)
+        if complete:
+            self.ready.set()
+
+    def snapshot(self):
+        return self.current
+
+    def wait_ready(self, timeout=None):
+        """wait_ready
+        Block until a snapshot with all battery info has been published
+        """
+        if self.ready.wait(timeout):
+            return self.current
+        return None
+
+class Checkpoint(object):
+    """Checkpoint
+    The latest complete snapshot on disk, so a restart can reply before
+    the BMS answers. Writes go to a temporary file that replaces the
+    checkpoint, a crash leaves either the old or the new one
+    """
+    def __init__(self, path, interval=30.0):
+        self.path = path
+        self.interval = interval
+        self.saved_version = None
+        self.saved_at = None
+        self.saves = 0
+
+    def load(self):
+        """load
+        Return the checkpointed snapshot marked restored, None if there
+        is no readable checkpoint
+        """
+        try:
+            with open(self.path) as myfile:
+                data = json.load(myfile)
+            info = data['info']
+            info['cells'] = {int(index): cell
+                             for index, cell in info['cells'].items()}
+            snapshot = Snapshot(data['version'], data['timestamp'], info,
+                                versions_at(info, data['version']),
+                                data['complete'], True)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            if not isinstance(e, FileNotFoundError):
+                LOG.error("Could not load checkpoint %s: %s", self.path, e)
+            return None
+        LOG.info("Restored snapshot version %d, %.0fs old", snapshot.version,
+                 snapshot.age())
+        self.saved_version = snapshot.version
+        return snapshot
+
+    def save(self, snapshot, force=False):
+        """save
+        Write a complete snapshot unless it is the one last written or,
+        without force, the last write was less than interval seconds ago.
+        Returns True if it was written
+        """
+        if not snapshot.complete or snapshot.restored or \
+                snapshot.version == self.saved_version:
+            return False
+        now = time.monotonic()
+        if not force and self.saved_at is not None and \
+                now - self.saved_at < self.interval:
+            return False
+        data = {
+            'version': snapshot.version,
+            'timestamp': snapshot.timestamp,
+            'complete': snapshot.complete,
+            'info': snapshot.info
+        }
+        tmp_path = self.path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as myfile:
+                json.dump(data, myfile)
+                myfile.flush()
+                os.fsync(myfile.fileno())
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            LOG.error("Could not save checkpoint %s: %s", self.path, e)
+            return False
+        self.saved_version = snapshot.version
+        self.saved_at = now
+        self.saves += 1
+        return True
@@ -0,0 +1,45 @@
+from BMS import CellInfo, Energy
+from alerts import AlertEngine, Rule
+
+def make_engine(*rules):
+    alerts = []
+    return AlertEngine(list(rules), alerts.append), alerts
+
+def test_debounce_and_hysteresis():
+    engine, alerts = make_engine(
+        Rule('cell_high', 'cell_info', 'cell_volts', above=3.6, clear=3.5,
+             debounce=2, cooldown=0, notify_clear=True))
+    engine.evaluate(CellInfo(3, 8, 3.65, 20.0))
+    assert alerts == []
+    engine.evaluate(CellInfo(3, 8, 3.66, 20.0))
+    assert [a.cell for a in alerts] == [3]
+    # inside the hysteresis band, still active
+    engine.evaluate(CellInfo(3, 8, 3.55, 20.0))
+    assert len(alerts) == 1
+    assert [(r.name, c) for r, c in engine.active()] == [('cell_high', 3)]
+    engine.evaluate(CellInfo(3, 8, 3.45, 20.0))
+    assert alerts[-1].cleared
+    assert engine.active() == []
+
+def test_debounce_resets_when_value_recovers():
+    engine, alerts = make_engine(
+        Rule('soc_low', 'energy', 'pack_soc', below=20, debounce=3))
+    for soc in (15, 15, 25, 15, 15):
+        engine.evaluate(Energy(0, 0, 0, soc))
+    assert alerts == []
+    engine.evaluate(Energy(0, 0, 0, 15))
+    assert len(alerts) == 1
+
+def test_cooldown_suppresses_repeats():
+    engine, alerts = make_engine(
+        Rule('soc_low', 'energy', 'pack_soc', below=20, cooldown=3600))
+    for soc in (10, 50, 10):
+        engine.evaluate(Energy(0, 0, 0, soc))
+    assert len(alerts) == 1
+
+def test_only_matching_rules_are_indexed():
+    engine, alerts = make_engine(
+        Rule('cell_high', 'cell_info', 'cell_volts', above=3.6))
+    assert engine.evaluate(Energy(0, 0, 0, 5)) == []
+    assert engine.evaluated == 0
+    assert 'energy' not in engine.index
@@ -0,0 +1,57 @@
+import numpy as np
+
+from analytics import CellHistory
+
+def info(volts, amps=0.0, temp=20.0):
+    return {
+        'cells': {index + 1: {'volts': v, 'temp': temp}
+                  for index, v in enumerate(volts)},
+        'total_cells': len(volts),
+        'pack_amps': amps
+    }
+
+def test_samples_land_in_the_cell_rows():
+    history = CellHistory(max_cells=4, samples=8)
+    history.add_sample(info([3.30, 3.31, 3.32]), timestamp=100.0)
+    assert history.total_cells == 3 and history.count == 1
+    mean, std, temp = history.cell_stats()
+    assert np.allclose(mean, [3.30, 3.31, 3.32])
+    assert np.allclose(std, 0.0) and np.allclose(temp, 20.0)
+    assert history.timestamps[0] == 100.0
+
+def test_out_of_range_cells_are_dropped():
+    history = CellHistory(max_cells=4, samples=8)
+    sample = info([3.30, 3.31, 3.32, 3.33])
+    # index 0 would wrap to the last row, 5 is past max_cells
+    sample['cells'][0] = {'volts': 9.9, 'temp': 99.0}
+    sample['cells'][5] = {'volts': 9.9, 'temp': 99.0}
+    history.add_sample(sample)
+    assert np.allclose(history.volts[:, 0], [3.30, 3.31, 3.32, 3.33])
+    assert np.allclose(history.temps[:, 0], 20.0)
+
+def test_window_covers_the_latest_samples():
+    history = CellHistory(max_cells=2, samples=4)
+    for step in range(6):
+        history.add_sample(info([3.0 + step / 10, 3.0]))
+    assert history.count == 4
+    # wrapped, oldest first
+    assert np.allclose(history.imbalance(), [0.2, 0.3, 0.4, 0.5])
+    assert np.allclose(history.imbalance(window=2), [0.4, 0.5])
+    assert np.allclose(history.cell_stats(window=2)[0], [3.45, 3.0])
+
+def test_summary():
+    history = CellHistory(max_cells=4, samples=16)
+    assert history.summary() is None
+    for step in range(10):
+        amps = float(step)
+        # cell 3 sits low and sags 10 milliohms under load
+        history.add_sample(info([3.30, 3.30, 3.25 - 0.01 * amps, 3.30],
+                                amps=amps))
+    summary = history.summary()
+    assert summary['samples'] == 10
+    assert list(summary['drifting_cells']) == [3]
+    assert summary['drifting_cells'][3] < -0.02
+    assert np.isclose(summary['spread_volts'], 0.14)
+    assert np.isclose(summary['max_spread_volts'], 0.14)
+    assert np.allclose(summary['resistance_ohms'], [0.0, 0.0, 0.01, 0.0])
+    assert history.summary(window=3)['samples'] == 3
@@ -0,0 +1,71 @@
+import pytest
+
+import BMS
+from transport import sample_frames
+
+def sweep(cells):
+    return [BMS.decode_packet(frame) for frame in sample_frames(cells)]
+
+@pytest.mark.parametrize('cells', [4, 16, 64, 256])
+def test_complete_after_one_sweep(cells):
+    packets = sweep(cells)
+    assembler = BMS.SnapshotAssembler()
+    ended = [assembler.add(packet) for packet in packets]
+    assert ended == [False] * (len(packets) - 1) + [True]
+    assert assembler.complete
+    assert BMS.has_all_battery_info(assembler.info)
+    assert assembler.missing() == ([], [])
+
+def test_last_cell_is_required():
+    assembler = BMS.SnapshotAssembler()
+    for packet in sweep(4)[:-1]:
+        assembler.add(packet)
+    assert not assembler.complete
+    assert not BMS.has_all_battery_info(assembler.info)
+    assert assembler.missing() == ([], [4])
+
+def test_records_and_dicts_agree():
+    by_record = BMS.SnapshotAssembler()
+    by_dict = BMS.SnapshotAssembler()
+    for packet in sweep(8):
+        by_record.track(packet)
+        by_dict.track(packet.to_dict())
+    assert by_record.complete and by_dict.complete
+    assert by_record.fields_seen == by_dict.fields_seen
+
+def test_sweep_boundaries():
+    assembler = BMS.SnapshotAssembler()
+    packets = sweep(4)
+    cells = [p for p in packets if p.type == 'cell_info']
+    for packet in packets + packets:
+        assembler.add(packet)
+    assert assembler.sweeps == 2
+    # a dropped cell makes the sweep partial, the next one starts over
+    for packet in cells[:2] + cells:
+        assembler.add(packet)
+    assert assembler.partial_sweeps == 1
+    assert assembler.sweeps == 3
+
+def test_cell_count_change_resets_missing_cells():
+    assembler = BMS.SnapshotAssembler()
+    for packet in sweep(4):
+        assembler.add(packet)
+    assembler.add(BMS.CellInfo(1, 6, 3.3, 20.0))
+    assert not assembler.complete
+    assert assembler.missing() == ([], [5, 6])
+
+def test_field_age():
+    assembler = BMS.SnapshotAssembler()
+    assert assembler.field_age('pack_soc') is None
+    for packet in sweep(4):
+        assembler.track(packet, timestamp=100.0)
+    assert assembler.field_age('pack_soc', now=102.5) == 2.5
+    assert assembler.field_age(3, now=101.0) == 1.0
+
+def test_cell_index_zero_is_rejected():
+    assert BMS.decode_packet(b'C_00_04_0298_127_00').type == 'invalid'
+    assembler = BMS.SnapshotAssembler()
+    assert not assembler.track(BMS.CellInfo(0, 4, 3.3, 20.0))
+    for packet in sweep(4):
+        assembler.add(packet)
+    assert assembler.complete and assembler.partial_sweeps == 0
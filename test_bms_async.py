@@ -0,0 +1,122 @@
+import asyncio
+
+import pygatt
+
+from BMS import AsyncSmartBMS
+from transport import FakeAdapter, sample_frames
+
+def run(coro):
+    return asyncio.run(coro)
+
+def test_connect_retries_until_connected():
+    async def scenario():
+        bms = AsyncSmartBMS(adapter=FakeAdapter(connect_failures=2))
+        resp = await bms.connect(timeout=1, retry_delay=0)
+        await bms.close()
+        return resp
+    assert run(scenario()) == bytearray(b'OK\r')
+
+def test_connect_gives_up_after_attempts():
+    async def scenario():
+        bms = AsyncSmartBMS(adapter=FakeAdapter(connect_failures=5))
+        return await bms.connect(timeout=1, retry_delay=0, attempts=2)
+    assert run(scenario()) is None
+
+def test_stream_yields_full_sweep():
+    frames = sample_frames(total_cells=4)
+
+    async def scenario():
+        bms = AsyncSmartBMS(adapter=FakeAdapter(frames=frames))
+        await bms.connect(timeout=1)
+        packets = []
+        stream = bms.stream(timeout=1)
+        async for packet in stream:
+            packets.append(packet)
+            if len(packets) == len(frames):
+                break
+        await stream.aclose()
+        await bms.close()
+        return packets
+
+    packets = run(scenario())
+    types = [p['type'] for p in packets]
+    assert types == ['overview', 'min_max_temp', 'energy', 'power',
+                     'min_max_volts'] + ['cell_info'] * 4
+    assert packets[-1]['contents']['cell_index'] == 4
+    assert packets[-1]['contents']['total_cells'] == 4
+
+def test_send_command_times_out_without_response():
+    async def scenario():
+        adapter = FakeAdapter()
+        bms = AsyncSmartBMS(adapter=adapter)
+        await bms.connect(timeout=1)
+        adapter.devices[bms.address].callbacks.clear()
+        return await bms.send_command("E!\r", timeout=0.2)
+    assert run(scenario()) is None
+
+def test_del_disconnects_outside_the_loop():
+    async def scenario():
+        adapter = FakeAdapter()
+        adapter.start()
+        bms = AsyncSmartBMS(adapter=adapter)
+        await bms.connect(timeout=1)
+        return adapter, bms
+    adapter, bms = run(scenario())
+    # the fake device keeps the client alive, run what collection would
+    bms.__del__()
+    assert not adapter.devices[bms.address].connected
+    # the adapter was passed in, it stays up for other clients
+    assert adapter.started
+
+def test_handles_are_kept_across_connections():
+    async def scenario():
+        adapter = FakeAdapter()
+        bms = AsyncSmartBMS(adapter=adapter)
+        await bms.connect(timeout=1)
+        bms.disconnect()
+        await bms.connect(timeout=1)
+        device = adapter.devices[bms.address]
+        await bms.close()
+        return device
+    # the GATT table is read once, as SmartBMS does
+    assert run(scenario()).handle_lookups == 0
+
+def test_failed_mode_write_disconnects():
+    class NoModeWrites(FakeAdapter):
+        def connect(self, address, timeout=5):
+            device = FakeAdapter.connect(self, address, timeout)
+            def refuse(*args, **kwargs):
+                raise pygatt.exceptions.NotificationTimeout()
+            device.char_write_handle = refuse
+            return device
+
+    async def scenario():
+        adapter = NoModeWrites()
+        bms = AsyncSmartBMS(adapter=adapter)
+        resp = await bms.connect(timeout=1)
+        return resp, bms.device, adapter.devices[bms.address]
+    resp, device, fake = run(scenario())
+    assert resp is None and device is None
+    assert not fake.connected
+
+def test_no_stop_command_after_a_failed_write():
+    frames = sample_frames(total_cells=4)
+
+    async def scenario():
+        adapter = FakeAdapter(frames=frames)
+        bms = AsyncSmartBMS(adapter=adapter)
+        await bms.connect(timeout=1)
+        device = adapter.devices[bms.address]
+        stream = bms.stream(timeout=0.5)
+        packets = []
+        async for packet in stream:
+            packets.append(packet)
+            if len(packets) == 2:
+                device.disconnect()
+                writes = bms.writes
+        await stream.aclose()
+        return packets, bms.writes - writes
+    packets, writes = run(scenario())
+    assert len(packets) == 2
+    # the stream ended on the failed flush, D! was not tried
+    assert writes == 1
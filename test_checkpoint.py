@@ -0,0 +1,115 @@
+import os
+import subprocess
+import sys
+import time
+import types
+
+import BMS
+from commands import default_registry
+from compact import decode_report
+from exporter import internal_metrics
+from main import BatteryMonitor
+from state import Checkpoint, LiveState
+from transport import sample_frames
+from workers import SnapshotRing
+
+def test_save_and_load(tmp_path, live_state):
+    path = str(tmp_path / 'checkpoint.json')
+    checkpoint = Checkpoint(path, interval=3600)
+    assert checkpoint.load() is None
+    state = live_state()
+    snapshot = state.snapshot()
+    assert checkpoint.save(snapshot)
+    assert os.listdir(str(tmp_path)) == ['checkpoint.json']
+    # unchanged, then within the interval
+    assert not checkpoint.save(snapshot)
+    state.update(BMS.CellInfo(1, 4, 3.4, 20.0))
+    assert not checkpoint.save(state.snapshot())
+    assert checkpoint.save(state.snapshot(), force=True)
+
+    restored = Checkpoint(path).load()
+    assert restored.restored and restored.complete
+    assert restored.version == state.version
+    assert restored.info == state.snapshot().info
+    assert restored.version_of(['cells']) == state.version
+    # restored snapshots are already on disk
+    assert not Checkpoint(path).save(restored)
+
+    with open(path, 'w') as myfile:
+        myfile.write('{"version": 3, "info"')
+    assert Checkpoint(path).load() is None
+
+def test_restored_until_the_first_sweep(tmp_path, live_state):
+    path = str(tmp_path / 'checkpoint.json')
+    old = live_state()
+    Checkpoint(path).save(old.snapshot())
+
+    state = LiveState()
+    state.restore(Checkpoint(path).load())
+    snapshot = state.wait_ready(timeout=0)
+    assert snapshot.restored and snapshot.version == old.version
+    frames = sample_frames(4)
+    # the same values as the checkpoint, the last frame ends the sweep
+    for frame in frames[:-1]:
+        state.update(BMS.decode_packet(frame))
+        assert state.snapshot().restored
+    state.update(BMS.decode_packet(frames[-1]))
+    snapshot = state.snapshot()
+    assert not snapshot.restored and snapshot.version == old.version + 1
+    assert snapshot.info == old.snapshot().info
+
+def test_replies_show_the_checkpoint_age(tmp_path, live_state):
+    path = str(tmp_path / 'checkpoint.json')
+    state = live_state(16)
+    Checkpoint(path).save(state.snapshot())
+    restored = Checkpoint(path).load()
+    restored.timestamp = restored.received = time.time() - 300
+    registry = default_registry(max_segments=1)
+    fresh = registry.reply("overview", state.snapshot())
+    assert registry.reply("overview", restored) == fresh + " (saved 5m ago)"
+    # the suffix is not cached
+    assert registry.reply("overview", state.snapshot()) == fresh
+    report = decode_report(registry.reply("cells", restored))
+    assert report.cells == {index: round(cell['volts'], 3) for index, cell in
+                            state.snapshot().info['cells'].items()}
+
+def test_ring_carries_the_restored_flag(tmp_path, live_state):
+    path = str(tmp_path / 'checkpoint.json')
+    Checkpoint(path).save(live_state().snapshot())
+    ring = SnapshotRing.create(slots=2, max_cells=8)
+    try:
+        ring.write(Checkpoint(path).load())
+        snapshot = ring.read()[0]
+        assert snapshot.restored and snapshot.complete
+        ring.write(live_state().snapshot())
+        assert not ring.read()[0].restored
+    finally:
+        ring.close()
+
+def test_startup_metrics():
+    text = internal_metrics(startup={'restored': 0.0421, 'snapshot': None,
+                                     'reply': 0.35})
+    assert 'bms_startup_seconds{stage="reply"} 0.350\n' in text
+    assert 'bms_startup_seconds{stage="restored"} 0.042\n' in text
+    assert 'stage="snapshot"' not in text
+
+def test_ble_and_serial_are_imported_on_first_use():
+    out = subprocess.check_output([
+        sys.executable, '-c',
+        'import sys, main; '
+        'print(sorted(m for m in sys.modules '
+        'if m.startswith(("pygatt.", "serial.", "asyncio."))))'],
+        cwd=os.path.dirname(os.path.abspath(__file__)))
+    assert out.strip() == b'[]'
+
+def test_partial_one_shot_info_is_not_checkpointed(tmp_path, live_state):
+    monitor = types.SimpleNamespace(
+        restored=None, has_all_battery_info=BMS.has_all_battery_info)
+    info = live_state().snapshot().info
+    partial = dict(info, cells={1: info['cells'][1]})
+    checkpoint = Checkpoint(str(tmp_path / 'checkpoint.json'))
+    snapshot = BatteryMonitor.one_shot_snapshot(monitor, partial)
+    assert not snapshot.complete
+    assert not checkpoint.save(snapshot)
+    snapshot = BatteryMonitor.one_shot_snapshot(monitor, info)
+    assert snapshot.complete and checkpoint.save(snapshot)
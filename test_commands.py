@@ -0,0 +1,27 @@
+import BMS
+from commands import default_registry
+
+def test_dispatch(live_state):
+    snapshot = live_state().snapshot()
+    registry = default_registry()
+    assert registry.reply("Overview ", snapshot).startswith("13.3V")
+    assert registry.reply("cells", snapshot).startswith("Cell Volts:")
+    assert registry.reply("cell 3", snapshot) == "Cell 3: 3.315V 22.4C"
+    assert registry.reply("foo", snapshot).endswith(
+        ". Commands: overview, cells, temperature, cell N")
+
+def test_replies_are_cached_until_their_fields_change(live_state):
+    state = live_state()
+    registry = default_registry()
+    first = registry.reply("cells", state.snapshot())
+    assert registry.reply("cells", state.snapshot()) is first
+    assert (registry.hits, registry.misses) == (1, 1)
+
+    # a change to a field the template does not use keeps the cache
+    state.update(BMS.Energy(1.5, 4.2, 2.7, 90))
+    assert registry.reply("cells", state.snapshot()) is first
+    assert registry.misses == 1
+
+    state.update(BMS.CellInfo(2, 4, 3.5, 20.0))
+    assert registry.reply("cells", state.snapshot()) != first
+    assert registry.misses == 2
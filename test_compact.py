@@ -0,0 +1,112 @@
+import random
+
+import pytest
+
+import BMS
+from SMS import split_message
+from commands import default_registry, format_cells, format_temperature
+from compact import decode_report, encode_cells, plan_report, summarize_cells
+from state import LiveState
+from transport import sample_frames
+
+def pack(cells, seed=0, spread=0.040):
+    rng = random.Random(seed)
+    info = {'cells': {}}
+    for index in range(1, cells + 1):
+        # runs of equal cells are common on a balanced pack
+        volts = 3.300
+        if index % 4 == 0:
+            volts = round(volts + rng.uniform(0, spread), 3)
+        info['cells'][index] = {'volts': volts,
+                                'temp': round(rng.uniform(18.0, 24.0), 1)}
+    values = list(info['cells'].values())
+    for key, name in (('volts', 'volt'), ('temp', 'temp')):
+        info['min_' + name + '_cell'] = min(values, key=lambda c: c[key])
+        info['max_' + name + '_cell'] = max(values, key=lambda c: c[key])
+    return info
+
+@pytest.mark.parametrize('cells', [4, 16, 64, 128, 256])
+@pytest.mark.parametrize('kind', ['volts', 'temp'])
+def test_compact_round_trip(cells, kind):
+    info = pack(cells, seed=cells)
+    encoded = encode_cells(info, kind)
+    report = decode_report(encoded)
+    assert (report.kind, report.format, report.complete) == \
+        (kind, 'compact', True)
+    assert report.cells == {index: cell[kind]
+                            for index, cell in info['cells'].items()}
+    # still decodes after being split into SMS parts
+    assert decode_report(split_message(encoded)).cells == report.cells
+
+@pytest.mark.parametrize('cells', [4, 16, 64, 128, 256])
+def test_compact_is_smaller(cells):
+    info = pack(cells)
+    assert len(encode_cells(info)) < len(format_cells(info)) / 3
+    assert len(encode_cells(info, 'temp')) < \
+        len(format_temperature(info)) / 2
+
+def test_large_deltas_and_runs():
+    info = pack(200, spread=0.0)
+    info['cells'][7]['volts'] = 4.2
+    info['cells'][9]['temp'] = -12.5
+    encoded = encode_cells(info)
+    assert encoded.count('*') >= 2 and '.' in encoded[6:]
+    assert decode_report(encoded).cells[7] == 4.2
+    assert len(decode_report(encoded).cells) == 200
+    assert decode_report(encode_cells(info, 'temp')).cells[9] == -12.5
+
+def test_summary_fits_and_lists_outliers():
+    info = pack(256, spread=0.0)
+    info['cells'][5]['volts'] = 3.350
+    info['cells'][200]['volts'] = 3.250
+    summary = summarize_cells(info)
+    assert summary.startswith("Cell Volts 256: 3.250-3.350V med 3.300V")
+    report = decode_report(summary)
+    assert report.cells == {5: 3.35, 200: 3.25}
+    assert not report.complete
+
+    for index in range(1, 257):
+        info['cells'][index]['volts'] = 3.0 + index / 1000.0
+    summary = summarize_cells(info, limit=160)
+    assert len(summary) <= 160 and summary.endswith(")")
+
+@pytest.mark.parametrize('cells', [4, 16, 64, 128, 256])
+def test_plan_picks_most_detailed_format_that_fits(cells):
+    info = pack(cells, seed=1)
+    for segments in (1, 2, 4):
+        body = plan_report(format_cells(info), info, 'volts', segments)
+        assert len(split_message(body)) <= segments
+        report = decode_report(body)
+        if len(split_message(format_cells(info))) <= segments:
+            assert report.format == 'plain'
+        elif len(split_message(encode_cells(info))) <= segments:
+            assert report.format == 'compact'
+        else:
+            assert report.format == 'summary'
+    assert decode_report(plan_report(format_cells(info), info)).kind == \
+        'volts'
+
+@pytest.mark.parametrize('cells', [128, 256])
+def test_summary_fits_the_segment_budget(cells):
+    # word breaks leave each part short of the budget
+    for seed in range(20):
+        info = pack(cells, seed=seed, spread=0.5)
+        for index in info['cells']:
+            info['cells'][index]['volts'] = round(
+                3.0 + random.Random(seed * 1000 + index).uniform(0, 0.5), 3)
+        for max_segments in range(2, 7):
+            body = plan_report(format_cells(info), info, 'volts', max_segments)
+            assert len(split_message(body)) <= max_segments
+
+def test_registry_fits_replies():
+    state = LiveState()
+    for frame in sample_frames(64):
+        state.update(BMS.decode_packet(frame))
+    registry = default_registry(max_segments=1)
+    reply = registry.reply("cells", state.snapshot())
+    assert len(split_message(reply)) == 1
+    assert decode_report(reply).cells == {
+        index: round(cell['volts'], 3)
+        for index, cell in state.snapshot().info['cells'].items()}
+    assert decode_report(registry.reply("temperature", state.snapshot())) \
+        .complete
@@ -0,0 +1,53 @@
+import pytest
+
+import BMS
+from benchmark import LegacyParser
+from transport import sample_frames
+
+FRAMES = [
+    b'U_0A50_0014_0028_0000\r',
+    b'U_XXXX_0014_XXXX_0000\r',
+    b'T_0120_0003_0130_0010\r',
+    b'T_XXX_XX_12B_02\r',
+    b'E_03E8_1388_07D0_0050\r',
+    b'E_XXXX_1388_XXXX_0050\r',
+    b'M_0064_00C8_0012:002D\r',
+    b'M_0064_00C8_XX:XX\r',
+    b'M_XXXX_00C8_0012:XX\r',
+    b'V_029A_0002_02A8_0007_0004\r',
+    b'V_XXXX_XXXX_02A8_0007_XXXX\r',
+    b'C_01_10_029E_127_00\r',
+    b'C_10_10_XXXX_XXX_00\r',
+    b'C_11_10_029E_127_00\r',
+    b'Q_0001_0002\r',
+    b'U_0001_0002\r',
+] + sample_frames(4)
+
+@pytest.mark.parametrize('frame', FRAMES)
+def test_matches_the_legacy_parser(frame):
+    # the legacy parser was fed the bytearrays of the receive buffer
+    legacy = LegacyParser._parse_packet(bytearray(frame))
+    for data in (frame, bytearray(frame), memoryview(frame)):
+        packet = BMS.decode_packet(data).to_dict()
+        if legacy['type'] == 'invalid':
+            # the message shows the fields, bytes rather than bytearrays
+            assert packet['type'] == 'invalid'
+        else:
+            assert packet == legacy
+
+@pytest.mark.parametrize('frame', [
+    b'U_ZZZZ_0000_0014_0014\r',
+    b'T_01G0_0003_0130_0010\r',
+    b'M_0064_00C8_0012\r',
+    b'M_0064_00C8_12:3:4\r',
+    b'C_01_10_02\xff9E_127_00\r',
+    b'V_029A__02A8_0007_0004\r',
+])
+def test_corrupt_frames_are_invalid(frame):
+    packet = BMS.decode_packet(frame)
+    assert packet.type == 'invalid'
+    assert packet.to_dict()['contents']['message'].startswith('Corrupt')
+
+def test_cell_index_zero_is_invalid():
+    # the legacy parser took cell 0, it has no place in a sweep
+    assert BMS.decode_packet(b'C_00_10_029E_127_00\r').type == 'invalid'
@@ -0,0 +1,73 @@
+import json
+import time
+import urllib.request
+
+import BMS
+from exporter import MetricsServer, SnapshotRenderer
+
+def test_metrics_text(live_state):
+    text = SnapshotRenderer().metrics(live_state().snapshot())
+    assert "# TYPE bms_pack_voltage_volts gauge\n" in text
+    assert 'bms_cell_volts{cell="3"} 3.315\n' in text
+    assert text.count("# TYPE bms_cell_volts gauge") == 1
+
+def test_only_changed_fields_are_rendered_again(live_state):
+    state = live_state()
+    renderer = SnapshotRenderer()
+    renderer.metrics(state.snapshot())
+    before = dict(renderer.cache)
+    state.update(BMS.CellInfo(2, 4, 3.5, 20.0))
+    text = renderer.metrics(state.snapshot())
+    changed = [key for key in before if renderer.cache[key] is not before[key]]
+    assert sorted(changed) == [('prom', 'temp', 2), ('prom', 'volts', 2)]
+    assert 'bms_cell_volts{cell="2"} 3.5\n' in text
+
+def test_json_matches_snapshot(live_state):
+    snapshot = live_state().snapshot()
+    renderer = SnapshotRenderer()
+    data = json.loads(renderer.json(snapshot))
+    assert data['version'] == snapshot.version
+    assert data['info']['pack_soc'] == snapshot.info['pack_soc']
+    assert data['info']['cells']['3'] == snapshot.info['cells'][3]
+
+def test_server(live_state):
+    state = live_state()
+
+    class Monitor(object):
+        live_state = state
+
+    server = MetricsServer(Monitor(), port=0, host='127.0.0.1')
+    server.start()
+    try:
+        base = "http://127.0.0.1:%d" % server.port
+        with urllib.request.urlopen(base + "/metrics") as reply:
+            assert b"bms_pack_soc_percent" in reply.read()
+        with urllib.request.urlopen(base + "/snapshot.json") as reply:
+            assert json.load(reply)['complete']
+    finally:
+        server.stop()
+
+def test_history_endpoint(tmp_path, live_state):
+    from recorder import Rollups
+
+    state = live_state()
+
+    class Monitor(object):
+        live_state = state
+        rollups = Rollups(str(tmp_path))
+
+    now = time.time()
+    for i in range(360):
+        Monitor.rollups.add(BMS.Overview(13.2, 0.0, 1.0, 1.0),
+                            now - 3600 + i * 10)
+    server = MetricsServer(Monitor(), port=0, host='127.0.0.1')
+    server.start()
+    try:
+        url = "http://127.0.0.1:%d/history.json?seconds=3600&rows=4" % \
+            server.port
+        with urllib.request.urlopen(url) as reply:
+            data = json.load(reply)
+        assert data['resolution'] == 900
+        assert sum(row['count'] for row in data['rows']) == 360
+    finally:
+        server.stop()
@@ -0,0 +1,72 @@
+import threading
+import time
+
+from BMS import FrameBuffer
+
+def test_frame_split_across_chunks():
+    buf = FrameBuffer()
+    assert not buf.append(b'U_05')
+    assert not buf.append(b'30_0000')
+    assert buf.get_nowait() is None
+    assert buf.append(b'_0014_0014\r')
+    assert buf.get_nowait() == bytearray(b'U_0530_0000_0014_0014\r')
+    assert buf.get_nowait() is None
+
+def test_several_frames_in_one_chunk():
+    seen = []
+    buf = FrameBuffer(listener=lambda: seen.append(buf.depth()))
+    assert buf.append(b'OK\rE!\rC_01')
+    # one wake up per chunk, with every completed frame queued
+    assert seen == [2]
+    assert buf.get_nowait() == bytearray(b'OK\r')
+    assert buf.get_nowait() == bytearray(b'E!\r')
+    buf.append(b'_02\r')
+    assert buf.get_nowait() == bytearray(b'C_01_02\r')
+
+def test_get_times_out_at_the_deadline():
+    buf = FrameBuffer()
+    start = time.monotonic()
+    assert buf.get(timeout=0.2) is None
+    assert 0.2 <= time.monotonic() - start < 0.5
+
+def test_get_wakes_on_a_frame():
+    buf = FrameBuffer()
+    threading.Timer(0.1, buf.append, args=(b'OK\r',)).start()
+    start = time.monotonic()
+    # a chunk without a terminator does not wake the reader
+    buf.append(b'partial')
+    assert buf.get(timeout=2) == bytearray(b'partialOK\r')
+    assert time.monotonic() - start < 1.0
+    threading.Timer(0.1, buf.append, args=(b'E!\r',)).start()
+    # no timeout waits until there is a frame
+    assert buf.get() == bytearray(b'E!\r')
+
+def test_clear_drops_frames_and_partial_data():
+    buf = FrameBuffer()
+    buf.append(b'OK\rhalf')
+    buf.clear()
+    assert buf.depth() == 0
+    buf.append(b'E!\r')
+    assert buf.get_nowait() == bytearray(b'E!\r')
+
+def test_stats():
+    buf = FrameBuffer()
+    assert buf.stats() == {
+        'frames_received': 0, 'frames_read': 0, 'queue_depth': 0,
+        'max_queue_depth': 0, 'last_latency': None, 'mean_latency': None,
+        'max_latency': 0.0
+    }
+    # latency counts from the first chunk of a frame
+    buf.append(b'O')
+    time.sleep(0.05)
+    buf.append(b'K\rA\rB\r')
+    time.sleep(0.05)
+    buf.get_nowait()
+    stats = buf.stats()
+    assert stats['frames_received'] == 3 and stats['frames_read'] == 1
+    assert stats['queue_depth'] == 2 and stats['max_queue_depth'] == 3
+    assert stats['last_latency'] >= 0.1
+    buf.get_nowait()
+    stats = buf.stats()
+    assert 0.05 <= stats['last_latency'] < stats['max_latency']
+    assert stats['last_latency'] < stats['mean_latency'] < stats['max_latency']
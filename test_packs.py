@@ -0,0 +1,78 @@
+import asyncio
+
+from packs import PackMonitor, load_packs
+from transport import FakeAdapter, sample_frames
+
+PACKS = [("pack%d" % i, "00:00:00:00:00:%02X" % i) for i in range(3)]
+
+def test_load_packs(tmp_path):
+    path = tmp_path / 'packs.txt'
+    path.write_text("# house bank\n00:00:00:00:00:01 front\n\n"
+                    "00:00:00:00:00:02  # no name\n")
+    assert load_packs(str(path)) == [('front', '00:00:00:00:00:01'),
+                                     ('00:00:00:00:00:02',
+                                      '00:00:00:00:00:02')]
+
+def test_every_pack_is_swept():
+    for concurrency in (1, 3):
+        adapter = FakeAdapter(frames=sample_frames(4))
+        monitor = PackMonitor(PACKS, adapter, concurrency=concurrency,
+                              timeout=1)
+
+        async def scenario():
+            swept = await monitor.poll_once()
+            connected = [s.bms is not None for s in monitor.states]
+            swept += await monitor.poll_once()
+            await monitor.close()
+            return swept, connected
+
+        swept, connected = asyncio.run(scenario())
+        assert swept == 6
+        # packs only stay connected when the adapter is not shared
+        assert connected == [concurrency == 3] * 3
+        assert sorted(adapter.devices) == sorted(a for n, a in PACKS)
+        snapshot = monitor.snapshot()
+        assert sorted(snapshot) == ['pack0', 'pack1', 'pack2']
+        for pack in snapshot.values():
+            assert pack['sweeps'] == 2 and not pack['stale']
+            assert len(pack['info']['cells']) == 4
+
+def test_failed_pack_backs_off():
+    adapter = FakeAdapter(frames=sample_frames(4), connect_failures=1)
+    monitor = PackMonitor(PACKS, adapter, concurrency=1, timeout=1,
+                          backoff_base=60.0)
+
+    async def scenario():
+        first = await monitor.poll_once()
+        second = await monitor.poll_once()
+        await monitor.close()
+        return first, second
+
+    # the first pack takes the refused connection and sits out a round
+    assert asyncio.run(scenario()) == (2, 2)
+    snapshot = monitor.snapshot()
+    assert snapshot['pack0']['failures'] == 1
+    assert snapshot['pack0']['info'] is None and snapshot['pack0']['stale']
+    assert snapshot['pack1']['sweeps'] == 2
+
+def test_run_reports_each_round():
+    adapter = FakeAdapter(frames=sample_frames(4))
+    monitor = PackMonitor(PACKS, adapter, concurrency=3, timeout=1)
+    rounds = []
+
+    async def scenario():
+        done = asyncio.Event()
+
+        def on_round(monitor):
+            rounds.append(sum(p['sweeps']
+                              for p in monitor.snapshot().values()))
+            if len(rounds) == 2:
+                done.set()
+
+        task = asyncio.ensure_future(monitor.run(on_round=on_round))
+        await done.wait()
+        task.cancel()
+        await monitor.close()
+
+    asyncio.run(scenario())
+    assert rounds == [3, 6]
@@ -0,0 +1,68 @@
+import pytest
+
+from BMS import SmartBMS
+from transport import FakeAdapter, sample_frames
+
+def sweep_counts(pipeline, sweeps=3, cells=8, latency=0.0):
+    frames = sample_frames(cells)
+    adapter = FakeAdapter(frames=frames, latency=latency)
+    bms = SmartBMS(adapter=adapter, pipeline=pipeline)
+    assert bms.initialize(timeout=1) is not None
+    device = adapter.devices[bms.address]
+    stream = bms.get_battery_info(timeout=1, records=True)
+    # start counting once cell data is on and the pipeline is full
+    packets = [next(stream)]
+    writes, round_trips = device.writes, device.round_trips
+    lookups = device.handle_lookups
+    for i, packet in zip(range(len(frames) * sweeps), stream):
+        packets.append(packet)
+    counts = {
+        'writes': (device.writes - writes) / sweeps,
+        'round_trips': (device.round_trips - round_trips) / sweeps,
+        'lookups': device.handle_lookups - lookups,
+        'bms_writes': bms.writes,
+        'bms_round_trips': bms.round_trips
+    }
+    stream.close()
+    bms.close()
+    return packets, counts, len(frames)
+
+def test_handles_are_looked_up_once_per_connection():
+    frames = sample_frames(4)
+    adapter = FakeAdapter(frames=frames)
+    bms = SmartBMS(adapter=adapter)
+    bms.initialize(timeout=1)
+    first = adapter.devices[bms.address].handle_lookups
+    stream = bms.get_battery_info(timeout=1)
+    for i, packet in zip(range(len(frames) * 2), stream):
+        pass
+    stream.close()
+    assert adapter.devices[bms.address].handle_lookups == first
+    # the GATT table does not change, a reconnect reuses the handles
+    bms.disconnect()
+    assert bms.resume(timeout=1)
+    assert adapter.devices[bms.address].handle_lookups == 0
+    bms.close()
+
+def test_one_round_trip_per_packet_without_pipelining():
+    packets, counts, frames = sweep_counts(pipeline=0)
+    assert counts['writes'] == frames
+    assert counts['round_trips'] == frames
+    assert counts['lookups'] == 0
+
+@pytest.mark.parametrize('pipeline', [1, 4, 16])
+def test_pipelined_flushes_are_not_acknowledged(pipeline):
+    packets, counts, frames = sweep_counts(pipeline=pipeline)
+    # one request per packet, none waits for a write response
+    assert counts['writes'] == frames
+    assert counts['round_trips'] == 0
+    assert counts['lookups'] == 0
+    assert counts['bms_round_trips'] < counts['bms_writes']
+    assert packets == sweep_counts(pipeline=0)[0]
+
+def test_pipelined_packets_keep_their_order_with_latency():
+    expected = sweep_counts(pipeline=0, sweeps=2)[0]
+    packets, counts, frames = sweep_counts(pipeline=4, sweeps=2,
+                                           latency=0.002)
+    assert packets == expected
+    assert counts['round_trips'] == 0
@@ -0,0 +1,213 @@
+import json
+import socket
+import socketserver
+import threading
+import time
+
+import BMS
+from exporter import internal_metrics
+from publisher import DeltaEncoder, DiskBuffer, MqttPublisher
+
+class Broker(object):
+    """Broker
+    Loopback MQTT 3.1.1 broker that accepts connections, acknowledges
+    QoS 1 publishes and records them as (topic, payload, retain)
+    """
+    def __init__(self, port=0):
+        self.messages = []
+        self.connections = []
+        broker = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                broker.connections.append(self.request)
+                try:
+                    broker.serve(self.request)
+                except OSError:
+                    pass
+
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        self.server = socketserver.ThreadingTCPServer(('127.0.0.1', port),
+                                                      Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    @staticmethod
+    def _read(sock, count):
+        data = b''
+        while len(data) < count:
+            chunk = sock.recv(count - len(data))
+            if not chunk:
+                raise OSError("closed")
+            data += chunk
+        return data
+
+    def serve(self, sock):
+        while True:
+            header = self._read(sock, 1)[0]
+            length, shift = 0, 0
+            while True:
+                byte = self._read(sock, 1)[0]
+                length += (byte & 0x7f) << shift
+                shift += 7
+                if not byte & 0x80:
+                    break
+            body = self._read(sock, length)
+            kind = header >> 4
+            if kind == 1:
+                sock.sendall(b'\x20\x02\x00\x00')
+            elif kind == 3:
+                topic_length = int.from_bytes(body[:2], 'big')
+                topic = body[2:2 + topic_length].decode()
+                rest = body[2 + topic_length:]
+                if (header >> 1) & 3:
+                    sock.sendall(b'\x40\x02' + rest[:2])
+                    rest = rest[2:]
+                self.messages.append((topic, json.loads(rest), header & 1))
+            elif kind == 12:
+                sock.sendall(b'\xd0\x00')
+            elif kind == 14:
+                return
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        for sock in self.connections:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+def wait_for(condition, timeout=10.0):
+    end = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < end
+        time.sleep(0.02)
+
+def test_delta_encoder_deadbands(live_state):
+    state = live_state()
+    encoder = DeltaEncoder()
+    full = encoder.full(state.snapshot())
+    assert set(full['cells']) == {'1', '2', '3', '4'}
+    assert encoder.delta(state.snapshot()) == {}
+
+    # below the cell and pack voltage deadbands
+    cell = state.snapshot().info['cells'][2]
+    state.update(BMS.CellInfo(2, 4, cell['volts'] + 0.001, cell['temp']))
+    overview = BMS.Overview(13.28, 0.0, 1.0, 1.0)
+    state.update(overview)
+    assert encoder.delta(state.snapshot()) == {}
+
+    # drift adds up against the last published value
+    state.update(BMS.CellInfo(2, 4, cell['volts'] + 0.002, cell['temp']))
+    state.update(overview._replace(pack_voltage=13.4, pack_amps=-2.0))
+    delta = encoder.delta(state.snapshot())
+    assert delta == {'pack_voltage': 13.4, 'pack_amps': -2.0,
+                     'cells': {'2': [round(cell['volts'] + 0.002, 3),
+                                     round(cell['temp'], 3)]}}
+
+def test_disk_buffer_is_bounded(tmpdir):
+    path = str(tmpdir.join('buffer'))
+    buffer = DiskBuffer(path, max_bytes=2000)
+    for index in range(200):
+        buffer.append('bms/pack/delta', '{"n":%d}' % index)
+        assert buffer.size <= 2000
+    pending = buffer.pending()
+    assert buffer.dropped > 0 and len(pending) == buffer.count
+    assert pending[-1] == ('bms/pack/delta', '{"n":199}', False)
+    # survives a restart
+    assert DiskBuffer(path).count == buffer.count
+
+def test_publishes_batched_deltas(live_state):
+    broker = Broker()
+    state = live_state(16)
+    publisher = MqttPublisher(state, '127.0.0.1', broker.port,
+                              interval=3600)
+    with publisher:
+        wait_for(publisher.connected.is_set)
+        assert publisher.publish_once() == 1
+        wait_for(lambda: len(broker.messages) == 1)
+        topic, payload, retain = broker.messages[0]
+        assert (topic, retain) == ('bms/pack/state', 1)
+        assert len(payload['info']['cells']) == 16
+
+        # nothing moved, nothing sent
+        assert publisher.publish_once() == 0
+        for index in range(1, 9):
+            state.update(BMS.CellInfo(index, 16, 3.5, 25.0))
+        assert publisher.publish_once() == 1
+        wait_for(lambda: len(broker.messages) == 2)
+        topic, payload, retain = broker.messages[1]
+        assert (topic, retain) == ('bms/pack/delta', 0)
+        assert sorted(payload['info']['cells'], key=int) == \
+            [str(index) for index in range(1, 9)]
+        assert publisher.stats()['messages'] == 2
+        assert "mqtt_messages_total 2\n" in internal_metrics(
+            publisher=publisher)
+    broker.stop()
+
+def test_buffers_offline_and_replays_on_reconnect(tmpdir, live_state):
+    broker = Broker()
+    port = broker.port
+    state = live_state()
+    publisher = MqttPublisher(state, '127.0.0.1', port, interval=3600,
+                              buffer_path=str(tmpdir.join('buffer')),
+                              reconnect_max=1)
+    with publisher:
+        wait_for(publisher.connected.is_set)
+        publisher.publish_once()
+        wait_for(lambda: len(broker.messages) == 1)
+        broker.stop()
+        wait_for(lambda: not publisher.connected.is_set())
+
+        for volts in (3.4, 3.5, 3.6):
+            state.update(BMS.CellInfo(1, 4, volts, 20.0))
+            assert publisher.publish_once() == 1
+        assert publisher.stats()['buffered'] == 3
+
+        broker = Broker(port)
+        wait_for(publisher.connected.is_set)
+        publisher.publish_once()
+        wait_for(lambda: len(broker.messages) == 4)
+        assert [m[0] for m in broker.messages] == ['bms/pack/delta'] * 3 + \
+            ['bms/pack/state']
+        assert [m[1]['info']['cells']['1'][0] for m in broker.messages] == \
+            [3.4, 3.5, 3.6, 3.6]
+        assert publisher.stats()['buffered'] == 0
+    broker.stop()
+
+def test_replays_more_than_the_client_queue(tmpdir, live_state):
+    broker = Broker()
+    port = broker.port
+    state = live_state()
+    publisher = MqttPublisher(state, '127.0.0.1', port, interval=3600,
+                              buffer_path=str(tmpdir.join('buffer')),
+                              reconnect_max=1)
+    with publisher:
+        wait_for(publisher.connected.is_set)
+        publisher.publish_once()
+        wait_for(lambda: len(broker.messages) == 1)
+        broker.stop()
+        wait_for(lambda: not publisher.connected.is_set())
+
+        count = 200
+        for index in range(count):
+            state.update(BMS.CellInfo(1, 4, 3.0 + index * 0.01, 20.0))
+            publisher.publish_once()
+        assert publisher.stats()['buffered'] == count
+
+        broker = Broker(port)
+        wait_for(publisher.connected.is_set)
+        # a change while the backlog is out waits for the keyframe
+        state.update(BMS.CellInfo(2, 4, 3.9, 20.0))
+        publisher.publish_once()
+        wait_for(lambda: len(broker.messages) == count + 1)
+        assert [m[0] for m in broker.messages] == \
+            ['bms/pack/delta'] * count + ['bms/pack/state']
+        assert [m[1]['info']['cells']['1'][0] for m in broker.messages] == \
+            [round(3.0 + index * 0.01, 3) for index in range(count)] + \
+            [round(3.0 + (count - 1) * 0.01, 3)]
+        assert broker.messages[-1][1]['info']['cells']['2'][0] == 3.9
+        assert publisher.stats()['buffered'] == 0
+    broker.stop()
@@ -0,0 +1,64 @@
+import os
+
+import BMS
+from recorder import RECORD_FORMATS, Recorder
+
+def overview(volts):
+    return BMS.Overview(volts, 0.0, 1.0, 1.0)
+
+def test_records_round_trip(tmp_path):
+    recorder = Recorder(str(tmp_path), segment_seconds=60)
+    for t in range(0, 180, 10):
+        recorder.record(overview(13.0 + t / 1000.0), t)
+    recorder.record(BMS.CellInfo(2, 4, 3.3, 20.0), 5)
+    rows = recorder.query('overview', 50, 130)
+    assert [t for t, r in rows] == list(range(50, 130, 10))
+    assert abs(rows[0][1].pack_voltage - 13.05) < 1e-6
+    assert len(recorder.segments('overview')) == 3
+    assert recorder.query('cell_info', cells=(1, 1)) == []
+    assert recorder.query('cell_info', cells=(2, 2))[0][1].cell_index == 2
+    recorder.close()
+
+def test_partial_record_is_dropped_on_open(tmp_path):
+    recorder = Recorder(str(tmp_path), segment_seconds=3600)
+    for t in range(3):
+        recorder.record(overview(13.0), t)
+    recorder.close()
+    path = recorder.segments('overview')[0][1]
+    with open(path, 'ab') as myfile:
+        myfile.write(b'\x01\x02\x03')
+
+    recorder = Recorder(str(tmp_path), segment_seconds=3600)
+    recorder.record(overview(13.5), 3)
+    recorder.close()
+    size = RECORD_FORMATS['overview'][1].size
+    assert os.path.getsize(path) == 4 * size
+    rows = recorder.query('overview')
+    assert [t for t, r in rows] == [0, 1, 2, 3]
+    assert abs(rows[-1][1].pack_voltage - 13.5) < 1e-6
+
+def test_timestamps_stay_sorted_when_the_clock_steps_back(tmp_path):
+    recorder = Recorder(str(tmp_path), segment_seconds=3600)
+    for t in (100, 110, 50, 60, 120):
+        recorder.record(overview(13.0), t)
+    recorder.close()
+    # also across a restart
+    recorder = Recorder(str(tmp_path), segment_seconds=3600)
+    recorder.record(overview(13.0), 30)
+    recorder.close()
+    rows = recorder.query('overview')
+    assert [t for t, r in rows] == [100, 110, 110, 110, 120, 120]
+    assert [t for t, r in recorder.query('overview', 110, 111)] == \
+        [110, 110, 110]
+
+def test_retention(tmp_path):
+    for keep, kept in ((None, 5), (2, 2), (0, 1)):
+        path = str(tmp_path / str(keep))
+        recorder = Recorder(path, segment_seconds=60, max_segments=keep)
+        for t in range(0, 300, 30):
+            recorder.record(overview(13.0), t)
+        recorder.close()
+        segments = recorder.segments('overview')
+        assert len(segments) == kept
+        # the newest segment is the one kept
+        assert segments[-1][0] == 240
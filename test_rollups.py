@@ -0,0 +1,80 @@
+import os
+import threading
+import time
+
+import BMS
+from commands import default_registry
+from recorder import Recorder, Rollups
+from state import LiveState
+
+TIERS = [('1m', 60, 3600, 2), ('15m', 900, 86400, 2), ('1h', 3600, 86400, 2)]
+
+def feed(rollups, start, seconds, step=10):
+    values = []
+    t = start
+    while t < start + seconds:
+        volts = 13.0 + (t % 600) / 600.0
+        rollups.add(BMS.Overview(volts, 0.0, 1.0, 1.0), t)
+        rollups.add(BMS.CellInfo(1, 2, volts / 4, 20.0), t)
+        values.append((t, volts))
+        t += step
+    return values
+
+def test_tiers_aggregate_raw_samples(tmp_path):
+    rollups = Rollups(str(tmp_path), tiers=TIERS)
+    values = feed(rollups, 7200, 7200)
+    for resolution, width in ((60, 60), (899, 60), (900, 900), (10 ** 6, 3600)):
+        bucket, rows = rollups.query('overview', 0, float('inf'), resolution)
+        assert bucket == width
+        assert sum(r.count for t, r in rows) == len(values)
+        first = [v for t, v in values if t < rows[0][0] + width]
+        assert abs(rows[0][1].pack_voltage_mean - sum(first) / len(first)) < 1e-4
+        assert abs(rows[0][1].pack_voltage_max - max(first)) < 1e-4
+        assert abs(rows[0][1].pack_voltage_last - first[-1]) < 1e-4
+    assert rollups.query('overview', 0, float('inf'), 30) is None
+    bucket, rows = rollups.query('cell_info', 0, float('inf'), 3600,
+                                 cells=(1, 1))
+    assert [r.cell_index for t, r in rows] == [1, 1]
+    rollups.close()
+
+def test_retention_per_tier(tmp_path):
+    rollups = Rollups(str(tmp_path), tiers=TIERS)
+    feed(rollups, 0, 5 * 3600, step=60)
+    rollups.close()
+    assert len(rollups.recorders[0].segments('overview')) == 2
+    assert len(rollups.recorders[2].segments('overview')) == 1
+
+def test_history_reply_reads_rollups(tmp_path):
+    recorder = Recorder(os.path.join(str(tmp_path), 'raw'))
+    rollups = Rollups(os.path.join(str(tmp_path), 'rollups'))
+    now = time.time()
+    for i in range(7 * 24 * 6):
+        t = now - 7 * 86400 + i * 600
+        rollups.add(BMS.Overview(13.2, 0.0, -2.0, 2.0), t)
+        rollups.add(BMS.Energy(1.0, 2.0, 3.0, 80), t)
+    registry = default_registry(recorder=recorder, rollups=rollups)
+    reply = registry.reply("history 7d", LiveState().snapshot())
+    assert reply == "History 7d: 13.2-13.2V, -2.0--2.0A, SOC 80-80% " \
+                    "(1008 samples)"
+
+def test_query_while_recording(tmp_path):
+    recorder = Recorder(str(tmp_path), segment_seconds=60, flush_every=4)
+    count = 20000
+    errors = []
+
+    def record():
+        try:
+            for i in range(count):
+                recorder.record(BMS.Overview(13.0, 0.0, 1.0, 1.0), 1000.0 + i)
+        except Exception as e:
+            errors.append(e)
+
+    writer = threading.Thread(target=record)
+    writer.start()
+    while writer.is_alive():
+        recorder.query('overview')
+    writer.join()
+    assert not errors
+    rows = recorder.query('overview')
+    assert [t for t, r in rows] == [1000.0 + i for i in range(count)]
+    recorder.close()
@@ -0,0 +1,85 @@
+import time
+
+import BMS
+from alerts import AlertEngine, Rule
+from exporter import internal_metrics
+from scheduler import AdaptiveScheduler
+from transport import FakeAdapter, sample_frames
+
+def sweep(scheduler, now, cells=4, amps=None, volts=None):
+    # feeds one sweep, returns the delay after its last packet
+    delays = []
+    for frame in sample_frames(cells):
+        packet = BMS.decode_packet(frame)
+        if amps is not None and packet.type == 'overview':
+            packet = packet._replace(pack_amps=amps)
+        if volts is not None and packet.type == 'cell_info' and \
+                packet.cell_index == 2:
+            packet = packet._replace(cell_volts=volts)
+        delays.append(scheduler.observe(packet, now))
+    assert not any(delays[:-1])
+    return delays[-1]
+
+def test_backs_off_while_idle_and_snaps_back_on_activity():
+    scheduler = AdaptiveScheduler(min_interval=1.0, max_interval=16.0)
+    now = 0.0
+    delays = []
+    for i in range(7):
+        delay = sweep(scheduler, now)
+        delays.append(delay)
+        now += delay
+    assert scheduler.interval == 16.0
+    assert delays == [2.0, 4.0, 8.0, 16.0, 16.0, 16.0, 16.0]
+
+    # charge current
+    assert sweep(scheduler, now, amps=-10.0) == 1.0
+    assert scheduler.stats()['reason'] == 'amps'
+    now += 1.0
+    assert sweep(scheduler, now) == 2.0
+    now += 2.0
+    # a cell moving between sweeps
+    sweep(scheduler, now, volts=3.4)
+    assert (scheduler.interval, scheduler.reason) == (1.0, 'cells')
+
+def test_sweep_time_counts_towards_the_interval():
+    scheduler = AdaptiveScheduler(min_interval=5.0, max_interval=5.0)
+    sweep(scheduler, 0.0)
+    # the next sweep starts at 5s and takes 3s
+    assert sweep(scheduler, 8.0) == 2.0
+    # a sweep slower than the interval is not paused after
+    assert sweep(scheduler, 20.0) == 0.0
+
+def test_near_alert_keeps_sampling_fast():
+    rule = Rule('high volts', 'cell_info', 'cell_volts', above=3.5)
+    alerts = AlertEngine([rule], lambda alert: None)
+    scheduler = AdaptiveScheduler(min_interval=1.0, max_interval=60.0,
+                                  alerts=alerts, alert_margin=0.01)
+    alerts.evaluate(BMS.CellInfo(1, 4, 3.3, 20.0))
+    assert not alerts.near(0.01)
+    sweep(scheduler, 0.0)
+    sweep(scheduler, 1.0)
+    assert scheduler.interval == 4.0
+    alerts.evaluate(BMS.CellInfo(1, 4, 3.47, 20.0))
+    assert alerts.near(0.01) and not alerts.near(0.001)
+    sweep(scheduler, 2.0)
+    assert (scheduler.interval, scheduler.reason) == (1.0, 'alert')
+    # and while it is firing
+    alerts.evaluate(BMS.CellInfo(1, 4, 3.6, 20.0))
+    assert alerts.near(0.0)
+
+def test_stream_is_paced():
+    frames = sample_frames(total_cells=4)
+    scheduler = AdaptiveScheduler(min_interval=0.2, max_interval=0.2)
+    with BMS.SmartBMS(adapter=FakeAdapter(frames=frames)) as bms:
+        bms.initialize(timeout=1)
+        stream = bms.get_battery_info(timeout=1, records=True,
+                                      scheduler=scheduler)
+        start = time.monotonic()
+        packets = [p for i, p in zip(range(3 * len(frames)), stream)]
+        elapsed = time.monotonic() - start
+        stream.close()
+    # the pause comes when the packet after a sweep is asked for
+    assert len(packets) == 3 * len(frames)
+    assert scheduler.sweeps == 2 and elapsed >= 0.35
+    assert 'bms_sweep_interval_seconds 0.200\n' in internal_metrics(
+        scheduler=scheduler)
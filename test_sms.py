@@ -0,0 +1,283 @@
+import os
+import threading
+import time
+import tty
+
+import pytest
+
+from SMS import (ATEngine, INIT_COMMAND, OutboundQueue, PRIORITY_HIGH,
+                 PRIORITY_LOW, SixFabSMS, split_message)
+
+class FakeModem(threading.Thread):
+    """FakeModem
+    Answers AT commands on the master side of a pty. replies maps a
+    command to a list of (delay, text) chunks and AT+CMGS prompts for a
+    body
+    """
+    def __init__(self, replies):
+        threading.Thread.__init__(self, daemon=True)
+        self.replies = replies
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.path = os.ttyname(self.slave)
+        self.received = []
+        self.bodies = []
+        self.running = True
+
+    def _write(self, text):
+        os.write(self.master, text.encode())
+
+    def run(self):
+        buf = b''
+        in_body = False
+        while self.running:
+            try:
+                buf += os.read(self.master, 1024)
+            except OSError:
+                return
+            while True:
+                end = buf.find(b'\x1a' if in_body else b'\r')
+                if end < 0:
+                    break
+                cmd = buf[:end].decode()
+                buf = buf[end + 1:]
+                if in_body:
+                    self.bodies.append(cmd)
+                    in_body = False
+                    self._write(cmd + '\x1a\r\n+CMGS: 7\r\n\r\nOK\r\n')
+                    continue
+                if len(cmd) == 0:
+                    continue
+                self.received.append(cmd)
+                self._write(cmd + '\r')
+                if cmd.startswith('AT+CMGS'):
+                    in_body = True
+                    self._write('\r\n> ')
+                    continue
+                for delay, text in self.replies.get(cmd, [(0, '\r\nOK\r\n')]):
+                    time.sleep(delay)
+                    self._write(text)
+
+    def close(self):
+        self.running = False
+        os.close(self.master)
+
+@pytest.fixture
+def modem_factory(tmp_path):
+    modems = []
+    whitelist = os.path.join(str(tmp_path), 'whitelist.txt')
+    with open(whitelist, 'w') as myfile:
+        myfile.write('+15551234567\n')
+
+    def make(replies=None):
+        modem = FakeModem(replies or {})
+        modem.start()
+        modems.append(modem)
+        return modem, SixFabSMS(whitelist, port=modem.path)
+
+    yield make
+    for modem in modems:
+        modem.close()
+
+def test_waits_for_slow_final_result(modem_factory):
+    # the final result code arrives separately, after the data
+    modem, sms = modem_factory({
+        'AT+CSQ': [(0.1, '\r\n+CSQ: 20,99\r\n'), (0.2, '\r\nOK\r\n')]
+    })
+    resp = sms.at.send('AT+CSQ')
+    assert resp.ok
+    assert 0.3 <= resp.elapsed < 1.5
+    assert sms.get_rssi() == -73
+
+def test_error_result_codes(modem_factory):
+    modem, sms = modem_factory({
+        'AT+CMGD=4': [(0, '\r\n+CMS ERROR: 321\r\n')],
+        'AT+BAD': [(0, '\r\nERROR\r\n')]
+    })
+    assert not sms.delete_message('4')
+    resp = sms.at.send('AT+BAD')
+    assert resp.final == 'ERROR'
+    assert resp.elapsed < 1.0
+
+def test_deadline_without_reply(modem_factory):
+    modem, sms = modem_factory({'AT+SLOW': []})
+    resp = sms.at.send('AT+SLOW', timeout=0.3)
+    assert resp.final is None
+    assert 0.3 <= resp.elapsed < 1.0
+
+def test_late_reply_is_not_taken_by_the_next_command(modem_factory):
+    modem, sms = modem_factory({
+        'AT+SLOW': [(0.5, '\r\nERROR\r\n')],
+        'AT+CSQ': [(0, '\r\n+CSQ: 20,99\r\n\r\nOK\r\n')]
+    })
+    assert sms.at.send('AT+SLOW', timeout=0.2).final is None
+    resp = sms.at.send('AT+CSQ')
+    assert resp.ok and '+CSQ: 20,99' in resp.raw
+    # and the commands after it are paired with their own replies
+    assert sms.get_rssi() == -73
+
+def test_timed_out_command_that_never_answers(modem_factory):
+    modem, sms = modem_factory({'AT+SLOW': []})
+    assert sms.at.send('AT+SLOW', timeout=0.2).final is None
+    resp = sms.at.send('AT')
+    assert resp.ok and resp.elapsed < 1.0
+
+def test_message_bodies_are_data(modem_factory):
+    header = '+CMGL: %d,"REC UNREAD","+15551234567",,"26/10/17,12:00:00+00"'
+    modem, sms = modem_factory({
+        'AT+CMGL="ALL"': [(0, '\r\n' + header % 1 + '\r\nOK\r\n' +
+                           header % 2 + '\r\nRING me\r\n' +
+                           header % 3 + '\r\nRDY\r\n\r\nOK\r\n')],
+        'AT+CMGR=4': [(0, '\r\n+CMGR: "REC UNREAD","+15551234567","",'
+                         '"26/10/17,12:00:00+00"\r\nOK\r\n\r\nOK\r\n')]
+    })
+    seen = []
+    sms.at.add_urc_handler('RING', seen.append)
+    messages = sms.get_messages()
+    assert [m['message'] for m in messages] == ['OK', 'RING me', 'RDY']
+    assert sms.read_message('4')['message'] == 'OK'
+    assert seen == []
+    # the real OK did not leak into the next command
+    resp = sms.at.send('AT+CSQ')
+    assert resp.ok and resp.raw.strip() == 'OK'
+
+def test_unsolicited_codes_are_dispatched(modem_factory):
+    modem, sms = modem_factory({
+        'AT': [(0, '\r\n+CMTI: "SM",3\r\n\r\nOK\r\n')]
+    })
+    seen = []
+    sms.at.add_urc_handler('+CMTI:', seen.append)
+    resp = sms.at.send('AT')
+    assert resp.ok
+    assert resp.raw == '\r\nOK\r\n'
+    assert seen == ['+CMTI: "SM",3']
+
+def test_send_message_waits_for_prompt(modem_factory):
+    modem, sms = modem_factory()
+    assert sms.send_message('+15551234567', 'hello')
+    assert modem.received[-1] == 'AT+CMGS="+15551234567"'
+    assert modem.bodies == ['hello']
+
+def test_send_async(modem_factory):
+    import asyncio
+    modem, sms = modem_factory({'ATI': [(0.1, '\r\nQuectel\r\n\r\nOK\r\n')]})
+    resp = asyncio.run(sms.at.send_async('ATI'))
+    assert resp.ok
+    assert 'Quectel' in resp.raw
+
+def test_new_message_indication_reads_only_new_index(modem_factory):
+    modem, sms = modem_factory({
+        'AT+CMGR=5': [(0, '\r\n+CMGR: "REC UNREAD","+15551234567","",'
+                         '"26/10/17,12:00:00+00"\r\nCells\r\n\r\nOK\r\n')]
+    })
+    assert sms.enable_new_message_indications()
+    threading.Timer(0.2, modem._write,
+                    args=('\r\n+CMTI: "SM",5\r\n',)).start()
+    start = time.monotonic()
+    messages = sms.wait_for_messages(timeout=5)
+    assert time.monotonic() - start < 1.0
+    assert messages == [{
+        'index': '5',
+        'status': 'REC UNREAD',
+        'number': '+15551234567',
+        'timestamp': '26/10/17,12:00:00+00',
+        'message': 'Cells'
+    }]
+    assert 'AT+CMGL="ALL"' not in modem.received
+
+class RecordingSender(object):
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.sent = []
+
+    def send_message(self, number, message):
+        if self.failures > 0:
+            self.failures -= 1
+            return False
+        self.sent.append((number, message))
+        return True
+
+def test_split_message():
+    assert split_message("short") == ["short"]
+    parts = split_message(" ".join(["3.330"] * 64))
+    assert len(parts) == 3
+    assert all(len(p) <= 160 for p in parts)
+    assert parts[0].startswith("(1/3) ") and parts[2].startswith("(3/3) ")
+
+def test_outbox_priority_and_dedupe():
+    sender = RecordingSender()
+    outbox = OutboundQueue(sender)
+    assert outbox.enqueue('+1', 'low', priority=PRIORITY_LOW)
+    assert outbox.enqueue('+1', 'normal')
+    assert not outbox.enqueue('+1', 'normal')
+    assert outbox.enqueue('+1', 'high', priority=PRIORITY_HIGH)
+    assert outbox.process() == 3
+    assert [m for n, m in sender.sent] == ['high', 'normal', 'low']
+    assert outbox.stats()['deduplicated'] == 1
+    assert outbox.depth() == 0
+
+def test_outbox_rate_limit():
+    sender = RecordingSender()
+    outbox = OutboundQueue(sender, rate_count=2, rate_period=60)
+    for i in range(3):
+        outbox.enqueue('+1', 'reply %d' % i)
+    outbox.enqueue('+2', 'other')
+    assert outbox.process() == 3
+    assert outbox.depth() == 1
+    assert 59 < outbox.seconds_until_due() <= 60
+
+def test_outbox_retries_with_backoff_and_persists(tmp_path):
+    path = os.path.join(str(tmp_path), 'outbox.json')
+    sender = RecordingSender(failures=1)
+    outbox = OutboundQueue(sender, path=path, backoff_base=0.2)
+    outbox.enqueue('+1', 'hello')
+    assert outbox.process() == 0
+    assert outbox.stats()['failed'] == 1
+    assert 0 < outbox.seconds_until_due() <= 0.2
+
+    # a restart keeps the pending message
+    restarted = OutboundQueue(sender, path=path, backoff_base=0.2)
+    assert restarted.depth() == 1
+    time.sleep(0.25)
+    assert restarted.process() == 1
+    assert sender.sent == [('+1', 'hello')]
+    assert OutboundQueue(sender, path=path).depth() == 0
+
+@pytest.mark.parametrize('saved', [
+    '[{"seq": 0, "number": "+1", "bo',
+    '{"seq": 0}',
+    '[{"seq": 0, "priority": 1, "number": "+1"}]',
+    '[3]',
+    '',
+])
+def test_bad_outbox_is_moved_aside(tmp_path, saved):
+    path = os.path.join(str(tmp_path), 'outbox.json')
+    with open(path, 'w') as myfile:
+        myfile.write(saved)
+    sender = RecordingSender()
+    outbox = OutboundQueue(sender, path=path)
+    assert outbox.depth() == 0
+    assert not os.path.exists(path)
+    with open(path + '.bad') as myfile:
+        assert myfile.read() == saved
+    # and the queue works, saving a fresh outbox
+    outbox.enqueue('+1', 'hello')
+    assert outbox.process() == 1
+    assert OutboundQueue(sender, path=path).depth() == 0
+
+def test_initialize_in_one_round_trip(modem_factory):
+    # a bare ctrl-z gets no reply
+    modem, sms = modem_factory({'\x1a': []})
+    assert sms.initialize()
+    assert modem.received[-1] == INIT_COMMAND
+    # modems that refuse the command line get one command at a time
+    modem, sms = modem_factory({'\x1a': [],
+                                INIT_COMMAND: [(0, '\r\nERROR\r\n')]})
+    assert sms.initialize()
+    assert modem.received[-4:] == ['AT&F', 'AT+CPMS="SM","SM","SM"',
+                                   'AT+CMGF=1', 'ATI']
+    # and still fail when the modem does not identify itself
+    modem, sms = modem_factory({'\x1a': [],
+                                INIT_COMMAND: [(0, '\r\nERROR\r\n')],
+                                'ATI': [(0, '\r\nERROR\r\n')]})
+    assert not sms.initialize()
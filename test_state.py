@@ -0,0 +1,56 @@
+import time
+
+import BMS
+from state import LiveState
+from transport import sample_frames
+from workers import RingState, SnapshotRing
+
+def test_snapshots_are_published_per_change():
+    state = LiveState()
+    assert state.wait_ready(timeout=0) is None
+    for frame in sample_frames(4):
+        state.update(BMS.decode_packet(frame))
+    first = state.wait_ready(timeout=0)
+    assert first.complete
+    version = state.update(BMS.CellInfo(2, 4, 3.4, 20.0))
+    second = state.snapshot()
+    assert version == second.version == first.version + 1
+    # the earlier snapshot is unchanged
+    assert first.info['cells'][2]['volts'] != 3.4
+    assert second.info['cells'][2] == {'temp': 20.0, 'volts': 3.4}
+    assert second.changes_since(first.version) == {
+        'cells': {2: {'temp': 20.0, 'volts': 3.4}}}
+    assert second.version_of(['pack_voltage']) < second.version
+
+def test_unchanged_packets_do_not_copy_cells(live_state):
+    state = live_state()
+    cells = state.info['cells']
+    snapshot = state.snapshot()
+    for frame in sample_frames(4):
+        state.update(BMS.decode_packet(frame))
+    assert state.info['cells'] is cells
+    assert state.snapshot() is snapshot
+
+def test_age_counts_from_the_last_packet(live_state):
+    state = live_state()
+    snapshot = state.snapshot()
+    snapshot.timestamp = snapshot.received = time.time() - 3600
+    assert snapshot.age() > 3599
+    # the same values again
+    state.update(BMS.decode_packet(sample_frames(4)[0]))
+    assert state.snapshot() is snapshot
+    assert snapshot.age() < 1 and time.time() - snapshot.timestamp > 3599
+
+def test_ring_readers_see_the_last_packet(live_state):
+    state = live_state()
+    ring = SnapshotRing.create(slots=2, max_cells=8)
+    try:
+        snapshot = state.snapshot()
+        snapshot.timestamp = snapshot.received = time.time() - 3600
+        ring.write(snapshot)
+        reader = RingState(ring)
+        assert reader.snapshot().age() > 3599
+        ring.touch(time.time())
+        assert reader.snapshot().age() < 1
+    finally:
+        ring.close()
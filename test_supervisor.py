@@ -0,0 +1,58 @@
+from BMS import ConnectionSupervisor, SmartBMS, backoff_delay
+from transport import FakeAdapter, sample_frames
+
+def take(stream, count):
+    return [packet for i, packet in zip(range(count), stream)]
+
+def test_backoff_delay_is_bounded():
+    for failures in range(1, 20):
+        delay = backoff_delay(failures, base=0.1, cap=2.0)
+        ceiling = min(2.0, 0.1 * 2 ** (failures - 1))
+        assert ceiling / 2 <= delay <= ceiling
+
+def test_resumes_session_after_drop():
+    frames = sample_frames(total_cells=4)
+    adapter = FakeAdapter(frames=frames, connect_failures=1)
+    with ConnectionSupervisor(SmartBMS(adapter=adapter), backoff_min=0,
+                              stale_after=1) as supervisor:
+        stream = supervisor.stream(timeout=1)
+        take(stream, len(frames))
+        first = adapter.devices[supervisor.bms.address]
+        first.disconnect()
+        packets = take(stream, len(frames))
+        second = adapter.devices[supervisor.bms.address]
+        assert second is not first
+        assert len(packets) == len(frames)
+        # cached handles and no second initialization
+        assert second.handle_lookups == 0
+        assert second.writes < len(frames) + 10
+        assert supervisor.reconnects == 1
+        assert supervisor.reconnect_latency.count == 1
+        stream.close()
+
+def test_stale_subscription_is_renewed_without_reconnect():
+    frames = sample_frames(total_cells=4)
+    adapter = FakeAdapter(frames=frames)
+    with ConnectionSupervisor(SmartBMS(adapter=adapter),
+                              stale_after=0.2) as supervisor:
+        stream = supervisor.stream(timeout=1)
+        take(stream, len(frames))
+        adapter.devices[supervisor.bms.address].callbacks.clear()
+        packets = take(stream, len(frames))
+        assert len(packets) == len(frames)
+        assert supervisor.resubscribes == 1
+        assert supervisor.bms.connects == 1
+        stream.close()
+
+def test_heartbeat_while_reconnecting():
+    frames = sample_frames(total_cells=4)
+    adapter = FakeAdapter(frames=frames, connect_failures=3)
+    beats = []
+    with ConnectionSupervisor(SmartBMS(adapter=adapter), backoff_min=0,
+                              backoff_max=0,
+                              heartbeat=lambda: beats.append(1)) as supervisor:
+        stream = supervisor.stream(timeout=1)
+        assert len(take(stream, len(frames))) == len(frames)
+        # one beat per connection attempt
+        assert len(beats) == 4
+        stream.close()
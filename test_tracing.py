@@ -0,0 +1,86 @@
+import json
+import os
+import signal
+
+import pytest
+
+import tracing
+from BMS import SmartBMS
+from exporter import trace_metrics
+from tracing import TRACER, Tracer, traced
+from transport import FakeAdapter, sample_frames
+
+@pytest.fixture
+def tracer():
+    TRACER.clear()
+    TRACER.enable(True)
+    yield TRACER
+    TRACER.enable(False)
+    TRACER.clear()
+
+@traced('test.add', lambda a, b: str(a))
+def add(a, b):
+    return a + b
+
+def test_spans_only_while_enabled():
+    TRACER.clear()
+    assert add(1, 2) == 3
+    assert TRACER.recorded == 0
+    TRACER.enable(True)
+    try:
+        assert add(1, 2) == 3
+    finally:
+        TRACER.enable(False)
+    (name, start, duration, thread, detail), = TRACER.recent()
+    assert (name, detail) == ('test.add', '1') and duration >= 0
+    assert TRACER.summary()['test.add'][0] == 1
+    TRACER.clear()
+
+def test_ring_keeps_the_newest_spans():
+    tracer = Tracer(size=8)
+    for index in range(20):
+        tracer.record('op', index, index + 1, str(index))
+    spans = tracer.recent()
+    assert [span[4] for span in spans] == [str(i) for i in range(12, 20)]
+    # histograms count every span, not just those still in the ring
+    assert tracer.histograms['op'].count == 20
+
+def test_bms_spans_and_chrome_trace(tracer, tmp_path):
+    frames = sample_frames(total_cells=4)
+    with SmartBMS(adapter=FakeAdapter(frames=frames)) as bms:
+        assert bms.initialize(timeout=1) is not None
+        stream = bms.get_battery_info(timeout=1, records=True)
+        assert len(list(zip(range(len(frames)), stream))) == len(frames)
+        stream.close()
+    names = set(span[0] for span in tracer.recent())
+    assert {'bms.connect', 'bms.command', 'bms.wait', 'bms.parse'} <= names
+    commands = [span[4] for span in tracer.recent()
+                if span[0] == 'bms.command']
+    assert commands[:2] == ['D!', 'E!']
+
+    path = tracer.dump(str(tmp_path / 'trace.json'))
+    with open(path) as myfile:
+        events = json.load(myfile)['traceEvents']
+    assert len(events) == len(tracer.recent())
+    assert all(e['ph'] == 'X' and e['dur'] >= 0 for e in events)
+    assert 'bms_span_seconds_count{op="bms.parse"} %d\n' % \
+        tracer.histograms['bms.parse'].count in trace_metrics(tracer)
+
+def test_signal_toggles_and_dumps(tmp_path):
+    path = str(tmp_path / 'trace.json')
+    previous = signal.getsignal(signal.SIGUSR1)
+    try:
+        tracing.install(path)
+        assert not TRACER.enabled
+        os.kill(os.getpid(), signal.SIGUSR1)
+        assert TRACER.enabled
+        add(2, 3)
+        os.kill(os.getpid(), signal.SIGUSR1)
+        assert not TRACER.enabled
+        with open(path) as myfile:
+            assert [e['name'] for e in json.load(myfile)['traceEvents']] == \
+                ['test.add']
+    finally:
+        signal.signal(signal.SIGUSR1, previous)
+        TRACER.enable(False)
+        TRACER.clear()
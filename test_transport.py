@@ -0,0 +1,53 @@
+import os
+
+from BMS import SmartBMS
+from transport import (FakeAdapter, RecordingAdapter, ReplayAdapter,
+                       load_capture, sample_frames)
+
+def read_packets(adapter, count):
+    bms = SmartBMS(adapter=adapter)
+    assert bms.initialize(timeout=1) is not None
+    stream = bms.get_battery_info(timeout=1)
+    packets = [p for i, p in zip(range(count), stream)]
+    stream.close()
+    bms.close()
+    return packets
+
+def test_replay_matches_recording(tmp_path):
+    frames = sample_frames(total_cells=6)
+    capture_path = os.path.join(str(tmp_path), 'capture.jsonl')
+    recording = RecordingAdapter(FakeAdapter(frames=frames), capture_path)
+    recorded = read_packets(recording, len(frames) * 2)
+    recording.stop()
+
+    events = load_capture(capture_path)
+    assert any(e['event'] == 'write' for e in events)
+    assert any(e['event'] == 'notify' for e in events)
+
+    replayed = read_packets(ReplayAdapter(capture_path), len(frames) * 2)
+    assert replayed == recorded
+
+def test_replay_repeats_capture(tmp_path):
+    frames = sample_frames(total_cells=4)
+    capture_path = os.path.join(str(tmp_path), 'capture.jsonl')
+    recording = RecordingAdapter(FakeAdapter(frames=frames), capture_path)
+    read_packets(recording, len(frames))
+    recording.stop()
+
+    replayed = read_packets(ReplayAdapter(capture_path, repeat=True),
+                            len(frames) * 3)
+    assert len(replayed) == len(frames) * 3
+
+def test_replay_ignores_unrecorded_writes(tmp_path):
+    frames = sample_frames(total_cells=4)
+    capture_path = os.path.join(str(tmp_path), 'capture.jsonl')
+    recording = RecordingAdapter(FakeAdapter(frames=frames), capture_path)
+    read_packets(recording, len(frames))
+    recording.stop()
+
+    adapter = ReplayAdapter(capture_path, repeat=True)
+    adapter.start()
+    device = adapter.connect()
+    device.char_write_handle(0x11, b'Q!\r')
+    # and the capture still plays
+    assert len(read_packets(adapter, len(frames) * 2)) == len(frames) * 2
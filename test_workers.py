@@ -0,0 +1,121 @@
+import time
+
+import BMS
+from commands import default_registry
+from transport import sample_frames
+from workers import RingState, SnapshotRing, Worker, WorkerSupervisor
+
+def test_ring_round_trip(live_state):
+    state = live_state(16)
+    ring = SnapshotRing.create(slots=4, max_cells=32)
+    try:
+        ring.write(state.snapshot(), sweeps=3)
+        snapshot, sweeps, published = ring.read()
+        expected = state.snapshot()
+        assert sweeps == 3
+        assert snapshot.version == expected.version
+        assert snapshot.complete
+        assert snapshot.info == expected.info
+        assert snapshot.field_versions == expected.field_versions
+        registry = default_registry()
+        for text in ("overview", "cells", "temperature", "cell 16"):
+            assert registry.reply(text, snapshot) == \
+                default_registry().reply(text, expected)
+    finally:
+        ring.close()
+
+def test_ring_counts_sweeps_that_change_nothing(live_state):
+    state = live_state()
+    ring = SnapshotRing.create(slots=2, max_cells=8)
+    try:
+        ring.write(state.snapshot(), state.assembler.sweeps)
+        reader = SnapshotRing.attach(ring.name)
+        snapshot, sweeps, published = reader.read()
+        assert sweeps == 1
+        # a steady pack, the same sweep again, fed as bms_worker does
+        for frame in sample_frames(4):
+            version = state.version
+            state.update(BMS.decode_packet(frame))
+            assert state.version == version
+            ring.touch(state.snapshot().received, state.assembler.sweeps)
+        snapshot, sweeps, later = reader.read()
+        assert snapshot.version == state.version
+        assert sweeps == 2 and later > published
+        # the counter carries over to a restarted writer
+        writer = SnapshotRing.attach(ring.name)
+        writer.touch(time.time(), 2)
+        assert reader.read()[2] == later
+        reader.close()
+        writer.close()
+    finally:
+        ring.close()
+
+def test_ring_keeps_latest_across_wraps(live_state):
+    state = live_state()
+    ring = SnapshotRing.create(slots=2, max_cells=8)
+    try:
+        reader = RingState(SnapshotRing.attach(ring.name))
+        assert reader.snapshot().version == 0
+        for i in range(5):
+            state.update(BMS.CellInfo(1, 4, 3.3 + i / 100.0, 20.0))
+            ring.write(state.snapshot())
+            assert reader.snapshot().version == state.version
+        assert reader.snapshot().info['cells'][1]['volts'] == 3.34
+        # a second writer (a restarted worker) continues the sequence
+        writer = SnapshotRing.attach(ring.name)
+        state.update(BMS.CellInfo(2, 4, 3.0, 20.0))
+        writer.write(state.snapshot())
+        assert reader.wait_ready(1).info['cells'][2]['volts'] == 3.0
+        writer.close()
+        reader.ring.close()
+    finally:
+        ring.close()
+
+def crashing_worker(ring_name, slot):
+    raise SystemExit(3)
+
+def stalled_worker(ring_name, slot):
+    time.sleep(60)
+
+def writing_worker(ring_name, slot, snapshot):
+    ring = SnapshotRing.attach(ring_name)
+    ring.write(snapshot)
+    while True:
+        ring.beat(slot)
+        time.sleep(0.05)
+
+def wait_for(condition, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.05)
+    return False
+
+def test_supervisor_restarts_failed_workers_alone(live_state):
+    workers = [Worker('writer', writing_worker, (live_state().snapshot(),),
+                      stall_timeout=5.0),
+               Worker('crash', crashing_worker, stall_timeout=5.0),
+               Worker('stall', stalled_worker, stall_timeout=1.0)]
+    with WorkerSupervisor(workers, max_cells=8, backoff_min=0.01,
+                          backoff_max=0.05) as supervisor:
+        supervisor.start()
+        assert supervisor.live_state.wait_ready(10).info['total_cells'] == 4
+        assert wait_for(lambda: supervisor.check() is not None and
+                        workers[1].restarts >= 2 and workers[2].restarts >= 1)
+        stats = {s['name']: s for s in supervisor.worker_stats()}
+        assert stats['writer']['alive']
+        assert stats['writer']['restarts'] == 0
+        assert stats['writer']['items'] > 0
+
+def test_worker_metrics(live_state):
+    from exporter import internal_metrics
+
+    workers = [Worker('writer', writing_worker, (live_state().snapshot(),))]
+    with WorkerSupervisor(workers, max_cells=8) as supervisor:
+        supervisor.start()
+        supervisor.live_state.wait_ready(10)
+        supervisor.ring.observe(0, 0.25)
+        text = internal_metrics(workers=supervisor.worker_stats)
+    assert 'bms_worker_up{worker="writer"} 1\n' in text
+    assert 'bms_worker_ipc_latency_seconds{worker="writer"} 0.25\n' in text
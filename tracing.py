@@ -0,0 +1,145 @@
+import atexit
+import functools
+import itertools
+import json
+import logging
+import os
+import signal
+import threading
+import time
+
+from metrics import Histogram
+
+LOG = logging.getLogger("Tracing")
+LOG.setLevel(logging.INFO)
+
+# spans kept in memory, older ones are overwritten
+RING_SIZE = 65536
+
+class Tracer(object):
+    """Tracer
+    Timed spans of the BLE and modem hot paths in a fixed size ring, with
+    a latency histogram per operation. Spans are only recorded while
+    enabled; a disabled traced() call costs one attribute check
+    """
+    def __init__(self, size=RING_SIZE):
+        self.enabled = False
+        self.size = size
+        # (name, start ns, duration ns, thread id, detail)
+        self.spans = [None] * size
+        # next() on a count is atomic, so recording takes no lock
+        self.counter = itertools.count()
+        self.recorded = 0
+        self.histograms = {}
+        self.path = None
+
+    def record(self, name, start, end, detail=None):
+        """record
+        Add a span from perf_counter_ns() start to end
+        """
+        index = next(self.counter)
+        self.spans[index % self.size] = (name, start, end - start,
+                                         threading.get_ident(), detail)
+        self.recorded = index + 1
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms.setdefault(name, Histogram())
+        histogram.observe((end - start) / 1e9)
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+        LOG.info("Tracing %s", "on" if enabled else "off")
+
+    def clear(self):
+        self.spans = [None] * self.size
+        self.counter = itertools.count()
+        self.recorded = 0
+        self.histograms = {}
+
+    def recent(self):
+        """recent
+        Spans in the ring, oldest first
+        """
+        count = min(self.recorded, self.size)
+        start = self.recorded - count
+        return [span for span in (self.spans[i % self.size]
+                                  for i in range(start, start + count))
+                if span is not None]
+
+    def chrome_trace(self):
+        """chrome_trace
+        The spans as Chrome trace events, for chrome://tracing or Perfetto
+        """
+        pid = os.getpid()
+        events = []
+        for name, start, duration, thread, detail in self.recent():
+            event = {'name': name, 'cat': name.split('.')[0], 'ph': 'X',
+                     'ts': start / 1e3, 'dur': duration / 1e3, 'pid': pid,
+                     'tid': thread}
+            if detail is not None:
+                event['args'] = {'detail': detail}
+            events.append(event)
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def dump(self, path=None):
+        path = path or self.path
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as myfile:
+            json.dump(self.chrome_trace(), myfile)
+        os.replace(tmp_path, path)
+        LOG.info("Wrote %d spans to %s", min(self.recorded, self.size), path)
+        return path
+
+    def summary(self):
+        """summary
+        operation -> (count, mean seconds, p99 bucket bound)
+        """
+        out = {}
+        for name, histogram in sorted(self.histograms.items()):
+            counts, count, total = histogram.snapshot()
+            if count:
+                out[name] = (count, total / count, histogram.quantile(0.99))
+        return out
+
+TRACER = Tracer()
+
+def traced(name, detail=None):
+    """traced
+    Decorator recording a span for each call while TRACER is enabled.
+    detail, if given, is called with the call arguments for a short
+    string to attach to the span
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not TRACER.enabled:
+                return func(*args, **kwargs)
+            start = time.perf_counter_ns()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                TRACER.record(name, start, time.perf_counter_ns(),
+                              detail(*args, **kwargs) if detail else None)
+        return wrapper
+    return decorator
+
+def install(path, enabled=False, signum=signal.SIGUSR1):
+    """install
+    Toggle tracing on signum; when it is turned off (or the process exits
+    with it on) the spans are written to path as a Chrome trace. Must be
+    called from the main thread
+    """
+    TRACER.path = path
+
+    def toggle(signum, frame):
+        if TRACER.enabled:
+            TRACER.enable(False)
+            TRACER.dump()
+        else:
+            TRACER.clear()
+            TRACER.enable(True)
+
+    signal.signal(signum, toggle)
+    atexit.register(lambda: TRACER.enabled and TRACER.dump())
+    if enabled:
+        TRACER.enable(True)
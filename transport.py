@@ -0,0 +1,425 @@
+import binascii
+import collections
+import json
+import logging
+import threading
+import time
+
+from BMS import (FLUSH, PACKET_SIZE, DEVICE_ADDR, INFO_CHAR_RD,
+                 MODE_CHAR_RW, RX_CHAR_WO, TX_CHAR_RD, RTS_CHAR_RD)
+from lazy import lazy_import
+
+# loaded on first use, it is slow to import
+pygatt = lazy_import('pygatt')
+
+LOG = logging.getLogger('Transport')
+LOG.setLevel(logging.INFO)
+
+HANDLES = {
+    INFO_CHAR_RD: 0x0b,
+    MODE_CHAR_RW: 0x0e,
+    RX_CHAR_WO: 0x11,
+    TX_CHAR_RD: 0x14,
+    RTS_CHAR_RD: 0x18
+}
+
+def encode_temp(temp):
+    return int(round((temp + 232.1) / 0.857))
+
+def sample_frames(total_cells=15, cell_volts=3.32, cell_temp=20.0):
+    """sample_frames
+    Return one full sweep of BMS frames (overview, min/max, energy, power
+    and every cell) with values similar to test_data.json
+    """
+    volts = int(round(cell_volts / 0.005))
+    temp = encode_temp(cell_temp)
+    frames = [
+        'U_%04X_%04X_%04X_%04X' % (volts * total_cells, 0, 20, 20),
+        'T_%03X_%02X_%03X_%02X' % (temp, 1, temp + 5, total_cells),
+        'E_%06X_%06X_%06X_%02X' % (1500, 4200, 2700, 87),
+        'M_%04X_%04X_%02X:%02X' % (0, 250, 23, 3),
+        'V_%04X_%02X_%04X_%02X_%04X' % (volts - 2, 1, volts + 2,
+                                        total_cells, 680),
+    ]
+    for idx in range(1, total_cells + 1):
+        frames.append('C_%02X_%02X_%04X_%03X_00' % (
+            idx, total_cells, volts + (idx % 3) - 1, temp + (idx % 5)))
+    return [(f + '\r').encode() for f in frames]
+
+class FakeDevice(object):
+    """FakeDevice
+    Emulates the BMS side of the serial-over-BLE protocol: commands are
+    echoed and acknowledged on the next '$' flush, and while cell data is
+    enabled every '$' returns the next frame of the sweep.
+    Acknowledged writes block for `latency` seconds; the notifications of
+    unacknowledged writes are delivered `latency` seconds after the write
+    by a delivery thread, so several can be in flight at once.
+    mode, streaming and frame_index are BMS state that a new connection
+    can carry over from the previous device
+    """
+    def __init__(self, address, frames, chunk_size=PACKET_SIZE, latency=0.0,
+                 mode=0, streaming=False, frame_index=0):
+        self.address = address
+        self.frames = frames
+        self.chunk_size = chunk_size
+        self.latency = latency
+        self.callbacks = {}
+        self.pending = collections.deque()
+        self.mode = mode
+        self.streaming = streaming
+        self.frame_index = frame_index
+        self.connected = True
+        self.writes = 0
+        self.round_trips = 0
+        self.handle_lookups = 0
+        self.lock = threading.Lock()
+        self.deliveries = collections.deque()
+        self.delivery_cond = threading.Condition()
+        self.delivery_thread = None
+
+    def _check_connected(self):
+        if not self.connected:
+            raise pygatt.exceptions.NotConnectedError("Fake device disconnected")
+
+    def subscribe(self, uuid, callback=None, indication=False,
+                  wait_for_response=True):
+        self._check_connected()
+        self.callbacks[HANDLES[uuid]] = callback
+
+    def unsubscribe(self, uuid):
+        self.callbacks.pop(HANDLES[uuid], None)
+
+    def get_handle(self, uuid):
+        self._check_connected()
+        self.handle_lookups += 1
+        return HANDLES[uuid]
+
+    def disconnect(self):
+        self.connected = False
+        with self.delivery_cond:
+            self.delivery_cond.notify_all()
+
+    def char_read_handle(self, handle, timeout=4):
+        self._check_connected()
+        self.round_trips += 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+        if handle == HANDLES[MODE_CHAR_RW]:
+            return bytearray([self.mode])
+        return bytearray()
+
+    def char_write(self, uuid, value, wait_for_response=True):
+        return self.char_write_handle(HANDLES[uuid], value, wait_for_response)
+
+    def char_write_handle(self, handle, value, wait_for_response=True,
+                          timeout=30):
+        self._check_connected()
+        with self.lock:
+            self.writes += 1
+            if wait_for_response:
+                self.round_trips += 1
+            out = []
+            if handle == HANDLES[MODE_CHAR_RW]:
+                self.mode = value[0]
+            elif handle == HANDLES[RX_CHAR_WO]:
+                value = bytes(value)
+                if value != b'$':
+                    self._command(value)
+                elif self.pending:
+                    out = list(self.pending)
+                    self.pending.clear()
+                elif self.streaming:
+                    out = [self.frames[self.frame_index]]
+                    self.frame_index = (self.frame_index + 1) % \
+                        len(self.frames)
+        if self.latency <= 0:
+            for frame in out:
+                self._notify(frame)
+            return
+        # queued either way so notifications keep the order of the writes
+        if out:
+            self._deliver_later(out)
+        if wait_for_response:
+            time.sleep(self.latency)
+
+    def _deliver_later(self, frames):
+        with self.delivery_cond:
+            self.deliveries.append((time.monotonic() + self.latency, frames))
+            if self.delivery_thread is None:
+                self.delivery_thread = threading.Thread(
+                    target=self._delivery_loop, daemon=True)
+                self.delivery_thread.start()
+            self.delivery_cond.notify()
+
+    def _delivery_loop(self):
+        while self.connected:
+            with self.delivery_cond:
+                if not self.deliveries:
+                    self.delivery_cond.wait(0.5)
+                    continue
+                due, frames = self.deliveries[0]
+                remaining = due - time.monotonic()
+                if remaining > 0:
+                    self.delivery_cond.wait(remaining)
+                    continue
+                self.deliveries.popleft()
+            for frame in frames:
+                self._notify(frame)
+
+    def _command(self, command):
+        if command == b'E!\r':
+            self.streaming = True
+        elif command == b'D!\r':
+            self.streaming = False
+        self.pending.append(command)
+        self.pending.append(b'OK\r')
+
+    def _notify(self, frame):
+        callback = self.callbacks.get(HANDLES[TX_CHAR_RD])
+        if callback is None:
+            return
+        for i in range(0, len(frame), self.chunk_size):
+            callback(HANDLES[TX_CHAR_RD], bytearray(frame[i:i + self.chunk_size]))
+
+class FakeAdapter(object):
+    """FakeAdapter
+    Stand-in for pygatt.GATTToolBackend serving FakeDevices. The first
+    connect_failures connection attempts raise NotConnectedError and
+    every connection takes connect_latency seconds
+    """
+    def __init__(self, frames=None, connect_failures=0, connect_latency=0.0,
+                 **device_args):
+        self.frames = frames if frames is not None else sample_frames()
+        self.connect_failures = connect_failures
+        self.connect_latency = connect_latency
+        self.device_args = device_args
+        self.devices = {}
+        self.started = False
+
+    def start(self):
+        self.started = True
+
+    def stop(self):
+        self.started = False
+
+    def connect(self, address=DEVICE_ADDR, timeout=5):
+        if self.connect_latency > 0:
+            time.sleep(self.connect_latency)
+        if self.connect_failures > 0:
+            self.connect_failures -= 1
+            raise pygatt.exceptions.NotConnectedError("Fake connection refused")
+        state = {}
+        previous = self.devices.get(address)
+        if previous is not None:
+            # the BMS keeps its state when the link drops
+            previous.disconnect()
+            state = {'mode': previous.mode, 'streaming': previous.streaming,
+                     'frame_index': previous.frame_index}
+        device = FakeDevice(address, self.frames, **dict(self.device_args,
+                                                         **state))
+        self.devices[address] = device
+        return device
+
+class RecordingDevice(object):
+    """RecordingDevice
+    Wraps a pygatt device and logs writes and notification chunks with
+    their time since connection, one JSON object per line
+    """
+    def __init__(self, device, capture):
+        self.device = device
+        self.capture = capture
+        self.lock = threading.Lock()
+        self.start = time.monotonic()
+
+    def _log(self, event, handle, value):
+        line = json.dumps({
+            't': round(time.monotonic() - self.start, 6),
+            'event': event,
+            'handle': handle,
+            'value': binascii.hexlify(bytes(value)).decode()
+        })
+        with self.lock:
+            self.capture.write(line + '\n')
+
+    def subscribe(self, uuid, callback=None, indication=False,
+                  wait_for_response=True):
+        def recording_callback(handle, value):
+            self._log('notify', handle, value)
+            if callback is not None:
+                callback(handle, value)
+        return self.device.subscribe(uuid, callback=recording_callback,
+                                     indication=indication,
+                                     wait_for_response=wait_for_response)
+
+    def unsubscribe(self, uuid):
+        return self.device.unsubscribe(uuid)
+
+    def get_handle(self, uuid):
+        return self.device.get_handle(uuid)
+
+    def char_read_handle(self, handle, timeout=4):
+        return self.device.char_read_handle(handle, timeout=timeout)
+
+    def disconnect(self):
+        self.capture.flush()
+        return self.device.disconnect()
+
+    def char_write(self, uuid, value, wait_for_response=True):
+        return self.char_write_handle(self.get_handle(uuid), value,
+                                      wait_for_response)
+
+    def char_write_handle(self, handle, value, wait_for_response=True,
+                          timeout=30):
+        self._log('write', handle, value)
+        return self.device.char_write_handle(
+            handle, value, wait_for_response=wait_for_response,
+            timeout=timeout)
+
+class RecordingAdapter(object):
+    """RecordingAdapter
+    Wraps an adapter (e.g. pygatt.GATTToolBackend) and captures every
+    connection to capture_path for later replay
+    """
+    def __init__(self, adapter, capture_path):
+        self.adapter = adapter
+        self.capture = open(capture_path, 'a')
+
+    def start(self):
+        self.adapter.start()
+
+    def stop(self):
+        self.adapter.stop()
+        self.capture.close()
+
+    def connect(self, address=DEVICE_ADDR, timeout=5):
+        return RecordingDevice(self.adapter.connect(address, timeout=timeout),
+                               self.capture)
+
+def load_capture(capture_path):
+    events = []
+    with open(capture_path) as myfile:
+        for line in myfile:
+            if len(line.strip()) == 0:
+                continue
+            event = json.loads(line)
+            event['value'] = binascii.unhexlify(event['value'])
+            events.append(event)
+    return events
+
+class ReplayDevice(object):
+    """ReplayDevice
+    Plays back a capture: every write advances to the matching recorded
+    write and delivers the notification chunks that followed it, either
+    with their recorded delays (realtime) or immediately
+    """
+    def __init__(self, events, realtime=False, repeat=False):
+        self.events = events
+        self.realtime = realtime
+        self.repeat = repeat
+        self.position = 0
+        self.loop_start = self._find_loop_start()
+        self.callback = None
+        self.connected = True
+        self.lock = threading.Lock()
+
+    def _find_loop_start(self):
+        # the second '$' after the enable cell data command is the first
+        # one answered with data
+        flushes = 0
+        enabled = False
+        for index, event in enumerate(self.events):
+            if event['event'] != 'write':
+                continue
+            if event['value'] == b'E!\r':
+                enabled = True
+            elif enabled and event['value'] == FLUSH:
+                flushes += 1
+                if flushes == 2:
+                    return index
+        return None
+
+    def subscribe(self, uuid, callback=None, indication=False,
+                  wait_for_response=True):
+        self.callback = callback
+
+    def unsubscribe(self, uuid):
+        self.callback = None
+
+    def get_handle(self, uuid):
+        return HANDLES[uuid]
+
+    def disconnect(self):
+        self.connected = False
+
+    def char_write(self, uuid, value, wait_for_response=True):
+        return self.char_write_handle(HANDLES[uuid], value, wait_for_response)
+
+    def _scan(self, handle, value, index):
+        # index of the first recorded write of this value from index on. A
+        # '$' only matches the next recorded write
+        while index < len(self.events):
+            event = self.events[index]
+            if event['event'] == 'write' and event['handle'] == handle:
+                if event['value'] == value:
+                    return index
+                if value == FLUSH:
+                    return None
+            index += 1
+        return None
+
+    def _next_write(self, handle, value):
+        # index of the next recorded write of this value. When repeating a
+        # '$' wraps to the start of the streamed data instead of running
+        # into a command, other writes are looked for once from the start
+        index = self._scan(handle, value, self.position)
+        if index is not None or not self.repeat:
+            return index
+        if value == FLUSH:
+            return self.loop_start
+        return self._scan(handle, value, 0)
+
+    def char_write_handle(self, handle, value, wait_for_response=True,
+                          timeout=30):
+        if not self.connected:
+            raise pygatt.exceptions.NotConnectedError("Replay disconnected")
+        with self.lock:
+            index = self._next_write(handle, bytes(value))
+            if index is None:
+                return
+            written = self.events[index]['t']
+            chunks = []
+            index += 1
+            while index < len(self.events) and \
+                    self.events[index]['event'] == 'notify':
+                chunks.append(self.events[index])
+                index += 1
+            self.position = index
+        started = time.monotonic()
+        for chunk in chunks:
+            if self.realtime:
+                delay = chunk['t'] - written - (time.monotonic() - started)
+                if delay > 0:
+                    time.sleep(delay)
+            if self.callback is not None:
+                self.callback(chunk['handle'], bytearray(chunk['value']))
+
+class ReplayAdapter(object):
+    """ReplayAdapter
+    Stand-in for pygatt.GATTToolBackend replaying a capture made with
+    RecordingAdapter, at recorded speed (realtime) or as fast as possible
+    """
+    def __init__(self, capture_path=None, events=None, realtime=False,
+                 repeat=False):
+        self.events = events if events is not None else \
+            load_capture(capture_path)
+        self.realtime = realtime
+        self.repeat = repeat
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def connect(self, address=DEVICE_ADDR, timeout=5):
+        return ReplayDevice(self.events, self.realtime, self.repeat)
@@ -0,0 +1,636 @@
+import collections
+import logging
+import multiprocessing
+import signal
+import struct
+import sys
+import threading
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+from BMS import backoff_delay
+from state import Snapshot
+
+LOG = logging.getLogger("Workers")
+LOG.setLevel(logging.INFO)
+
+# battery_info fields stored in the snapshot ring
+SCALAR_FIELDS = [
+    'pack_voltage', 'input_amps', 'pack_amps', 'output_amps', 'input_kwh',
+    'pack_kwh', 'output_kwh', 'pack_soc', 'input_watts', 'output_watts',
+    'time_hours', 'time_minutes', 'balance_volts', 'total_cells']
+INT_FIELDS = set(['pack_soc', 'input_watts', 'output_watts', 'time_hours',
+                  'time_minutes', 'total_cells'])
+# (field, value key) of the {'index', value key} fields
+CELL_FIELDS = [('min_volt_cell', 'volts'), ('max_volt_cell', 'volts'),
+               ('min_temp_cell', 'temp'), ('max_temp_cell', 'temp')]
+FIELD_COUNT = len(SCALAR_FIELDS) + len(CELL_FIELDS)
+
+RING_MAGIC = 0x534d4252
+# magic, slots, max cells, worker slots, latest write (-1 if none), time
+# of the last packet, sweeps ended, monotonic time the last one ended
+RING_HEAD = struct.Struct('<IIIIqdQd')
+LATEST_OFFSET = 16
+RECEIVED_OFFSET = 24
+SWEEPS_OFFSET = 32
+# heartbeat, items, latency sum, latency count, latency max
+WORKER_STATS = struct.Struct('<dQdQd')
+
+# snapshot flags byte
+FLAG_COMPLETE = 1
+FLAG_RESTORED = 2
+
+# seconds a worker has to be up before its failures are forgotten
+WORKER_STABLE = 60.0
+
+def _slot_structs(max_cells):
+    # seq, version, timestamp, published, sweeps, cells, flags,
+    # values, field versions, cells version
+    fixed = struct.Struct('<QQddIHBx%dd%dQQ' % (
+        len(SCALAR_FIELDS) + 2 * len(CELL_FIELDS), FIELD_COUNT))
+    # volts, temps and versions of every cell
+    cells = struct.Struct('<%dd%dd%dQ' % ((max_cells,) * 3))
+    return fixed, cells
+
+class SnapshotRing(object):
+    """SnapshotRing
+    Snapshots in a ring of fixed-layout slots in shared memory, written by
+    one process and read by any number of others without pickling. Each
+    slot carries a sequence number that is odd while the slot is written,
+    readers retry if it changed under them. Worker heartbeat and latency
+    counters follow the slots
+    """
+    def __init__(self, shm, slots, max_cells, worker_slots, owner):
+        self.shm = shm
+        self.buf = shm.buf
+        self.slots = slots
+        self.max_cells = max_cells
+        self.worker_slots = worker_slots
+        self.owner = owner
+        self.fixed, self.cells = _slot_structs(max_cells)
+        self.slot_size = self.fixed.size + self.cells.size
+        self.stats_offset = RING_HEAD.size + slots * self.slot_size
+        # a restarted writer carries on after the last write
+        self.written = self._latest()
+        self.sweeps_written = self.sweeps()[0]
+        # writer side copy of the cells region, only changed cells are
+        # packed into it
+        self.cell_buf = bytearray(self.cells.size)
+        self.cell_cache = {}
+        self.cell_count = 0
+        self.cells_version = None
+        # stats are updated from several threads of a worker
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def size(slots, max_cells, worker_slots):
+        fixed, cells = _slot_structs(max_cells)
+        return RING_HEAD.size + slots * (fixed.size + cells.size) + \
+            worker_slots * WORKER_STATS.size
+
+    @classmethod
+    def create(cls, slots=8, max_cells=256, worker_slots=4):
+        shm = shared_memory.SharedMemory(
+            create=True, size=cls.size(slots, max_cells, worker_slots))
+        RING_HEAD.pack_into(shm.buf, 0, RING_MAGIC, slots, max_cells,
+                            worker_slots, -1, 0.0, 0, 0.0)
+        return cls(shm, slots, max_cells, worker_slots, True)
+
+    @classmethod
+    def attach(cls, name):
+        shm = shared_memory.SharedMemory(name=name)
+        # only the creating process unlinks the segment
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        magic, slots, max_cells, worker_slots = \
+            RING_HEAD.unpack_from(shm.buf, 0)[:4]
+        if magic != RING_MAGIC:
+            raise ValueError("%s is not a snapshot ring" % name)
+        return cls(shm, slots, max_cells, worker_slots, False)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def close(self):
+        self.buf = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+    def _latest(self):
+        return RING_HEAD.unpack_from(self.buf, 0)[4]
+
+    def _slot(self, index):
+        return RING_HEAD.size + (index % self.slots) * self.slot_size
+
+    def write(self, snapshot, sweeps=0):
+        """write
+        Publish a snapshot into the next slot
+        """
+        info = snapshot.info
+        versions = snapshot.field_versions
+        values = []
+        field_versions = []
+        for field in SCALAR_FIELDS:
+            values.append(info.get(field, 0))
+            field_versions.append(versions.get(field, 0))
+        for field, key in CELL_FIELDS:
+            cell = info.get(field)
+            values += [cell['index'], cell[key]] if cell else [0, 0]
+            field_versions.append(versions.get(field, 0))
+        if versions.get('cells') != self.cells_version:
+            self.cells_version = versions.get('cells')
+            self._pack_cells(info['cells'], versions)
+
+        sequence = self.written + 1
+        offset = self._slot(sequence)
+        struct.pack_into('<Q', self.buf, offset, 2 * sequence + 1)
+        self.fixed.pack_into(
+            self.buf, offset, 2 * sequence + 1, snapshot.version,
+            snapshot.timestamp, time.monotonic(), sweeps, self.cell_count,
+            (FLAG_COMPLETE if snapshot.complete else 0) |
+            (FLAG_RESTORED if snapshot.restored else 0), *(values + field_versions +
+                                 [versions.get('cells', 0)]))
+        start = offset + self.fixed.size
+        self.buf[start:start + self.cells.size] = self.cell_buf
+        struct.pack_into('<Q', self.buf, offset, 2 * sequence + 2)
+        struct.pack_into('<q', self.buf, LATEST_OFFSET, sequence)
+        self.written = sequence
+        self.touch(snapshot.received, sweeps)
+
+    def touch(self, received, sweeps=None):
+        """touch
+        Record the time of the last packet and the sweeps ended so far,
+        which move without the snapshot changing
+        """
+        struct.pack_into('<d', self.buf, RECEIVED_OFFSET, received)
+        if sweeps is not None and sweeps != self.sweeps_written:
+            struct.pack_into('<Qd', self.buf, SWEEPS_OFFSET, sweeps,
+                             time.monotonic())
+            self.sweeps_written = sweeps
+
+    def received(self):
+        return struct.unpack_from('<d', self.buf, RECEIVED_OFFSET)[0]
+
+    def sweeps(self):
+        """sweeps
+        Return (sweeps ended, monotonic time the last one ended)
+        """
+        return struct.unpack_from('<Qd', self.buf, SWEEPS_OFFSET)
+
+    def _pack_cells(self, cells, versions):
+        # published cell dicts are replaced, never changed, when a cell
+        # changes so unchanged cells are found by identity
+        max_cells = self.max_cells
+        for index, cell in cells.items():
+            if self.cell_cache.get(index) is cell or \
+                    not 0 < index <= max_cells:
+                continue
+            self.cell_cache[index] = cell
+            struct.pack_into('<d', self.cell_buf, 8 * (index - 1),
+                             cell['volts'])
+            struct.pack_into('<d', self.cell_buf, 8 * (max_cells + index - 1),
+                             cell['temp'])
+            struct.pack_into('<Q', self.cell_buf,
+                             8 * (2 * max_cells + index - 1),
+                             versions.get(('cells', index), 1))
+            self.cell_count = max(self.cell_count, index)
+
+    def version(self):
+        """version
+        Version of the latest snapshot, 0 if none was written
+        """
+        latest = self._latest()
+        if latest < 0:
+            return 0
+        return struct.unpack_from('<Q', self.buf, self._slot(latest) + 8)[0]
+
+    def read(self):
+        """read
+        Return (snapshot, sweeps, monotonic publish time) of the latest
+        write, None if there is none. sweeps also counts the sweeps that
+        changed nothing, the publish time is then when the last one ended
+        """
+        while True:
+            latest = self._latest()
+            if latest < 0:
+                return None
+            offset = self._slot(latest)
+            fixed = self.fixed.unpack_from(self.buf, offset)
+            if fixed[0] != 2 * latest + 2:
+                continue
+            cells = self.cells.unpack_from(self.buf, offset + self.fixed.size)
+            if struct.unpack_from('<Q', self.buf, offset)[0] == fixed[0]:
+                break
+        snapshot = self._snapshot(fixed, cells)
+        snapshot.received = max(snapshot.timestamp, self.received())
+        sweeps, swept = self.sweeps()
+        if sweeps > fixed[4]:
+            return snapshot, sweeps, max(fixed[3], swept)
+        return snapshot, fixed[4], fixed[3]
+
+    def _snapshot(self, fixed, cells):
+        version, timestamp, count, flags = \
+            fixed[1], fixed[2], fixed[5], fixed[6]
+        values = fixed[7:7 + len(SCALAR_FIELDS) + 2 * len(CELL_FIELDS)]
+        field_versions = fixed[7 + len(values):-1]
+        info = {}
+        versions = {}
+        for pos, field in enumerate(SCALAR_FIELDS):
+            if field_versions[pos]:
+                value = values[pos]
+                info[field] = int(value) if field in INT_FIELDS else value
+                versions[field] = field_versions[pos]
+        for pos, (field, key) in enumerate(CELL_FIELDS):
+            if field_versions[len(SCALAR_FIELDS) + pos]:
+                base = len(SCALAR_FIELDS) + 2 * pos
+                info[field] = {'index': int(values[base]),
+                               key: values[base + 1]}
+                versions[field] = field_versions[len(SCALAR_FIELDS) + pos]
+        info['cells'] = {}
+        max_cells = self.max_cells
+        for i in range(count):
+            cell_version = cells[2 * max_cells + i]
+            if cell_version:
+                info['cells'][i + 1] = {'temp': cells[max_cells + i],
+                                        'volts': cells[i]}
+                versions[('cells', i + 1)] = cell_version
+        if fixed[-1]:
+            versions['cells'] = fixed[-1]
+        return Snapshot(version, timestamp, info, versions,
+                        bool(flags & FLAG_COMPLETE), bool(flags & FLAG_RESTORED))
+
+    def _stats(self, slot):
+        return self.stats_offset + slot * WORKER_STATS.size
+
+    def beat(self, slot, items=1):
+        """beat
+        Record a worker heartbeat and the work items done since the last
+        """
+        offset = self._stats(slot)
+        with self.lock:
+            done = struct.unpack_from('<Q', self.buf, offset + 8)[0]
+            struct.pack_into('<dQ', self.buf, offset, time.monotonic(),
+                             done + items)
+
+    def observe(self, slot, latency):
+        """observe
+        Record an IPC latency (seconds from send to receipt) of a worker
+        """
+        offset = self._stats(slot) + 16
+        with self.lock:
+            total, count, worst = struct.unpack_from('<dQd', self.buf, offset)
+            struct.pack_into('<dQd', self.buf, offset, total + latency,
+                             count + 1, max(worst, latency))
+
+    def reset_stats(self, slot):
+        WORKER_STATS.pack_into(self.buf, self._stats(slot), time.monotonic(),
+                               0, 0.0, 0, 0.0)
+
+    def worker_stats(self, slot):
+        heartbeat, items, total, count, worst = \
+            WORKER_STATS.unpack_from(self.buf, self._stats(slot))
+        return {
+            'heartbeat_age': time.monotonic() - heartbeat,
+            'items': items,
+            'mean_latency': total / count if count else None,
+            'max_latency': worst if count else None
+        }
+
+class RingState(object):
+    """RingState
+    Read-only LiveState backed by a SnapshotRing, for processes other
+    than the BMS worker. Snapshots are decoded once per version
+    """
+    def __init__(self, ring, poll_interval=0.1):
+        self.ring = ring
+        self.poll_interval = poll_interval
+        self.current = Snapshot(0, time.time(), {'cells': {}}, {}, False)
+
+    def snapshot(self):
+        if self.ring.version() != self.current.version:
+            latest = self.ring.read()
+            if latest is not None:
+                self.current = latest[0]
+        elif self.current.version:
+            self.current.received = self.ring.received()
+        return self.current
+
+    def wait_ready(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            snapshot = self.snapshot()
+            if snapshot.complete:
+                return snapshot
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+            time.sleep(self.poll_interval)
+
+class Worker(object):
+    """Worker
+    A subsystem run as target(ring name, stats slot, *args) in its own
+    process. It is restarted when it exits or when it has not beaten its
+    heartbeat for stall_timeout seconds
+    """
+    def __init__(self, name, target, args=(), stall_timeout=60.0):
+        self.name = name
+        self.target = target
+        self.args = args
+        self.stall_timeout = stall_timeout
+        self.process = None
+        self.started = None
+        self.restarts = 0
+        self.failures = 0
+        self.restart_at = None
+
+class WorkerSupervisor(object):
+    """WorkerSupervisor
+    Runs each worker in a process of its own, sharing snapshots through a
+    SnapshotRing. Workers that die or stall are restarted alone, with
+    backoff while they keep failing
+    """
+    def __init__(self, workers, max_cells=256, slots=8, context='spawn',
+                 backoff_min=1.0, backoff_max=60.0):
+        self.workers = workers
+        self.context = multiprocessing.get_context(context)
+        self.ring = SnapshotRing.create(slots, max_cells, len(workers))
+        self.live_state = RingState(self.ring)
+        # an MqttPublisher of live_state, for the metrics server
+        self.publisher = None
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+        self.running = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def _spawn(self, slot, worker):
+        self.ring.reset_stats(slot)
+        worker.process = self.context.Process(
+            target=worker.target, name=worker.name, daemon=True,
+            args=(self.ring.name, slot) + tuple(worker.args))
+        worker.process.start()
+        worker.started = time.monotonic()
+        LOG.info("Started %s worker (pid %d)", worker.name, worker.process.pid)
+
+    def _kill(self, worker, timeout=5.0):
+        worker.process.terminate()
+        worker.process.join(timeout)
+        if worker.process.is_alive():
+            worker.process.kill()
+            worker.process.join()
+
+    def start(self):
+        self.running = True
+        for slot, worker in enumerate(self.workers):
+            self._spawn(slot, worker)
+
+    def check(self):
+        """check
+        Restart the workers that exited or stalled, returns the number of
+        workers found failed
+        """
+        now = time.monotonic()
+        failed = 0
+        for slot, worker in enumerate(self.workers):
+            if worker.restart_at is not None:
+                if now >= worker.restart_at:
+                    worker.restart_at = None
+                    self._spawn(slot, worker)
+                continue
+            age = self.ring.worker_stats(slot)['heartbeat_age']
+            alive = worker.process.is_alive()
+            if alive and age < worker.stall_timeout:
+                if now - worker.started > WORKER_STABLE:
+                    worker.failures = 0
+                continue
+            if alive:
+                LOG.error("%s worker stalled for %.0fs, restarting",
+                          worker.name, age)
+                self._kill(worker)
+            else:
+                LOG.error("%s worker exited with %s", worker.name,
+                          worker.process.exitcode)
+            failed += 1
+            worker.failures += 1
+            worker.restarts += 1
+            worker.restart_at = now + backoff_delay(
+                worker.failures, self.backoff_min, self.backoff_max)
+        return failed
+
+    def run(self, interval=1.0):
+        self.start()
+        while self.running:
+            self.check()
+            time.sleep(interval)
+
+    def stop(self):
+        self.running = False
+        for worker in self.workers:
+            if worker.process is not None and worker.process.is_alive():
+                self._kill(worker)
+        if self.ring.buf is not None:
+            self.ring.close()
+
+    def worker_stats(self):
+        """worker_stats
+        Health of every worker, for the exporter
+        """
+        out = []
+        for slot, worker in enumerate(self.workers):
+            stats = self.ring.worker_stats(slot)
+            stats['name'] = worker.name
+            stats['alive'] = worker.process is not None and \
+                worker.process.is_alive()
+            stats['restarts'] = worker.restarts
+            out.append(stats)
+        return out
+
+def _init_worker(config, name):
+    # SIGTERM unwinds the worker so BLE and serial ports are closed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    from main import setup_logging
+    setup_logging()
+    # each worker traces to a file of its own
+    import tracing
+    tracing.install(config['trace_path'] + '.' + name, config['trace'])
+
+class RemoteAlerts(object):
+    # active alerts as last published by the BMS worker
+    Rule = collections.namedtuple('Rule', 'name')
+
+    def __init__(self):
+        self.current = []
+
+    def update(self, active):
+        self.current = [(self.Rule(name), cell) for name, cell in active]
+
+    def active(self):
+        return self.current
+
+class RemoteAnalytics(object):
+    # analytics summary as last published by the analytics worker
+    def __init__(self):
+        self.current = None
+
+    def update(self, summary):
+        self.current = summary
+
+    def summary(self, window=None):
+        return self.current
+
+def bms_worker(ring_name, slot, config):
+    """bms_worker
+    Streams from the BMS into a LiveState published to the ring, records
+    history and evaluates alerts. Alerts go to the SMS worker's inbox
+    """
+    _init_worker(config, 'bms')
+    import BMS
+    from alerts import AlertEngine, load_rules
+    from recorder import Recorder, Rollups
+    from scheduler import AdaptiveScheduler
+    from state import Checkpoint, LiveState
+
+    ring = SnapshotRing.attach(ring_name)
+    inbox = config['inbox']
+    state = LiveState()
+    # versions keep increasing across restarts, replies are cached by them
+    state.version = ring.version()
+    # carry on from the last snapshot, or the checkpoint the ring was
+    # seeded with, until the first sweep
+    latest = ring.read()
+    if latest is not None and latest[0].complete:
+        state.restore(latest[0])
+    checkpoint = None
+    if config.get('checkpoint'):
+        checkpoint = Checkpoint(config['checkpoint'])
+    recorder = rollups = alerts = None
+    if config.get('record'):
+        recorder = Recorder(config['record'],
+                            max_segments=config.get('keep_raw_days') or None)
+        rollups = Rollups(config['rollups'])
+    if config.get('alerts'):
+        alerts = AlertEngine(
+            load_rules(config['alerts']),
+            lambda alert: inbox.put(('alert', alert.message(),
+                                     time.monotonic())))
+    active = []
+    scheduler = None
+    if config.get('sweep_interval'):
+        scheduler = AdaptiveScheduler(*config['sweep_interval'],
+                                      alerts=alerts)
+
+    ring.beat(slot, 0)
+    # no packets while reconnecting, beat from the reconnect loop so a
+    # long outage is not taken for a stall
+    with BMS.ConnectionSupervisor(
+            BMS.SmartBMS(pipeline=config.get('pipeline', 0)),
+            heartbeat=lambda: ring.beat(slot, 0)) as supervisor:
+        for packet in supervisor.stream(timeout=10, scheduler=scheduler):
+            version = state.version
+            state.update(packet)
+            if state.version != version:
+                ring.write(state.snapshot(), state.assembler.sweeps)
+                if checkpoint is not None:
+                    checkpoint.save(state.snapshot())
+            else:
+                ring.touch(state.snapshot().received, state.assembler.sweeps)
+            if recorder is not None:
+                recorder.record(packet)
+                rollups.add(packet)
+            if alerts is not None:
+                alerts.evaluate(packet)
+                if state.sweep_ended:
+                    names = [(r.name, c) for r, c in alerts.active()]
+                    if names != active:
+                        active = names
+                        inbox.put(('active', names, time.monotonic()))
+            ring.beat(slot)
+
+def sms_worker(ring_name, slot, config):
+    """sms_worker
+    Answers SMS from the ring snapshots and sends the alerts and
+    analytics summaries that arrive in its inbox
+    """
+    _init_worker(config, 'sms')
+    from main import BatteryMonitor
+    from recorder import Recorder, Rollups
+    from SMS import PRIORITY_HIGH
+
+    ring = SnapshotRing.attach(ring_name)
+    inbox = config['inbox']
+    alerts = RemoteAlerts() if config.get('alerts') else None
+    analytics = RemoteAnalytics() if config.get('analytics') else None
+    recorder = rollups = None
+    if config.get('record'):
+        # read only, the BMS worker writes the history
+        recorder = Recorder(config['record'])
+        rollups = Rollups(config['rollups'])
+    monitor = BatteryMonitor(
+        config['disable_sms'], config.get('request'), config['phone_list'],
+        continuous=True, recorder=recorder, analytics=analytics,
+        sms_push=config.get('sms_push', False),
+        outbox_path=config.get('outbox'), rollups=rollups,
+        live_state=RingState(ring), alerts=alerts,
+        max_segments=config.get('max_segments'))
+
+    def drain_inbox():
+        while True:
+            kind, payload, sent = inbox.get()
+            ring.observe(slot, time.monotonic() - sent)
+            if kind == 'alert':
+                for number in monitor.sms.whitelist:
+                    monitor.outbox.enqueue(number, payload,
+                                           priority=PRIORITY_HIGH)
+            elif kind == 'active' and alerts is not None:
+                alerts.update(payload)
+            elif kind == 'analytics' and analytics is not None:
+                analytics.update(payload)
+
+    def heartbeat():
+        # the SMS loop is alive while it keeps issuing AT commands
+        commands = None
+        while True:
+            if monitor.sms.at.commands != commands:
+                commands = monitor.sms.at.commands
+                ring.beat(slot)
+            time.sleep(1.0)
+
+    ring.beat(slot, 0)
+    for target in (drain_inbox, heartbeat):
+        threading.Thread(target=target, daemon=True).start()
+    monitor.task_respond_to_sms()
+
+def analytics_worker(ring_name, slot, config):
+    """analytics_worker
+    Samples every completed sweep from the ring into a CellHistory and
+    sends its summary to the SMS worker
+    """
+    _init_worker(config, 'analytics')
+    from analytics import CellHistory
+
+    ring = SnapshotRing.attach(ring_name)
+    inbox = config['inbox']
+    history = CellHistory()
+    interval = config.get('summary_interval', 10.0)
+    last_sweeps = None
+    last_sent = 0.0
+    while True:
+        latest = ring.read()
+        ring.beat(slot, 0)
+        if latest is not None:
+            snapshot, sweeps, published = latest
+            if sweeps != last_sweeps and snapshot.complete and \
+                    not snapshot.restored:
+                last_sweeps = sweeps
+                ring.observe(slot, time.monotonic() - published)
+                history.add_sample(snapshot.info, snapshot.received)
+                ring.beat(slot)
+                if time.monotonic() - last_sent >= interval:
+                    inbox.put(('analytics', history.summary(),
+                               time.monotonic()))
+                    last_sent = time.monotonic()
+        time.sleep(config.get('poll_interval', 0.2))